@@ -0,0 +1,374 @@
+"""Benchmark the workflow stages on synthetic data
+
+Generates synthetic orthomosaics and multi-date bird predictions at several
+scales, then times each stage in a fresh process and records wall time, CPU
+time and peak memory. Results are written as JSON and compared against a
+baseline file from an earlier run on the same machine. Everything runs
+offline on the CPU; stages whose dependencies are not installed (e.g. the GDAL
+python bindings for projection) are reported as skipped.
+
+    python benchmark.py --scales small medium --output results.json --baseline baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import geopandas
+import numpy as np
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import instrument
+
+SITE = "Synthetic"
+YEAR = "2022"
+LABELS = ["Great Egret", "Wood Stork", "White Ibis", "Great Blue Heron", "Snowy Egret", "Roseate Spoonbill"]
+
+SCALES = {
+    "small": {
+        "n_dates": 4,
+        "n_nests": 200,
+        "raster_size": 2048
+    },
+    "medium": {
+        "n_dates": 8,
+        "n_nests": 2000,
+        "raster_size": 6144
+    },
+    "large": {
+        "n_dates": 16,
+        "n_nests": 10000,
+        "raster_size": 12288
+    },
+}
+
+# Tile zoom levels and processes used for the tiling stage
+TILE_ZOOMS = (17, 21)
+TILE_WORKERS = 4
+
+
+def write_synthetic_mosaic(path, size, crs, origin, pixel_size, alpha=False, nodata=255, seed=0):
+    """Write a mosaic whose valid data is a rotated flight footprint surrounded by nodata (255)
+
+    With alpha=True the mosaic is RGBA with the footprint in the alpha band,
+    like the delivered orthomosaics, otherwise it is RGB with a nodata value
+    like the projected mosaics.
+
+    The mosaic is written in blocks of rows so large sizes do not need to fit
+    in memory.
+    """
+    rng = np.random.default_rng(seed)
+    profile = {
+        "driver": "GTiff",
+        "width": size,
+        "height": size,
+        "count": 4 if alpha else 3,
+        "dtype": "uint8",
+        "crs": crs,
+        "transform": from_origin(origin[0], origin[1], pixel_size, pixel_size),
+        "nodata": None if alpha else nodata,
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "lzw",
+    }
+    angle = np.deg2rad(25)
+    center = size / 2
+    with rasterio.open(path, "w", **profile) as dst:
+        for row_off in range(0, size, 512):
+            height = min(512, size - row_off)
+            rows, cols = np.mgrid[row_off:row_off + height, 0:size]
+            # Footprint is a rotated rectangle covering about half the mosaic
+            u = (cols - center) * np.cos(angle) + (rows - center) * np.sin(angle)
+            v = -(cols - center) * np.sin(angle) + (rows - center) * np.cos(angle)
+            valid = (np.abs(u) < size * 0.42) & (np.abs(v) < size * 0.3)
+            texture = rng.integers(40, 200, size=(3, height, size), dtype=np.uint8)
+            data = np.where(valid, texture, nodata).astype("uint8")
+            if alpha:
+                data = np.concatenate([data, np.where(valid, 255, 0).astype("uint8")[None]])
+            dst.write(data, window=Window(0, row_off, size, height))
+    return path
+
+
+def write_synthetic_flights(directory, n_dates, n_nests, seed=0):
+    """Write one prediction file per flight date with nests re-detected across dates among scattered birds
+
+    Nests are fixed locations that are detected on about 70% of dates with a
+    few centimeters of jitter. Each date also has as many unmatched birds as
+    there are nests. Returns the prediction file paths.
+    """
+    rng = np.random.default_rng(seed)
+    extent = np.sqrt(n_nests) * 6
+    origin = np.array([536000.0, 2877000.0])
+    centers = origin + rng.uniform(0, extent, size=(n_nests, 2))
+    paths = []
+    for date in range(n_dates):
+        present = rng.random(n_nests) < 0.7
+        nest_xy = centers[present] + rng.normal(0, 0.1, size=(present.sum(), 2))
+        bird_xy = origin + rng.uniform(0, extent, size=(n_nests, 2))
+        xy = np.concatenate([nest_xy, bird_xy])
+        half = rng.uniform(0.3, 0.6, size=len(xy))
+        gdf = geopandas.GeoDataFrame(
+            {
+                "xmin": xy[:, 0] - half,
+                "ymin": xy[:, 1] - half,
+                "xmax": xy[:, 0] + half,
+                "ymax": xy[:, 1] + half,
+                "score": rng.uniform(0.1, 1.0, size=len(xy)),
+                "label": rng.choice(LABELS, size=len(xy)),
+            },
+            geometry=shapely.box(xy[:, 0] - half, xy[:, 1] - half, xy[:, 0] + half, xy[:, 1] + half),
+            crs="EPSG:32617")
+        path = os.path.join(directory, f"{SITE}_03_{date + 1:02d}_{YEAR}_projected.shp")
+        gdf.to_file(path)
+        paths.append(path)
+    return paths
+
+
+def prepare(workdir, scale):
+    """Generate the synthetic inputs for a scale"""
+    params = SCALES[scale]
+    os.makedirs(os.path.join(workdir, "flights"), exist_ok=True)
+    data = {"workdir": workdir, "scale": scale}
+    data["flights"] = write_synthetic_flights(os.path.join(workdir, "flights"), params["n_dates"], params["n_nests"])
+    # Roughly 1 cm pixels near the Everglades, as delivered, and 5 cm pixels in web mercator for tiling
+    data["orthomosaic"] = write_synthetic_mosaic(os.path.join(workdir, f"{SITE}_03_01_{YEAR}.tif"),
+                                                 params["raster_size"],
+                                                 "EPSG:4326", (-80.6, 26.0),
+                                                 1e-7,
+                                                 alpha=True)
+    data["webmercator"] = write_synthetic_mosaic(os.path.join(workdir, "webmercator.tif"), params["raster_size"],
+                                                 "EPSG:3857", (-8972000.0, 3000000.0), 0.05)
+    return data
+
+
+# Each stage loads its inputs and returns a function to time, which returns the number of items it processed
+def stage_project_raster(data):
+    import project_orthos
+
+    savedir = os.path.join(data["workdir"], "projected")
+
+    def run():
+        project_orthos.project_raster(data["orthomosaic"], YEAR, SITE, 32617, savedir)
+        return 1
+
+    return run
+
+
+def stage_combine_files(data):
+    import combine_birds_site_year
+
+    return lambda: len(combine_birds_site_year.combine_files(data["flights"], YEAR, SITE, 0.3, savedir=data["workdir"]))
+
+
+def stage_stream_combine_files(data):
+    import combine_birds_site_year
+
+    savedir = os.path.join(data["workdir"], "streamed")
+    os.makedirs(savedir, exist_ok=True)
+
+    def run():
+        combine_birds_site_year.stream_combine_files(data["flights"], YEAR, SITE, 0.3, savedir=savedir, workers=4)
+        return len(data["flights"])
+
+    return run
+
+
+def combined_path(data):
+    return os.path.join(data["workdir"], f"{SITE}_{YEAR}_combined.shp")
+
+
+def stage_compare_site(data):
+    import nest_detection
+
+    df = geopandas.read_file(combined_path(data))
+    return lambda: len(nest_detection.compare_site(df))
+
+
+def stage_detect_nests(data):
+    import nest_detection
+
+    savedir = os.path.join(data["workdir"], "nests")
+    os.makedirs(savedir, exist_ok=True)
+
+    def run():
+        nest_detection.detect_nests(combined_path(data), YEAR, SITE, savedir)
+        return 1
+
+    return run
+
+
+def stage_process_nests(data):
+    import process_nests
+
+    savedir = os.path.join(data["workdir"], "nests")
+    nest_file = os.path.join(savedir, f"{SITE}_{YEAR}_detected_nests.shp")
+
+    def run():
+        process_nests.process_nests(nest_file, YEAR, SITE, savedir)
+        return 1
+
+    return run
+
+
+def stage_combine_bird_predictions(data):
+    import combine_bird_predictions
+
+    partition_dir = os.path.join(data["workdir"], "published")
+    output_base = os.path.join(data["workdir"], "PredictedBirds")
+
+    def run():
+        names, _ = combine_bird_predictions.update_partitions([combined_path(data)], partition_dir)
+        combine_bird_predictions.assemble_partitions(names, partition_dir, output_base)
+        return len(names)
+
+    return run
+
+
+def stage_combine_nests(data):
+    import combine_nests
+
+    processed = os.path.join(data["workdir"], "nests", f"{SITE}_{YEAR}_processed_nests.shp")
+    return lambda: len(combine_nests.combine([processed]))
+
+
+def stage_create_mbtiles(data):
+    import tiler
+
+    output = os.path.join(data["workdir"], "webmercator.mbtiles")
+    return lambda: tiler.create_mbtiles(data["webmercator"], output, *TILE_ZOOMS, workers=TILE_WORKERS)["written"]
+
+
+# Stages in dependency order
+STAGES = {
+    "project_raster": stage_project_raster,
+    "combine_files": stage_combine_files,
+    "stream_combine_files": stage_stream_combine_files,
+    "compare_site": stage_compare_site,
+    "detect_nests": stage_detect_nests,
+    "process_nests": stage_process_nests,
+    "combine_bird_predictions": stage_combine_bird_predictions,
+    "combine_nests": stage_combine_nests,
+    "create_mbtiles": stage_create_mbtiles,
+}
+
+
+def run_stage(stage, data):
+    """Time a stage, run in its own process so peak memory is the stage's own"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        run = STAGES[stage](data)
+    except ImportError as e:
+        return {"status": "skipped", "reason": str(e)}
+    # Memory in use before the timed function runs, i.e. imports and loaded inputs
+    start_rss_mb = instrument.peak_rss_mb()
+    instrument.reset_peak_rss()
+    start_children = os.times()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    items = run()
+    seconds = time.perf_counter() - start
+    end_children = os.times()
+    cpu_seconds = time.process_time() - start_cpu + (end_children.children_user - start_children.children_user) + (
+        end_children.children_system - start_children.children_system)
+    return {
+        "status": "ok",
+        "seconds": seconds,
+        "cpu_seconds": cpu_seconds,
+        "peak_rss_mb": instrument.peak_rss_mb(),
+        "start_rss_mb": start_rss_mb,
+        "items": int(items) if items is not None else None,
+    }
+
+
+def run_benchmarks(scales, stages=None, workdir=None):
+    """Run the selected stages at each scale, returning results keyed by stage/scale"""
+    stages = stages or list(STAGES)
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        for scale in scales:
+            scale_dir = os.path.join(tmpdir, scale)
+            print(f"Generating {scale} inputs in {scale_dir}")
+            data = prepare(scale_dir, scale)
+            for stage in STAGES:
+                if stage not in stages:
+                    continue
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    try:
+                        result = executor.submit(run_stage, stage, data).result()
+                    except Exception as e:
+                        traceback.print_exc()
+                        result = {"status": "failed", "reason": repr(e)}
+                results[f"{stage}/{scale}"] = result
+                summary = f"{result['seconds']:.2f}s, {result['peak_rss_mb']:.0f} MB" if result[
+                    "status"] == "ok" else f"{result['status']}: {result['reason']}"
+                print(f"{stage}/{scale}: {summary}")
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.25, min_seconds=0.1):
+    """Find stages that are slower or use more memory than the baseline
+
+    A stage regresses when its time exceeds the baseline by more than
+    tolerance (as a fraction) and by more than min_seconds, or its peak memory
+    exceeds the baseline by more than tolerance. Returns a list of messages.
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None or result.get("status") != "ok" or base.get("status") != "ok":
+            continue
+        if result["seconds"] > base["seconds"] * (1 + tolerance) and result["seconds"] - base["seconds"] > min_seconds:
+            regressions.append(f"{key}: {result['seconds']:.2f}s vs {base['seconds']:.2f}s baseline")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{key}: {result['peak_rss_mb']:.0f} MB vs {base['peak_rss_mb']:.0f} MB baseline")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the workflow stages on synthetic data")
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=list(SCALES))
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), help="Stages to run (default all)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file to write results to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Write these results to the --baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed fractional slowdown or memory growth")
+    parser.add_argument("--workdir", help="Directory for the synthetic inputs (default the system temp directory)")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scales, args.stages, args.workdir)
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {args.output}")
+
+    if args.baseline and args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_results(results, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
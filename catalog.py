@@ -0,0 +1,83 @@
+"""Catalog of the orthomosaic flights used to build the workflow DAG
+
+Flights live at orthomosaics/{year}/{site}/{flight}.tif. The flight names in
+each site directory are cached with the directory's mtime, which changes
+whenever a file is added, removed or renamed, so later builds only list the
+directories that changed.
+"""
+import json
+import os
+import time
+from collections import namedtuple
+import manifest
+import tools
+
+# Directories modified this recently are listed again on the next scan, in case
+# another file lands within the filesystem's mtime resolution
+MTIME_MARGIN_NS = 2 * 10**9
+
+Flight = namedtuple("Flight", ["year", "site", "flight", "date", "event", "file_postscript"])
+
+
+def parse_flight(year, site, flight):
+    """Parse a flight name into a Flight record"""
+    event, file_postscript = tools.get_event(f"{flight}_projected")
+    return Flight(year, site, flight, tools.get_date(flight), event, file_postscript)
+
+
+def list_flights(site_dir):
+    return sorted(name[:-len(".tif")] for name in os.listdir(site_dir) if name.endswith(".tif"))
+
+
+def list_dirs(path):
+    return sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+
+
+def scan_flights(orthomosaic_dir, cache_path=None):
+    """Flight records for every orthomosaic, sorted by year, site and flight
+
+    With cache_path the listing of each year and site directory is stored with
+    its mtime and only directories whose mtime changed are listed again.
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    scan_time_ns = time.time_ns()
+    updated = {}
+
+    def listing(path, list_entries):
+        mtime_ns = os.stat(path).st_mtime_ns
+        if cache.get(path, {}).get("mtime_ns") == mtime_ns:
+            updated[path] = cache[path]
+        else:
+            # A listing of a recently modified directory is stored without an mtime so it is never reused
+            recent = scan_time_ns - mtime_ns < MTIME_MARGIN_NS
+            updated[path] = {"mtime_ns": None if recent else mtime_ns, "entries": list_entries(path)}
+        return updated[path]["entries"]
+
+    years = list_dirs(orthomosaic_dir)
+    for year in years:
+        year_dir = os.path.join(orthomosaic_dir, year)
+        for site in listing(year_dir, list_dirs):
+            listing(os.path.join(year_dir, site), list_flights)
+
+    if cache_path is not None and updated != cache:
+        manifest.write_json_atomic(updated, cache_path)
+
+    flights = []
+    for year in years:
+        year_dir = os.path.join(orthomosaic_dir, year)
+        for site in updated[year_dir]["entries"]:
+            for flight in updated[os.path.join(year_dir, site)]["entries"]:
+                flights.append(parse_flight(year, site, flight))
+    return flights
+
+
+def index_flights(flights):
+    """Group flights by (site, year, event)"""
+    index = {}
+    for flight in flights:
+        index.setdefault((flight.site, flight.year, flight.event), []).append(flight)
+    return index
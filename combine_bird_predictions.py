@@ -1,18 +1,23 @@
+import argparse
 import os
-import sys
 import shutil
 from zipfile import ZipFile, ZIP_DEFLATED
 import geopandas as gpd
 import pandas as pd
+import pyarrow.parquet as pq
+import instrument
+import manifest
 import tools
 
+COUNT_COLUMNS = ["Site", "Date", "label"]
+
 
 def combine(paths):
-    """Read multiple prediction shapefiles and concatenate into one GeoDataFrame."""
+    """Read multiple prediction files and concatenate into one GeoDataFrame."""
     gdfs = []
     target_crs = None
     for p in paths:
-        gdf = gpd.read_file(p)
+        gdf = tools.read_geodataframe(p)
         if target_crs is None:
             target_crs = gdf.crs
         elif gdf.crs != target_crs:
@@ -24,10 +29,88 @@ def combine(paths):
     return gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), crs=target_crs)
 
 
+def truncate_columns(df):
+    """Published as a Shapefile, so long column names are truncated to the 10 character limit"""
+    return df.rename(columns={col: col[:10] for col in df.columns if len(col) > 10})
+
+
+def count_birds(df):
+    return df.groupby(COUNT_COLUMNS).size().reset_index(name="count")
+
+
+def update_partitions(paths, partition_dir):
+    """Keep a publish-ready GeoParquet partition and bird counts for each site-year file
+
+    Partitions are named after their source file and only rebuilt when the
+    source's content digest differs from the one recorded in the partition
+    manifest. Partitions whose source is no longer an input are removed.
+    Returns the partition names in input order and the names that were rebuilt.
+    """
+    os.makedirs(partition_dir, exist_ok=True)
+    manifest_path = os.path.join(partition_dir, "partitions.json")
+    partitions = manifest.load_manifest(manifest_path)
+    digests = manifest.update_manifest(paths, os.path.join(partition_dir, "sources.json"))
+
+    names = []
+    rebuilt = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        names.append(name)
+        partition_path = os.path.join(partition_dir, f"{name}.parquet")
+        if partitions.get(name, {}).get("digest") == digests[path] and os.path.exists(partition_path):
+            continue
+        df = truncate_columns(tools.read_geodataframe(path))
+        tools.write_geodataframe(df, partition_path)
+        count_birds(df).to_csv(os.path.join(partition_dir, f"{name}_counts.csv"), index=False)
+        partitions[name] = {"source": path, "digest": digests[path]}
+        rebuilt.append(name)
+
+    for name in set(partitions) - set(names):
+        for path in (os.path.join(partition_dir, f"{name}.parquet"), os.path.join(partition_dir, f"{name}_counts.csv")):
+            if os.path.exists(path):
+                os.remove(path)
+        del partitions[name]
+
+    manifest.write_json_atomic(partitions, manifest_path)
+    print(f"Rebuilt {len(rebuilt)} of {len(names)} site-year partitions")
+    return names, rebuilt
+
+
+def assemble_partitions(names, partition_dir, output_shp_base):
+    """Write the published Shapefile and counts CSV one partition at a time"""
+    files = [os.path.join(partition_dir, f"{name}.parquet") for name in names]
+    # Columns from every partition in first-seen order, as pd.concat would give
+    columns = []
+    for path in files:
+        columns.extend(col for col in pq.read_schema(path).names if col not in columns)
+
+    target_crs = None
+    mode = "w"
+    for path in files:
+        gdf = gpd.read_parquet(path)
+        if target_crs is None:
+            target_crs = gdf.crs
+        elif gdf.crs != target_crs:
+            gdf = gdf.to_crs(target_crs)
+        if len(gdf) == 0 and mode == "a":
+            continue
+        tools.write_geodataframe(gdf.reindex(columns=columns), f"{output_shp_base}.shp", mode=mode)
+        mode = "a"
+
+    counts = pd.concat(
+        [pd.read_csv(os.path.join(partition_dir, f"{name}_counts.csv"), dtype={"Date": str}) for name in names],
+        ignore_index=True)
+    counts = counts.sort_values(COUNT_COLUMNS, ignore_index=True)
+    counts.to_csv(output_shp_base + ".csv", index=False)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python combine_bird_predictions.py <shp1> <shp2> ...")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Combine the site-year bird predictions into PredictedBirds.zip")
+    parser.add_argument("paths", nargs="+", help="Combined bird prediction files for each site-year")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Only rebuild the site-year partitions whose input changed and stream them to the output")
+    args = parser.parse_args()
 
     working_dir = tools.get_working_dir()
     output_path = os.path.join(working_dir, "everwatch-workflow", "App", "Zooniverse", "data")
@@ -36,23 +119,28 @@ if __name__ == "__main__":
     output_shp_base = os.path.join(output_path, "PredictedBirds")
     output_zip = output_shp_base + ".zip"
 
-    # Read and combine
-    predictions = sys.argv[1:]
-    df = combine(predictions)
-
-    try:
-        import pyogrio
-        df.to_file(f"{output_shp_base}.shp", driver="ESRI Shapefile", engine="pyogrio")
-    except ImportError:
-        df.to_file(f"{output_shp_base}.shp", driver="ESRI Shapefile", engine="fiona")
+    instrument.start_job("combine_predicted_birds")
+    predictions = args.paths
+    if args.incremental:
+        partition_dir = os.path.join(working_dir, "published", "PredictedBirds")
+        with instrument.step("partitions"):
+            names, rebuilt = update_partitions(predictions, partition_dir)
+            instrument.count("partitions_rebuilt", len(rebuilt))
+        with instrument.step("assemble"):
+            assemble_partitions(names, partition_dir, output_shp_base)
+    else:
+        # Read and combine
+        with instrument.step("combine"):
+            df = truncate_columns(combine(predictions))
+        with instrument.step("write"):
+            tools.write_geodataframe(df, f"{output_shp_base}.shp")
 
-    # Write summary CSV
-    grouped_df = df.groupby(["Site", "Date", "label"]).size().reset_index(name="count")
-    grouped_df.to_csv(output_shp_base + ".csv", index=False)
+            # Write summary CSV
+            count_birds(df).to_csv(output_shp_base + ".csv", index=False)
 
     # Zip shapefile components
     shp_exts = ["cpg", "dbf", "prj", "shp", "shx"]
-    with ZipFile(output_zip, "w", compression=ZIP_DEFLATED) as zf:
+    with instrument.step("zip"), ZipFile(output_zip, "w", compression=ZIP_DEFLATED) as zf:
         for ext in shp_exts:
             f = f"{output_shp_base}.{ext}"
             if os.path.exists(f):
@@ -72,4 +160,4 @@ if __name__ == "__main__":
         shutil.copy(output_zip, dest_file)
         print(f"{output_zip} copied to {dest_file}.")
     else:
-        print(f"{output_zip} file does not exist.")
\ No newline at end of file
+        print(f"{output_zip} file does not exist.")
@@ -1,78 +1,162 @@
+import argparse
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas
 import pandas as pd
 from shapely.errors import GEOSException
 
+import instrument
 import tools
 
 
-def combine_files(bird_detection_files, year, site, score_thresh, savedir):
-    """Load shapefiles and concat into large frame"""
-    # load all shapefiles to create a dataframe
-    df = []
-    for x in bird_detection_files:
-        try:
-            # Catch and skip badly structured file names
-            # TODO: fix file naming issues so we don't need this
-            try:
-                eventdf = geopandas.read_file(x)
-                # Fix any invalid geometries
-                if len(eventdf) > 0:
-                    invalid_mask = ~eventdf.geometry.is_valid
-                    if invalid_mask.any():
-                        eventdf.loc[invalid_mask, 'geometry'] = eventdf.loc[invalid_mask, 'geometry'].make_valid()
-            except (GEOSException, ValueError) as geom_error:
-                print(f"Warning: Could not read {x} due to geometry error, skipping...")
-                continue
+def read_flight(path, score_thresh):
+    """Read the birds above the score threshold from one flight's predictions
 
+    The threshold is applied before geometries are repaired, so only kept rows
+    are validated. Returns None for unreadable or empty files.
+    """
+    # Catch and skip badly structured file names
+    # TODO: fix file naming issues so we don't need this
+    try:
+        try:
+            eventdf = tools.read_geodataframe(path)
             # Skip empty files
             if len(eventdf) == 0:
-                continue
+                return None
+            eventdf = eventdf[eventdf.score > score_thresh].copy()
+            # Fix any invalid geometries
+            invalid_mask = ~eventdf.geometry.is_valid
+            if invalid_mask.any():
+                eventdf.loc[invalid_mask, 'geometry'] = eventdf.loc[invalid_mask, 'geometry'].make_valid()
+        except (GEOSException, ValueError) as geom_error:
+            print(f"Warning: Could not read {path} due to geometry error, skipping...")
+            return None
 
-            eventdf["Site"] = tools.get_site(x)
-            eventdf["Date"] = tools.get_date(x)
-            eventdf["Year"] = tools.get_year(x)
-            eventdf["event"], eventdf["file_postscript"] = tools.get_event(x)
-            eventdf = eventdf[eventdf.score > score_thresh]
-            df.append(eventdf)
-        except IndexError as e:
-            print("Filename issue:")
-            print(e)
-    if not df:
+        eventdf["Site"] = tools.get_site(path)
+        eventdf["Date"] = tools.get_date(path)
+        eventdf["Year"] = tools.get_year(path)
+        eventdf["event"], eventdf["file_postscript"] = tools.get_event(path)
+    except IndexError as e:
+        print("Filename issue:")
+        print(e)
         return None
-    df = geopandas.GeoDataFrame(pd.concat(df, ignore_index=True))
-    df = df.assign(bird_id=range(1, len(df) + 1))  # Index bird IDs starting at 1
+    return eventdf
+
+
+def shapefile_columns(df, output_format):
+    """Rename columns to comply with ESRI Shapefile 10-character limit
 
-    # Rename columns to comply with ESRI Shapefile 10-character limit
-    # This avoids warnings about truncation
+    This avoids warnings about truncation
+    """
     column_rename = {}
     for col in df.columns:
-        if len(col) > 10:
+        if output_format == "shp" and len(col) > 10:
             column_rename[col] = col[:10]
     if column_rename:
         df = df.rename(columns=column_rename)
+    return df
 
-    filename = os.path.join(savedir, f"{site}_{year}_combined.shp")
-    print(filename)
 
-    try:
-        import pyogrio
-        df.to_file(filename, driver="ESRI Shapefile", engine="pyogrio")
-    except ImportError:
-        df.to_file(filename, driver="ESRI Shapefile", engine="fiona")
+def combine_files(bird_detection_files, year, site, score_thresh, savedir, output_format="shp"):
+    """Load shapefiles and concat into large frame"""
+    # load all shapefiles to create a dataframe
+    # Flights are added in file name order so the birds from each date form a
+    # contiguous block, in date order, and bird ids stay stable as new flights arrive
+    df = []
+    with instrument.step("read"):
+        for x in sorted(bird_detection_files, key=os.path.basename):
+            eventdf = read_flight(x, score_thresh)
+            instrument.count("flights")
+            if eventdf is not None:
+                df.append(eventdf)
+                instrument.count("birds", len(eventdf))
+    if not df:
+        return None
+    df = geopandas.GeoDataFrame(pd.concat(df, ignore_index=True))
+    df = df.assign(bird_id=range(1, len(df) + 1))  # Index bird IDs starting at 1
+    df = shapefile_columns(df, output_format)
+
+    filename = os.path.join(savedir, f"{site}_{year}_combined.{output_format}")
+    print(filename)
+    with instrument.step("write"):
+        tools.write_geodataframe(df, filename)
 
     return df
 
 
+def read_flights(paths, score_thresh, workers):
+    """Read flights on a thread pool, yielding them in input order
+
+    At most 2 * workers flights are read ahead of the one being consumed, so
+    memory does not grow with the number of flights.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(read_flight, path, score_thresh))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def stream_combine_files(bird_detection_files, year, site, score_thresh, savedir, output_format="shp", workers=4):
+    """Combine flights like combine_files, writing each flight to the output as it is read
+
+    Gives the same file as combine_files, including bird_id numbering, but
+    only a few flights are in memory at once. Returns the output path or None
+    if there were no birds.
+    """
+
+    def batches():
+        next_id = 1
+        for eventdf in read_flights(sorted(bird_detection_files, key=os.path.basename), score_thresh, workers):
+            instrument.count("flights")
+            if eventdf is None or len(eventdf) == 0:
+                continue
+            instrument.count("birds", len(eventdf))
+            eventdf = eventdf.assign(bird_id=range(next_id, next_id + len(eventdf)))
+            next_id += len(eventdf)
+            yield shapefile_columns(eventdf.reset_index(drop=True), output_format)
+
+    filename = os.path.join(savedir, f"{site}_{year}_combined.{output_format}")
+    print(filename)
+    with instrument.step("stream"):
+        n_rows = tools.write_geodataframe_batches(batches(), filename)
+    if n_rows == 0:
+        return None
+    return filename
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Combine the bird predictions for a site-year")
+    parser.add_argument("paths", nargs="+", help="Bird prediction files for each flight")
+    parser.add_argument("--format", default="shp", choices=tools.INTERMEDIATE_FORMATS, help="Output file format")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=0,
+                        help="Read flights on this many threads and stream them to the output (0 reads them all first)")
+    args = parser.parse_args()
+
     score_thresh = 0.3
-    paths = sys.argv[1:]
+    paths = args.paths
     split_path = os.path.normpath(paths[0]).split(os.path.sep)
     year = split_path[5]
     site = split_path[6]
 
     working_dir = tools.get_working_dir()
     savedir = os.path.join(working_dir, "predictions", year, site)
-    combine_files(paths, year, site, score_thresh, savedir=savedir)
+    instrument.start_job("combine_birds_site_year", site=site, year=year)
+    if args.workers > 0:
+        stream_combine_files(paths,
+                             year,
+                             site,
+                             score_thresh,
+                             savedir=savedir,
+                             output_format=args.format,
+                             workers=args.workers)
+    else:
+        combine_files(paths, year, site, score_thresh, savedir=savedir, output_format=args.format)
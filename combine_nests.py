@@ -6,6 +6,7 @@ from zipfile import ZipFile
 
 import geopandas
 import pandas as pd
+import instrument
 import tools
 
 
@@ -16,7 +17,7 @@ def get_site(path):
 
 
 def load_shapefile(x):
-    shp = geopandas.read_file(x)
+    shp = tools.read_geodataframe(x)
     # Force correct datatypes
     # Empty shapefiles don't seem to maintain provided types when written and loaded
     shp = shp.astype({
@@ -56,17 +57,18 @@ if __name__ == "__main__":
     output_path = f"{working_dir}/everwatch-workflow/App/Zooniverse/data/"
 
     nest_files = sys.argv[1:]
+    instrument.start_job("combine_nests")
     # write output to zooniverse app
-    df = combine(nest_files)
+    with instrument.step("combine"):
+        df = combine(nest_files)
+        instrument.count("nests", len(df))
     filename = os.path.join(output_path, "nest_detections_processed.shp")
-    try:
-        import pyogrio
-        df.to_file(filename, driver="ESRI Shapefile", engine="pyogrio")
-    except ImportError:
-        df.to_file(filename, driver="ESRI Shapefile", engine="fiona")
+    with instrument.step("write"):
+        tools.write_geodataframe(df, filename)
 
     # Zip the shapefile for storage efficiency
-    with ZipFile(os.path.join(output_path, "nest_detections_processed.zip"), 'w', ZIP_DEFLATED) as zip:
+    with instrument.step("zip"), ZipFile(os.path.join(output_path, "nest_detections_processed.zip"), 'w',
+                                         ZIP_DEFLATED) as zip:
         for ext in ['cpg', 'dbf', 'prj', 'shp', 'shx']:
             focal_file = os.path.join(output_path, f"nest_detections_processed.{ext}")
             file_name = os.path.basename(focal_file)
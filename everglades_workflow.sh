@@ -19,6 +19,8 @@ source /etc/profile.d/modules.sh
 ml conda
 conda activate everwatch
 export PYTHONNOUSERSITE=1
+# Jobs write their performance metrics to logs/metrics/$EVERWATCH_RUN_ID
+export EVERWATCH_RUN_ID=$(date "+%Y%m%d_%H%M%S")
 cd /blue/ewhite/everglades/everwatch-workflow/
 
 snakemake --unlock
@@ -33,6 +35,9 @@ snakemake \
   --jobs 2 \
   --resources mem_mb=160000 gpu=1 project_mosaic_slot=1 predict_birds_slot=1
 
+echo "INFO [$(date "+%Y-%m-%d %H:%M:%S")] Performance report for run $EVERWATCH_RUN_ID"
+python instrument.py report
+
 echo ""
 echo "=============================="
 echo "INFO [$(date "+%Y-%m-%d %H:%M:%S")] End"
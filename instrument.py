@@ -0,0 +1,324 @@
+"""Per-job performance metrics and a report across a workflow run
+
+Entry scripts call start_job once with the Snakemake rule name and the
+site/year/flight they process, wrap sub-steps in step() and record item
+counts with count(). Wall time, CPU time, peak memory and bytes read and
+written are measured for the job and each step and written to a JSON sidecar
+when the process exits. step() and count() do nothing when no job was started,
+so library functions can be instrumented without affecting other callers.
+
+Sidecars go to $EVERWATCH_METRICS_DIR, or logs/metrics/$EVERWATCH_RUN_ID under
+the working directory. Summarize a run with
+
+    python instrument.py report /blue/ewhite/everglades/logs/metrics/<run id>
+"""
+import argparse
+import atexit
+import contextlib
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from datetime import datetime
+import tools
+
+# Rules a job depends on, used to find the critical path of a run
+RULE_DEPENDENCIES = {
+    "project_mosaics": [],
+    "predict_birds": ["project_mosaics"],
+    "create_mbtile": ["project_mosaics"],
+    "upload_mapbox": ["create_mbtile"],
+    "combine_birds_site_year": ["predict_birds"],
+    "combine_predicted_birds": ["combine_birds_site_year"],
+    "build_prediction_store": ["combine_birds_site_year"],
+    "detect_nests": ["combine_birds_site_year"],
+    "process_nests": ["detect_nests"],
+    "combine_nests": ["process_nests"],
+    "extract_nest_chips": ["process_nests", "project_mosaics"],
+}
+
+_job = None
+
+
+def metrics_dir():
+    if os.environ.get("EVERWATCH_METRICS_DIR"):
+        return os.environ["EVERWATCH_METRICS_DIR"]
+    run_id = os.environ.get("EVERWATCH_RUN_ID", "adhoc")
+    return os.path.join(tools.get_working_dir(), "logs", "metrics", run_id)
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB (VmHWM on Linux)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    """Reset the peak to the current resident memory, where the kernel supports it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def io_bytes():
+    """Bytes read and written by this process, including through the page cache"""
+    counters = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def snapshot():
+    times = os.times()
+    bytes_read, bytes_written = io_bytes()
+    return {
+        "wall": time.perf_counter(),
+        "cpu": times.user + times.system,
+        "children_cpu": times.children_user + times.children_system,
+        "bytes_read": bytes_read,
+        "bytes_written": bytes_written,
+    }
+
+
+def measure(start, end):
+    return {
+        "wall_seconds": end["wall"] - start["wall"],
+        "cpu_seconds": end["cpu"] - start["cpu"] + end["children_cpu"] - start["children_cpu"],
+        "bytes_read": end["bytes_read"] - start["bytes_read"],
+        "bytes_written": end["bytes_written"] - start["bytes_written"],
+    }
+
+
+def start_job(name, **labels):
+    """Start recording metrics for this process
+
+    name is the Snakemake rule and labels identify what the job processed
+    (site, year, flight, or flights for batched jobs). The sidecar is written
+    by finish_job, which runs automatically at exit.
+    """
+    global _job
+    _job = {
+        "job": name,
+        "labels": labels,
+        "host": platform.node(),
+        "pid": os.getpid(),
+        "argv": sys.argv,
+        "start": datetime.now().isoformat(timespec="seconds"),
+        "status": "ok",
+        "counts": {},
+        "steps": [],
+        "_start": snapshot(),
+        "_peak_rss_mb": 0.0,
+        "_open_steps": [],
+    }
+    previous_hook = sys.excepthook
+
+    def record_failure(exc_type, exc, tb):
+        if _job is not None:
+            _job["status"] = "failed"
+            _job["error"] = repr(exc)
+        previous_hook(exc_type, exc, tb)
+
+    sys.excepthook = record_failure
+    atexit.register(finish_job)
+
+
+@contextlib.contextmanager
+def step(name):
+    """Measure a sub-step of the current job; nested steps are named parent/child"""
+    if _job is None:
+        yield
+        return
+    open_steps = _job["_open_steps"]
+    # Resetting the peak loses the high-water mark of the job and the enclosing steps, so keep it first
+    peak = peak_rss_mb()
+    for running in [_job] + open_steps:
+        running["_peak_rss_mb"] = max(running["_peak_rss_mb"], peak)
+    reset_peak_rss()
+    record = {
+        "name": "/".join([parent["name"] for parent in open_steps[-1:]] + [name]),
+        "counts": {},
+        "_peak_rss_mb": 0.0
+    }
+    open_steps.append(record)
+    start = snapshot()
+    try:
+        yield
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record.update(measure(start, snapshot()))
+        record["peak_rss_mb"] = max(record.pop("_peak_rss_mb"), peak_rss_mb())
+        _job["_peak_rss_mb"] = max(_job["_peak_rss_mb"], record["peak_rss_mb"])
+        open_steps.pop()
+        _job["steps"].append(record)
+
+
+def count(name, n=1):
+    """Add n items (windows, boxes, candidate pairs, ...) to the job and the innermost open step"""
+    if _job is None:
+        return
+    for counts in [_job["counts"]] + [record["counts"] for record in _job["_open_steps"][-1:]]:
+        counts[name] = counts.get(name, 0) + int(n)
+
+
+def finish_job(status=None):
+    """Write the sidecar for the current job; later calls do nothing"""
+    global _job
+    if _job is None:
+        return None
+    job, _job = _job, None
+    if status is not None:
+        job["status"] = status
+    job.update(measure(job.pop("_start"), snapshot()))
+    job["end"] = datetime.now().isoformat(timespec="seconds")
+    job["peak_rss_mb"] = max(job.pop("_peak_rss_mb"), peak_rss_mb())
+    job["children_peak_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    job.pop("_open_steps")
+
+    directory = metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    label = "_".join(str(value) for key, value in sorted(job["labels"].items()) if not isinstance(value, list))
+    path = os.path.join(directory, f"{job['job']}_{label}_{job['pid']}.json".replace("__", "_"))
+    with open(path, "w") as f:
+        json.dump(job, f, indent=1)
+    return path
+
+
+def load_sidecars(directory):
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path) as f:
+            records.append(json.load(f))
+    return records
+
+
+def summarize(records, key):
+    """Total and peak metrics of records grouped by key(record)"""
+    groups = {}
+    for record in records:
+        group = groups.setdefault(
+            key(record), {
+                "jobs": 0,
+                "failed": 0,
+                "wall_hours": 0.0,
+                "max_wall_hours": 0.0,
+                "cpu_hours": 0.0,
+                "peak_rss_gb": 0.0,
+                "read_gb": 0.0,
+                "written_gb": 0.0
+            })
+        group["jobs"] += 1
+        group["failed"] += record.get("status") == "failed"
+        group["wall_hours"] += record["wall_seconds"] / 3600
+        group["max_wall_hours"] = max(group["max_wall_hours"], record["wall_seconds"] / 3600)
+        group["cpu_hours"] += record["cpu_seconds"] / 3600
+        group["peak_rss_gb"] = max(group["peak_rss_gb"], record.get("peak_rss_mb", 0) / 1024)
+        group["read_gb"] += record["bytes_read"] / 1024**3
+        group["written_gb"] += record["bytes_written"] / 1024**3
+    return dict(sorted(groups.items(), key=lambda item: -item[1]["wall_hours"]))
+
+
+def depends_on(job, upstream):
+    """Whether upstream produced an input of job, judged by rule and shared site/year/flight labels"""
+    if upstream["job"] not in RULE_DEPENDENCIES.get(job["job"], []):
+        return False
+    labels, upstream_labels = job["labels"], upstream["labels"]
+    if "flights" in labels and "flight" in upstream_labels:
+        return upstream_labels["flight"] in labels["flights"]
+    if "flights" in upstream_labels and "flight" in labels:
+        return labels["flight"] in upstream_labels["flights"]
+    return all(labels[key] == upstream_labels[key]
+               for key in ("site", "year", "flight")
+               if key in labels and key in upstream_labels)
+
+
+def critical_path(records):
+    """Chain of dependent jobs with the largest total wall time
+
+    Returns the jobs on the chain, from first to last, and its total wall time
+    in seconds.
+    """
+    order = list(RULE_DEPENDENCIES)
+    jobs = sorted((record for record in records if record["job"] in RULE_DEPENDENCIES),
+                  key=lambda record: order.index(record["job"]))
+    finish = []
+    previous = []
+    for i, job in enumerate(jobs):
+        upstream = [j for j in range(i) if depends_on(job, jobs[j])]
+        best = max(upstream, key=lambda j: finish[j], default=None)
+        finish.append(job["wall_seconds"] + (finish[best] if best is not None else 0))
+        previous.append(best)
+    if not jobs:
+        return [], 0.0
+    last = max(range(len(jobs)), key=lambda i: finish[i])
+    total = finish[last]
+    path = []
+    while last is not None:
+        path.append(jobs[last])
+        last = previous[last]
+    return path[::-1], total
+
+
+def format_table(groups, title):
+    columns = ["jobs", "failed", "wall_hours", "max_wall_hours", "cpu_hours", "peak_rss_gb", "read_gb", "written_gb"]
+    width = max([len(title)] + [len(str(name)) for name in groups])
+    lines = [f"{title:<{width}}  " + "  ".join(columns)]
+    for name, group in groups.items():
+        values = [
+            f"{group[column]:>{len(column)}.2f}"
+            if isinstance(group[column], float) else f"{group[column]:>{len(column)}}" for column in columns
+        ]
+        lines.append(f"{str(name):<{width}}  " + "  ".join(values))
+    return "\n".join(lines)
+
+
+def job_label(record):
+    labels = record["labels"]
+    if "flights" in labels:
+        return f"{record['job']} ({len(labels['flights'])} flights)"
+    return " ".join([record["job"]] + [str(labels[key]) for key in ("site", "year", "flight") if key in labels])
+
+
+def report(directory):
+    """Per-rule, per-site and per-step tables and the critical path of the jobs recorded in directory"""
+    records = load_sidecars(directory)
+    if not records:
+        return f"No metrics found in {directory}"
+    sections = [
+        format_table(summarize(records, lambda record: record["job"]), "rule"),
+        format_table(summarize(records, lambda record: record["labels"].get("site", "(all sites)")), "site"),
+    ]
+    steps = [{**step_record, "job": record["job"]} for record in records for step_record in record.get("steps", [])]
+    if steps:
+        sections.append(format_table(summarize(steps, lambda record: f"{record['job']}:{record['name']}"), "step"))
+    path, total = critical_path(records)
+    lines = [f"Critical path ({total / 3600:.2f} hours)"]
+    lines.extend(f"  {record['wall_seconds'] / 3600:8.2f}h  {job_label(record)}" for record in path)
+    sections.append("\n".join(lines))
+    return "\n\n".join(sections)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the metrics recorded during a workflow run")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("directory", nargs="?", default=None, help="Metrics directory (default this run's)")
+    args = parser.parse_args()
+    print(report(args.directory or metrics_dir()))
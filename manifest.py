@@ -0,0 +1,178 @@
+"""Content digests of orthomosaics and versions of derived products
+
+The Snakefile uses the stamp files written here as inputs instead of relying
+on orthomosaic modification times. A stamp is only rewritten when its content
+changes, so a sync that touches a file without changing its pixels does not
+trigger reprojection, prediction or tiling.
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Bytes read per chunk when hashing, so large mosaics are never held in memory
+CHUNK_SIZE = 16 * 1024 * 1024
+# Shapefile components besides the .shp that hold attributes, the index, the CRS and the encoding
+SHAPEFILE_COMPONENTS = (".shx", ".dbf", ".prj", ".cpg")
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """sha256 of a file, read in fixed size chunks"""
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            n_bytes = f.readinto(buffer)
+            if not n_bytes:
+                break
+            digest.update(view[:n_bytes])
+    return digest.hexdigest()
+
+
+def dataset_files(path):
+    """Files holding a dataset: every component of a Shapefile, otherwise just path"""
+    base, extension = os.path.splitext(path)
+    if extension.lower() != ".shp":
+        return [path]
+    return [path] + [base + component for component in SHAPEFILE_COMPONENTS if os.path.exists(base + component)]
+
+
+def dataset_digest(path, chunk_size=CHUNK_SIZE):
+    """sha256 of a file, or for a Shapefile of all its components, so attribute-only changes are seen"""
+    files = dataset_files(path)
+    if len(files) == 1:
+        return file_digest(path, chunk_size)
+    digest = hashlib.sha256()
+    for component in files:
+        digest.update(os.path.splitext(component)[1].encode())
+        digest.update(file_digest(component, chunk_size).encode())
+    return digest.hexdigest()
+
+
+def component_stats(path):
+    """Size and mtime of the other components of a Shapefile, None for single file datasets"""
+    files = dataset_files(path)[1:]
+    if not files:
+        return None
+    return {
+        os.path.basename(component): [os.stat(component).st_size,
+                                      os.stat(component).st_mtime_ns] for component in files
+    }
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_json_atomic(data, path, mode=None):
+    """Write json to a temporary file and move it into place so readers never see a partial file
+
+    With mode, e.g. 0o600, the temporary file is created with those
+    permissions, so the data is never readable with the default umask.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    if mode is None:
+        f = open(tmp_path, "w")
+    else:
+        # A leftover temporary file would keep its permissions, so it is always created afresh
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        f = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode), "w")
+    with f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def update_manifest(paths, manifest_path, workers=4):
+    """Record the content digest of each path
+
+    A Shapefile's digest covers all of its components. Digests are only
+    recomputed for files whose size or modification time, or that of one of
+    their components, differs from the manifest entry. Returns the digest of
+    each path.
+    """
+    manifest = load_manifest(manifest_path)
+    stats = {path: os.stat(path) for path in paths}
+    components = {path: component_stats(path) for path in paths}
+    stale = [
+        path for path, stat in stats.items()
+        if manifest.get(path, {}).get("size") != stat.st_size or manifest.get(path, {}).get("mtime_ns") !=
+        stat.st_mtime_ns or manifest.get(path, {}).get("components") != components[path]
+    ]
+    if stale:
+        print(f"Hashing {len(stale)} of {len(paths)} files")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, digest in zip(stale, executor.map(dataset_digest, stale)):
+                manifest[path] = {"size": stats[path].st_size, "mtime_ns": stats[path].st_mtime_ns, "digest": digest}
+                if components[path] is not None:
+                    manifest[path]["components"] = components[path]
+        write_json_atomic(manifest, manifest_path)
+    return {path: manifest[path]["digest"] for path in paths}
+
+
+def write_stamp(path, content, mtime=None):
+    """Write content to a stamp file, leaving the file (and its mtime) alone if the content is unchanged
+
+    A stamp that did not exist yet is given mtime, so creating it does not
+    make the products that already depend on it out of date.
+    """
+    created = not os.path.exists(path)
+    if not created:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    if created and mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return True
+
+
+def orthomosaic_stamp(path, working_dir):
+    """Stamp path of an orthomosaic, mirroring the orthomosaic layout under manifest/orthomosaics"""
+    relative_path = os.path.splitext(os.path.relpath(path, os.path.join(working_dir, "orthomosaics")))[0]
+    return os.path.join(working_dir, "manifest", "orthomosaics", f"{relative_path}.sha256")
+
+
+def stamp_orthomosaics(paths, working_dir, workers=4):
+    """Write a digest stamp for each orthomosaic
+
+    A new stamp takes the mtime of its orthomosaic, so products made from
+    the orthomosaic stay current. Returns the stamp path of each orthomosaic.
+    """
+    digests = update_manifest(paths, os.path.join(working_dir, "manifest", "orthomosaics.json"), workers=workers)
+    stamps = {}
+    for path, digest in digests.items():
+        stamps[path] = orthomosaic_stamp(path, working_dir)
+        write_stamp(stamps[path], digest, mtime=os.path.getmtime(path))
+    return stamps
+
+
+def stamp_version(product, working_dir, version):
+    """Write the version stamp of a derived product and return its path
+
+    version is set explicitly, e.g. the model version for predictions, and
+    products are rerun only when it changes. A new stamp is dated to the
+    epoch so it does not rerun the products that already exist.
+    """
+    stamp = os.path.join(working_dir, "manifest", "versions", f"{product}.txt")
+    write_stamp(stamp, str(version), mtime=0)
+    return stamp
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write content digest stamps of orthomosaics")
+    parser.add_argument("paths", nargs="+", help="Orthomosaics")
+    parser.add_argument("--working-dir", required=True, help="Directory holding orthomosaics/ and manifest/")
+    parser.add_argument("--workers", type=int, default=4, help="Threads hashing orthomosaics")
+    args = parser.parse_args()
+
+    stamps = stamp_orthomosaics(args.paths, args.working_dir, workers=args.workers)
+    print(f"Stamped {len(stamps)} orthomosaics")
@@ -1,14 +1,24 @@
+import argparse
 import os
 import shlex
+import shutil
 import sys
 import subprocess
+import instrument
+import tiler
 import tools
 
 import rasterio as rio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 
 
-def create_mbtile(path, year, site, force_upload=False):
+def create_mbtile(path, year, site, force_upload=False, native=True, workers=4, incremental=False):
+    """Tile a webmercator mosaic into mapbox/{year}/{site}/{flight}.mbtiles
+
+    native=True renders tiles in-process with tiler.py, otherwise rio mbtiles
+    is used. With incremental=True the native tiler updates a cached copy in
+    mapbox/cache so only tiles whose source pixels changed are re-encoded.
+    """
     basename = os.path.splitext(os.path.basename(path))[0]
     flight = basename.replace("_projected", "")
 
@@ -22,10 +32,28 @@ def create_mbtile(path, year, site, force_upload=False):
         os.remove(mbtiles_filename)
 
     print("Creating mbtiles file")
-    rio_command = f"rio mbtiles {path} -o {mbtiles_filename} --zoom-levels 17..24 -j 4 -f PNG"
+    if native:
+        if incremental:
+            # Snakemake removes the rule output before running, so the tiles to update are kept in a cache
+            cache_dir = os.path.join(working_dir, "mapbox", "cache", year, site)
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_filename = os.path.join(cache_dir, f"{flight}.mbtiles")
+            with instrument.step("tile"):
+                counts = tiler.create_mbtiles(path, cache_filename, workers=workers, incremental=True)
+            with instrument.step("copy"):
+                shutil.copyfile(cache_filename, mbtiles_filename)
+        else:
+            with instrument.step("tile"):
+                counts = tiler.create_mbtiles(path, mbtiles_filename, workers=workers)
+        for name, n_tiles in counts.items():
+            instrument.count(f"tiles_{name}", n_tiles)
+        return mbtiles_filename
+
+    rio_command = f"rio mbtiles {path} -o {mbtiles_filename} --zoom-levels 17..24 -j {workers} -f PNG"
 
     rio_command_list = shlex.split(rio_command)
-    return_code = subprocess.call(rio_command_list)
+    with instrument.step("rio_mbtiles"):
+        return_code = subprocess.call(rio_command_list)
 
     # Check the return code to see if the command was successful
     if return_code != 0:
@@ -40,10 +68,26 @@ def create_mbtile(path, year, site, force_upload=False):
 
 
 if __name__ == "__main__":
-    path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Create an mbtiles file from a webmercator mosaic")
+    parser.add_argument("path", help="Path to the webmercator projected mosaic")
+    parser.add_argument("--workers", type=int, default=4, help="Number of tile rendering processes")
+    parser.add_argument("--rio", action="store_true", help="Tile with rio mbtiles instead of the native tiler")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Only re-encode tiles whose source pixels changed since the last run")
+    # Extra arguments (e.g. the mapbox-param config value) are ignored
+    args, _ = parser.parse_known_args()
+    path = args.path
     split_path = os.path.normpath(path).split(os.path.sep)
     year, site = split_path[6], split_path[7]
     force_upload = True
+    instrument.start_job("create_mbtile", **tools.flight_labels(path))
 
     # Create mbtiles
-    file_path = create_mbtile(path, year, site, force_upload=force_upload)
+    file_path = create_mbtile(path,
+                              year,
+                              site,
+                              force_upload=force_upload,
+                              native=not args.rio,
+                              workers=args.workers,
+                              incremental=args.incremental)
@@ -0,0 +1,267 @@
+"""Image chips of detected nests for review
+
+For every nest in a site-year's processed nests, a PNG chip is cut around the
+box detected on each date the nest was seen, from the projected mosaic of
+that date's flight. Chips are grouped by flight, so each mosaic is opened
+once and its chips are read in block order. Chips larger than max_size pixels
+are read at a lower resolution, which GDAL serves from the mosaic's overviews
+when it has them. PNGs are encoded by a pool of worker processes.
+
+chips.json records the mosaic and bounds each chip was cut from, so a chip
+is only written again when its nest's box changed, e.g. after the nest ids
+were reassigned. Chips and nest directories that are no longer wanted are
+removed, so a season is a single pass over each mosaic.
+
+    python nest_chips.py processed_nests/2022/Joule/Joule_2022_processed_nests.shp \
+        detected_nests/2022/Joule/Joule_2022_detected_nests.shp
+"""
+import argparse
+import multiprocessing
+import os
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import instrument
+import manifest
+import tools
+
+# Meters added on each side of a detected box
+CHIP_BUFFER = 3
+# Largest side of a chip in pixels, larger chips are downsampled
+CHIP_MAX_SIZE = 512
+
+
+def chip_path(savedir, nest_id, site, date):
+    return os.path.join(savedir, str(nest_id), f"{nest_id}_{site}_{date}.png")
+
+
+def plan_chips(processed, detected, savedir, buffer=CHIP_BUFFER, max_size=CHIP_MAX_SIZE):
+    """One row per chip wanted, with its nest, date, mosaic, bounds, path and key
+
+    Detections of nests that were not kept by process_nests are left out and
+    a nest detected more than once on a date gets the chip of its best
+    scoring box. The key records the mosaic, bounds and size of the chip.
+    """
+    detected = detected[detected["target_ind"].astype("int64").isin(processed["nest_id"].astype("int64"))]
+    detected = detected.sort_values("score", ascending=False, kind="stable")
+    detected = detected.drop_duplicates(["target_ind", "Date"])
+    bounds = detected.geometry.bounds
+    # Older predictions do not record the mosaic they came from
+    fallback = detected["Site"].astype(str) + "_" + detected["Date"].astype(str) + "_projected.tif"
+    if "image_path" in detected.columns:
+        mosaic = detected["image_path"].where(detected["image_path"].notna() & (detected["image_path"] != ""), fallback)
+    else:
+        mosaic = fallback
+    chips = pd.DataFrame({
+        "nest_id": detected["target_ind"].astype("int64").to_numpy(),
+        "Date": detected["Date"].astype(str).to_numpy(),
+        "mosaic": mosaic.astype(str).to_numpy(),
+        "minx": (bounds.minx - buffer).to_numpy(),
+        "miny": (bounds.miny - buffer).to_numpy(),
+        "maxx": (bounds.maxx + buffer).to_numpy(),
+        "maxy": (bounds.maxy + buffer).to_numpy(),
+    })
+    chips["path"] = [
+        chip_path(savedir, nest_id, site, date)
+        for nest_id, site, date in zip(chips["nest_id"], detected["Site"].astype(str), chips["Date"])
+    ]
+    chips["key"] = [
+        f"{mosaic} {minx:.3f} {miny:.3f} {maxx:.3f} {maxy:.3f} {max_size}"
+        for mosaic, minx, miny, maxx, maxy in chips[["mosaic", "minx", "miny", "maxx", "maxy"]].itertuples(index=False)
+    ]
+    return chips.sort_values(["mosaic", "nest_id", "Date"]).reset_index(drop=True)
+
+
+def stale_chips(chips, savedir, index):
+    """Chips whose file is missing or was cut from another box, e.g. after nest ids were reassigned
+
+    index maps the path of each chip, relative to savedir, to its key when
+    it was written.
+    """
+    current = [
+        os.path.exists(path) and index.get(os.path.relpath(path, savedir)) == key
+        for path, key in zip(chips["path"], chips["key"])
+    ]
+    return chips[~np.array(current, dtype=bool)].reset_index(drop=True)
+
+
+def prune_chips(chips, savedir, index):
+    """Remove chips that are no longer wanted, and the directories of nests that were not kept
+
+    Returns the number of chip files removed.
+    """
+    wanted = set(chips["path"])
+    nest_dirs = {str(nest_id) for nest_id in chips["nest_id"]}
+    removed = 0
+    for name in os.listdir(savedir) if os.path.isdir(savedir) else []:
+        nest_dir = os.path.join(savedir, name)
+        if not os.path.isdir(nest_dir) or not name.isdigit():
+            continue
+        for filename in os.listdir(nest_dir):
+            path = os.path.join(nest_dir, filename)
+            if path not in wanted:
+                os.remove(path)
+                index.pop(os.path.relpath(path, savedir), None)
+                removed += filename.endswith(".png")
+        if name not in nest_dirs:
+            os.rmdir(nest_dir)
+    return removed
+
+
+def chip_windows(src, chips):
+    """Pixel window of each chip, clipped to the mosaic, in the block order of the mosaic
+
+    Returns (chip position, window) pairs; chips outside the mosaic are left out.
+    """
+    from rasterio.errors import WindowError
+    from rasterio.windows import Window, from_bounds
+
+    full = Window(0, 0, src.width, src.height)
+    block_height, block_width = src.block_shapes[0]
+    windows = []
+    for i, (minx, miny, maxx, maxy) in enumerate(chips[["minx", "miny", "maxx", "maxy"]].to_numpy()):
+        window = from_bounds(minx, miny, maxx, maxy, transform=src.transform).round_offsets().round_lengths()
+        try:
+            window = window.intersection(full)
+        except WindowError:
+            continue
+        if window.width > 0 and window.height > 0:
+            windows.append((i, window))
+    return sorted(windows,
+                  key=lambda item:
+                  (item[1].row_off // block_height, item[1].col_off // block_width, item[1].row_off, item[1].col_off))
+
+
+def chip_shape(window, max_size=CHIP_MAX_SIZE):
+    """Height and width a chip is read at, keeping its aspect ratio within max_size pixels"""
+    height, width = int(window.height), int(window.width)
+    if max_size is None or max(height, width) <= max_size:
+        return height, width
+    scale = max_size / max(height, width)
+    return max(1, round(height * scale)), max(1, round(width * scale))
+
+
+def read_chips(mosaic_path, chips, max_size=CHIP_MAX_SIZE):
+    """Open a mosaic once and yield (chip position, RGB array) for each of its chips in block order"""
+    import rasterio
+    from rasterio.enums import Resampling
+
+    with rasterio.open(mosaic_path) as src:
+        for i, window in chip_windows(src, chips):
+            height, width = chip_shape(window, max_size)
+            yield i, src.read(indexes=[1, 2, 3],
+                              window=window,
+                              out_shape=(3, height, width),
+                              resampling=Resampling.average)
+
+
+def write_png(path, image):
+    """Encode a (bands, height, width) uint8 array as a PNG, replacing path only once it is complete"""
+    import rasterio
+    from rasterio.errors import NotGeoreferencedWarning
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with rasterio.open(tmp_path,
+                           "w",
+                           driver="PNG",
+                           width=image.shape[2],
+                           height=image.shape[1],
+                           count=image.shape[0],
+                           dtype="uint8") as dst:
+            dst.write(np.asarray(image, dtype="uint8"))
+    os.replace(tmp_path, path)
+    return path
+
+
+def extract_chips(processed_file,
+                  detected_file,
+                  mosaic_dir,
+                  savedir,
+                  buffer=CHIP_BUFFER,
+                  max_size=CHIP_MAX_SIZE,
+                  workers=4):
+    """Write a PNG chip for each date each processed nest was detected on
+
+    Mosaics are looked up in mosaic_dir by the image_path of each detection.
+    workers processes encode PNGs while mosaics are read, 0 encodes them in
+    this process. Returns the paths of the chips that were written.
+    """
+    index_path = os.path.join(savedir, "chips.json")
+    with instrument.step("plan"):
+        processed = tools.read_geodataframe(processed_file, columns=["nest_id"])
+        detected = tools.read_geodataframe(detected_file)
+        chips = plan_chips(processed, detected, savedir, buffer, max_size)
+        index = manifest.load_manifest(index_path)
+        instrument.count("chips_removed", prune_chips(chips, savedir, index))
+        keys = dict(zip(chips["path"], chips["key"]))
+        chips = stale_chips(chips, savedir, index)
+        # A chip of another box must not stay in place if its mosaic cannot be read this time
+        for path in chips["path"]:
+            if os.path.exists(path):
+                os.remove(path)
+            index.pop(os.path.relpath(path, savedir), None)
+        instrument.count("chips_planned", len(chips))
+    print(f"{len(chips)} nest chips to write from {chips['mosaic'].nunique()} mosaics")
+
+    written = []
+    executor = None
+    if workers > 0 and len(chips):
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    pending = set()
+    try:
+        for mosaic, flight_chips in chips.groupby("mosaic", sort=True):
+            mosaic_path = os.path.join(mosaic_dir, mosaic)
+            if not os.path.exists(mosaic_path):
+                print(f"Skipping {len(flight_chips)} chips, {mosaic_path} does not exist")
+                instrument.count("chips_missing_mosaic", len(flight_chips))
+                continue
+            flight_chips = flight_chips.reset_index(drop=True)
+            with instrument.step("read"):
+                for i, image in read_chips(mosaic_path, flight_chips, max_size):
+                    path = flight_chips["path"].iloc[i]
+                    if executor is None:
+                        written.append(write_png(path, image))
+                        continue
+                    # Bound the chips held in memory while they wait to be encoded
+                    if len(pending) >= 4 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        written.extend(future.result() for future in done)
+                    pending.add(executor.submit(write_png, path, image))
+                instrument.count("mosaics")
+        written.extend(future.result() for future in wait(pending).done)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        # Record the chips written so far, so an interrupted run does not write them again
+        index.update({os.path.relpath(path, savedir): keys[path] for path in written})
+        manifest.write_json_atomic(index, index_path)
+    instrument.count("chips", len(written))
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write review image chips of the processed nests of a site-year")
+    parser.add_argument("processed", help="Processed nests for a site-year")
+    parser.add_argument("detected", help="Detected nests for the same site-year")
+    parser.add_argument("--workers", type=int, default=4, help="Processes encoding PNGs, 0 encodes in this process")
+    parser.add_argument("--buffer", type=float, default=CHIP_BUFFER, help="Meters around each detected box")
+    parser.add_argument("--max-size", type=int, default=CHIP_MAX_SIZE, help="Largest chip side in pixels")
+    args = parser.parse_args()
+
+    working_dir = tools.get_working_dir()
+    split_path = os.path.normpath(args.processed).split(os.path.sep)
+    year = split_path[5]
+    site = split_path[6]
+    instrument.start_job("extract_nest_chips", site=site, year=year)
+    extract_chips(args.processed,
+                  args.detected,
+                  mosaic_dir=os.path.join(working_dir, "projected_mosaics", year, site),
+                  savedir=os.path.join(working_dir, "nest_chips", year, site),
+                  buffer=args.buffer,
+                  max_size=args.max_size,
+                  workers=args.workers)
@@ -1,100 +1,320 @@
 # Bird Bird Bird Detector
 # Given a set of predictions in /orange/ewhite/everglades/predictions/, generate predicted nests
+import argparse
+import hashlib
+import json
 import os
+import shutil
 import sys
 import glob
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import geopandas
+import shapely
 
+import instrument
 import tools
 
 
 def calculate_IoUs(geom, match):
-    """Calculate intersection-over-union scores for a pair of boxes"""
-    intersection = geom.intersection(match).area
-    union = geom.union(match).area
-    iou = intersection / float(union)
+    """Calculate intersection-over-union scores for a pair of boxes
+
+    Works on single geometries or on aligned arrays of geometries.
+    """
+    intersection = shapely.area(shapely.intersection(geom, match))
+    union = shapely.area(shapely.union(geom, match))
+    iou = intersection / union
     return iou
 
 
-def compare_site(gdf):
-    """Iterate over a dataframe and check rows"""
-    results = []
-    claimed_indices = []
-    spatial_index = gdf.sindex
+EMPTY_MATCH_COLUMNS = [
+    'match_xmin', 'match_ymin', 'match_xmax', 'match_ymax', 'label', 'score', 'image_path', 'Site', 'Date', 'Year',
+    'event', 'file_posts', 'bird_id', 'target_ind'
+]
 
-    for index, row in gdf.iterrows():
-        if index in claimed_indices:
-            continue
-        claimed_indices.append(index)
-        geom = row["geometry"]
-
-        possible_matches_index = list(spatial_index.intersection(geom.bounds))
-        possible_matches = gdf.iloc[possible_matches_index]
-
-        # Remove matches to the current date, which are nearby birds not the same bird on a different date
-        possible_matches = possible_matches.loc[possible_matches["Date"] != row.Date]
-
-        # Check for multiple matches from the same date and pick best match
-        match_date_count = possible_matches.groupby("Date").Date.agg("count")
-        multiple_match_dates = match_date_count[match_date_count > 1]
-
-        if not multiple_match_dates.empty:
-            for date in multiple_match_dates.index:
-                mm = possible_matches[possible_matches["Date"] == date].copy()
-                mm = mm.assign(iou=mm["geometry"].map(lambda x: calculate_IoUs(x, geom)))
-                best_match = mm.loc[mm["iou"] == mm["iou"].max()].drop(columns="iou")
-                possible_matches = possible_matches.drop(possible_matches[possible_matches["Date"] == date].index)
-                possible_matches = geopandas.GeoDataFrame(pd.concat([possible_matches, best_match], ignore_index=True),
-                                                          crs=gdf.crs)
-
-        # remove matches already claimed
-        matches = possible_matches[~(possible_matches.index.isin(claimed_indices))]
-        if matches.empty:
+MATCH_RENAME = {
+    "xmin": "match_xmin",
+    "xmax": "match_xmax",
+    "ymin": "match_ymin",
+    "ymax": "match_ymax",
+}
+
+
+def best_matches(target_geoms, target_dates, match_geoms, match_dates):
+    """Find the best candidate match on every other date for each target box
+
+    Returns two aligned arrays of positions (target, match) sorted by target
+    and then match. Candidates are boxes from other dates that intersect the
+    target box. When a date has more than one candidate only the candidates
+    with the highest IoU with the target are kept.
+    """
+    target, match = shapely.STRtree(match_geoms).query(target_geoms)
+    dates, uniques = pd.factorize(np.concatenate([target_dates, match_dates]))
+    target_dates = dates[:len(target_dates)]
+    match_dates = dates[len(target_dates):]
+
+    # Remove matches to the current date, which are nearby birds not the same bird on a different date
+    other_date = target_dates[target] != match_dates[match]
+    target = target[other_date]
+    match = match[other_date]
+    instrument.count("candidate_pairs", len(target))
+
+    # Check for multiple matches from the same date and pick best match
+    pairs = pd.DataFrame({"target": target, "date": match_dates[match]})
+    date_count = pairs.groupby(["target", "date"])["date"].transform("size").to_numpy()
+    multiple = date_count > 1
+    if multiple.any():
+        iou = np.full(len(pairs), np.nan)
+        iou[multiple] = calculate_IoUs(target_geoms[target[multiple]], match_geoms[match[multiple]])
+        pairs["iou"] = iou
+        best_iou = pairs.groupby(["target", "date"])["iou"].transform("max").to_numpy()
+        keep = ~multiple | (iou == best_iou)
+        target = target[keep]
+        match = match[keep]
+
+    order = np.lexsort((match, target))
+    return target[order], match[order]
+
+
+def candidate_matches(gdf):
+    """Find the best candidate match on every other date for every bird in gdf"""
+    geoms = np.asarray(gdf.geometry.values)
+    dates = gdf["Date"].to_numpy()
+    return best_matches(geoms, dates, geoms, dates)
+
+
+def assign_targets(gdf):
+    """Assign every bird the index of the target bird it was matched to
+
+    Birds are visited in index order. Each unclaimed bird claims itself and its
+    unclaimed best matches on other dates. Birds that are not matched to
+    anything are their own target.
+    """
+    target, match = candidate_matches(gdf)
+    return gdf.index.to_numpy()[claim_targets(len(gdf), target, match)]
+
+
+def claim_targets(n, target, match):
+    """Position of the target each of n birds is claimed by, from candidate pairs sorted by target"""
+    offsets = np.searchsorted(target, np.arange(n + 1))
+
+    # Claiming is greedy in index order so it is resolved sequentially, but only
+    # over the precomputed candidate arrays
+    claimed = np.zeros(n, dtype=bool)
+    targets = np.arange(n)
+    for i in range(n):
+        if claimed[i]:
             continue
+        claimed[i] = True
+        matches = match[offsets[i]:offsets[i + 1]]
+        matches = matches[~claimed[matches]]
+        claimed[matches] = True
+        targets[matches] = i
+    return targets
+
+
+def group_matches(gdf, targets):
+    """Build the match table from per-bird targets, dropping unmatched birds"""
+    targets = pd.Series(targets, index=gdf.index)
+    group_size = targets.map(targets.value_counts())
+    in_group = (group_size > 1).to_numpy()
+    if not in_group.any():
+        return pd.DataFrame(columns=EMPTY_MATCH_COLUMNS)
+
+    results = gdf[in_group].assign(target_ind=targets[in_group])
+    results = results.sort_values("target_ind", kind="stable").reset_index(drop=True)
+    results = results.rename(columns=MATCH_RENAME)
+    return results
+
+
+def compare_site(gdf):
+    """Match birds across dates and assign each match group a target index"""
+    return group_matches(gdf, assign_targets(gdf))
+
+
+def extend_targets(tracks, new_birds):
+    """Match birds from a single later date against existing tracks
+
+    tracks holds the earlier birds with their target_ind. Only birds that are
+    their own target can claim new birds, which gives the same result as
+    rerunning assign_targets over all dates as long as new_birds comes after
+    every bird in tracks in index order.
+    """
+    targets = new_birds.index.to_numpy().copy()
+    track_targets = tracks["target_ind"].to_numpy()
+    roots = np.flatnonzero(track_targets == tracks.index.to_numpy())
+    if len(roots) == 0 or len(new_birds) == 0:
+        return targets
+
+    target, match = best_matches(
+        np.asarray(tracks.geometry.values)[roots],
+        tracks["Date"].to_numpy()[roots],
+        np.asarray(new_birds.geometry.values),
+        new_birds["Date"].to_numpy(),
+    )
+    claimed = np.zeros(len(new_birds), dtype=bool)
+    group_starts = np.flatnonzero(np.diff(target, prepend=-1))
+    for root, matches in zip(target[group_starts], np.split(match, group_starts[1:])):
+        matches = matches[~claimed[matches]]
+        claimed[matches] = True
+        targets[matches] = track_targets[roots[root]]
 
-        # add to claimed
-        claimed_indices.extend(matches.index.values)
-
-        # add target info to match
-        row_gdf = geopandas.GeoDataFrame(pd.DataFrame(row).transpose(), crs=matches.crs)
-        matches = geopandas.GeoDataFrame(pd.concat([matches, row_gdf], ignore_index=True), crs=matches.crs)
-        matches["target_ind"] = index
-        matches = matches.rename(columns={
-            "xmin": "match_xmin",
-            "xmax": "match_xmax",
-            "ymin": "match_ymin",
-            "ymax": "match_ymax",
+    return targets
+
+
+TRACK_DIGEST_COLUMNS = ["bird_id", "score", "label", "xmin", "ymin", "xmax", "ymax"]
+
+
+def date_blocks(df):
+    """Summarise the block of rows for each date in a combined bird file
+
+    Each block records the date, the position of its first row, the number of
+    rows and a digest of the bird attributes so stored tracks can be checked
+    against a new version of the combined file.
+    """
+    digest_columns = [col for col in TRACK_DIGEST_COLUMNS if col in df.columns]
+    row_hashes = pd.util.hash_pandas_object(df[digest_columns], index=False).to_numpy()
+    blocks = []
+    for date, positions in df.groupby("Date", sort=False).indices.items():
+        blocks.append({
+            "date": date,
+            "first_index": int(positions[0]),
+            "count": len(positions),
+            "digest": hashlib.sha1(row_hashes[positions].tobytes()).hexdigest(),
         })
-        results.append(matches)
+    return sorted(blocks, key=lambda block: block["first_index"])
+
+
+def extendable_blocks(blocks, manifest, n_rows):
+    """Return the date blocks that can be appended to stored tracks
+
+    Returns None when the stored tracks cannot be extended and need a full
+    rebuild: nothing is stored yet, a stored date changed or was removed, a
+    date is spread over more than one block of rows, or a new date is not
+    later than every stored date.
+    """
+    if manifest is None:
+        return None
+    stored = manifest["dates"]
+    if blocks[:len(stored)] != stored:
+        return None
+
+    next_index = 0
+    for block in blocks:
+        if block["first_index"] != next_index:
+            return None
+        next_index += block["count"]
+    if next_index != n_rows:
+        return None
+
+    new_blocks = blocks[len(stored):]
+    last_date = tools.parse_date(stored[-1]["date"]) if stored else None
+    for block in new_blocks:
+        date = tools.parse_date(block["date"])
+        if last_date is not None and date <= last_date:
+            return None
+        last_date = date
+    return new_blocks
+
+
+def track_partition_path(track_dir, site, date, output_format):
+    return os.path.join(track_dir, f"{site}_{date}_tracks.{output_format}")
+
+
+def load_tracks(track_dir, site, blocks, output_format):
+    """Load stored tracks for the given date blocks, indexed by row position"""
+    tracks = []
+    for block in blocks:
+        path = track_partition_path(track_dir, site, block["date"], output_format)
+        if not os.path.exists(path):
+            raise ValueError(f"Stored tracks for {site} {block['date']} are missing")
+        partition = tools.read_geodataframe(path)
+        if len(partition) != block["count"]:
+            raise ValueError(f"Stored tracks for {site} {block['date']} do not match the manifest")
+        partition.index = pd.RangeIndex(block["first_index"], block["first_index"] + block["count"])
+        tracks.append(partition)
+    return geopandas.GeoDataFrame(pd.concat(tracks), crs=tracks[0].crs)
 
-    if results:
-        results = pd.concat(results, ignore_index=True)
+
+def write_tracks(tracks, track_dir, site, blocks, output_format):
+    """Write one track partition per date block"""
+    os.makedirs(track_dir, exist_ok=True)
+    for block in blocks:
+        partition = tracks.iloc[block["first_index"]:block["first_index"] + block["count"]]
+        tools.write_geodataframe(partition, track_partition_path(track_dir, site, block["date"], output_format))
+
+
+def update_tracks(df, year, site, savedir, output_format="shp"):
+    """Assign targets using the persisted track store for the site-year
+
+    The store in savedir/tracks holds one partition per date with the bird id,
+    date, target index and geometry of every bird, plus a manifest of the
+    dates it covers. When the combined file only adds dates after the stored
+    ones, only the new birds are matched against the stored tracks and
+    appended. Otherwise the store is rebuilt from scratch.
+    """
+    track_dir = os.path.join(savedir, "tracks")
+    manifest_path = os.path.join(track_dir, f"{site}_{year}_tracks.json")
+    blocks = date_blocks(df)
+
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    new_blocks = extendable_blocks(blocks, manifest, len(df))
+
+    track_columns = ["bird_id", "Date", "geometry"]
+    if new_blocks is not None and manifest["dates"]:
+        try:
+            tracks = load_tracks(track_dir, site, manifest["dates"], output_format)
+        except (OSError, ValueError) as e:
+            print(f"Could not load stored tracks: {e}")
+            new_blocks = None
+
+    if new_blocks is None:
+        print(f"Rebuilding nest tracks for {site} {year}")
+        shutil.rmtree(track_dir, ignore_errors=True)
+        tracks = df[track_columns].assign(target_ind=assign_targets(df))
+        new_blocks = blocks
+        stored_blocks = []
     else:
-        results = pd.DataFrame(columns=[
-            'match_xmin', 'match_ymin', 'match_xmax', 'match_ymax', 'label', 'score', 'image_path', 'Site', 'Date',
-            'Year', 'event', 'file_posts', 'bird_id', 'target_ind'
-        ])
-    return results
+        print(f"Extending nest tracks for {site} {year} with {len(new_blocks)} new dates")
+        stored_blocks = manifest["dates"]
+        if not stored_blocks:
+            tracks = df.iloc[:0][track_columns].assign(target_ind=pd.Series(dtype="int64"))
+        for block in new_blocks:
+            new_birds = df.iloc[block["first_index"]:block["first_index"] + block["count"]][track_columns]
+            new_birds = new_birds.assign(target_ind=extend_targets(tracks, new_birds))
+            tracks = geopandas.GeoDataFrame(pd.concat([tracks, new_birds]), crs=df.crs)
+
+    write_tracks(tracks, track_dir, site, new_blocks, output_format)
+    with open(manifest_path, "w") as f:
+        json.dump({"dates": stored_blocks + new_blocks}, f, indent=1)
+
+    return tracks["target_ind"].to_numpy()
 
 
-def detect_nests(bird_detection_file, year, site, savedir):
-    """Given a set of shapefiles, track time series of overlaps and save a shapefile of detected boxes"""
+def detect_nests(bird_detection_file, year, site, savedir, incremental=False, output_format="shp"):
+    """Given a set of shapefiles, track time series of overlaps and save a shapefile of detected boxes
+
+    With incremental=True matches are read from and appended to the site-year
+    track store (see update_tracks) so only newly added dates are matched.
+    """
     os.makedirs(savedir, exist_ok=True)
-    filename = os.path.join(savedir, f"{site}_{year}_detected_nests.shp")
-    df = geopandas.read_file(bird_detection_file)
-
-    # In some versions of DeepForest, when image coordinates are reprojected
-    # to geographic coordinates the columns storing the bounding box positions
-    # are not updated. This code ensures that the bounding box columns we use
-    # match the properly transformed geometry.
-    df["xmin"] = df.geometry.bounds["minx"]
-    df["ymin"] = df.geometry.bounds["miny"]
-    df["xmax"] = df.geometry.bounds["maxx"]
-    df["ymax"] = df.geometry.bounds["maxy"]
-    results = compare_site(df)
+    filename = os.path.join(savedir, f"{site}_{year}_detected_nests.{output_format}")
+    with instrument.step("read"):
+        df = tools.read_geodataframe(bird_detection_file)
+        instrument.count("birds", len(df))
+
+    df = tools.repair_bounds(df)
+    with instrument.step("match"):
+        if incremental:
+            targets = update_tracks(df, year, site, savedir, output_format)
+        else:
+            targets = assign_targets(df)
+        results = group_matches(df, targets)
 
     schema = {
         "geometry": "Polygon",
@@ -134,20 +354,27 @@ def detect_nests(bird_detection_file, year, site, savedir):
         )
         gdf_tofile = empty_results
 
-    try:
-        import pyogrio
-        gdf_tofile.to_file(filename, driver="ESRI Shapefile", engine="pyogrio")
-    except ImportError:
-        gdf_tofile.to_file(filename, driver="ESRI Shapefile", engine="fiona")
+    with instrument.step("write"):
+        tools.write_geodataframe(gdf_tofile, filename)
+        instrument.count("nest_detections", len(gdf_tofile))
 
     return filename
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect nests from combined site-year bird predictions")
+    parser.add_argument("path", help="Combined bird predictions for a site-year")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Only match dates that are not already in the stored nest tracks")
+    parser.add_argument("--format", default="shp", choices=tools.INTERMEDIATE_FORMATS, help="Output file format")
+    args = parser.parse_args()
+
     working_dir = tools.get_working_dir()
-    path = sys.argv[1]
+    path = args.path
     split_path = os.path.normpath(path).split(os.path.sep)
     year = split_path[5]
     site = split_path[6]
     savedir = os.path.join(working_dir, "detected_nests", year, site)
-    detect_nests(path, year, site, savedir=savedir)
+    instrument.start_job("detect_nests", site=site, year=year)
+    detect_nests(path, year, site, savedir=savedir, incremental=args.incremental, output_format=args.format)
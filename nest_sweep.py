@@ -0,0 +1,209 @@
+"""Sweep nest detection and processing thresholds over a site-year
+
+Every candidate pair of birds on different dates is found once per site-year,
+with its IoU. Each bird score threshold then matches the birds it keeps using
+only that graph, the same way nest_detection.assign_targets would on a
+combined file written with the threshold. Every combination of the
+process_nests thresholds is summarized from those matches in memory. No
+intermediate files are written and the spatial index is built only once.
+
+    python nest_sweep.py predictions/2022/Joule/Joule_2022_combined.shp --score-thresh 0.3 0.4 0.5 \
+        --min-detections 2 3 4 --output joule_sweep.csv
+
+Score thresholds are applied to the combined file, so thresholds below the
+one it was combined with (0.3) give the same nests as that threshold.
+"""
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import shapely
+import instrument
+import nest_detection
+import process_nests
+import tools
+
+SWEEP_COLUMNS = ["Site", "Year", "score_thresh", "min_score", "min_detections", "min_consec_detects", "birds", "nests"]
+
+# Match graph and birds of the site-year being swept in a worker process
+_worker_graph = None
+
+
+def build_match_graph(gdf):
+    """Every pair of birds on different dates whose boxes intersect, with the IoU of the pair
+
+    Returns a dict of aligned target, match and iou arrays of positions in
+    gdf sorted by target and then match, with the factorized date of every
+    bird.
+    """
+    geoms = np.asarray(gdf.geometry.values)
+    dates, _ = pd.factorize(gdf["Date"].to_numpy())
+    target, match = shapely.STRtree(geoms).query(geoms)
+    other_date = dates[target] != dates[match]
+    target, match = target[other_date], match[other_date]
+    order = np.lexsort((match, target))
+    target, match = target[order], match[order]
+    instrument.count("candidate_pairs", len(target))
+    return {
+        "target": target,
+        "match": match,
+        "iou": nest_detection.calculate_IoUs(geoms[target], geoms[match]),
+        "dates": dates,
+    }
+
+
+def sweep_targets(graph, keep):
+    """Targets of the birds selected by the boolean mask keep, as positions among the kept birds
+
+    Gives the same targets as nest_detection.assign_targets on the kept
+    birds: pairs with a dropped bird are removed, the best IoU match on
+    each other date is chosen again and birds are claimed greedily.
+    """
+    positions = np.cumsum(keep) - 1
+    pairs = keep[graph["target"]] & keep[graph["match"]]
+    target, match, iou = graph["target"][pairs], graph["match"][pairs], graph["iou"][pairs]
+
+    # Only the best matches of a target on each date are candidates, as in nest_detection.best_matches
+    groups = pd.DataFrame({"target": target, "date": graph["dates"][match], "iou": iou}).groupby(["target", "date"])
+    single = groups["iou"].transform("size").to_numpy() == 1
+    best = single | (iou == groups["iou"].transform("max").to_numpy())
+    return nest_detection.claim_targets(int(keep.sum()), positions[target[best]], positions[match[best]])
+
+
+def evaluate_threshold(birds, graph, score_thresh, nest_grid):
+    """Rows of the sweep table for one bird score threshold and every process_nests combination in nest_grid"""
+    keep = birds["score"].to_numpy() > score_thresh
+    kept = birds[keep]
+    targets = pd.Series(sweep_targets(graph, keep), index=kept.index)
+    nests_data = kept[targets.map(targets.value_counts()).to_numpy() > 1]
+    nests_data = nests_data.assign(target_ind=targets[nests_data.index].to_numpy())
+
+    rows = []
+    for min_score, min_detections, min_consec_detects in nest_grid:
+        species = {}
+        if len(nests_data):
+            nest_info = process_nests.summarize_nests(nests_data, min_score, min_detections, min_consec_detects)
+            species = nest_info["label"].value_counts().to_dict()
+        rows.append({
+            "Site": birds["Site"].iloc[0],
+            "Year": birds["Year"].iloc[0],
+            "score_thresh": score_thresh,
+            "min_score": min_score,
+            "min_detections": min_detections,
+            "min_consec_detects": min_consec_detects,
+            "birds": int(keep.sum()),
+            "nests": sum(species.values()),
+            **species
+        })
+    return rows
+
+
+def sweep_birds(birds):
+    """Columns of a combined bird file needed by the sweep, named like the detected nests"""
+    bounds = birds.geometry.bounds
+    return pd.DataFrame({
+        "Site": birds["Site"].astype(str).to_numpy(),
+        "Year": birds["Year"].astype(str).to_numpy(),
+        "Date": birds["Date"].astype(str).to_numpy(),
+        "label": birds["label"].to_numpy(),
+        "score": birds["score"].to_numpy(dtype="float64"),
+        "bird_id": birds["bird_id"].to_numpy(),
+        "match_xmin": bounds.minx.to_numpy(),
+        "match_ymin": bounds.miny.to_numpy(),
+        "match_xmax": bounds.maxx.to_numpy(),
+        "match_ymax": bounds.maxy.to_numpy(),
+    })
+
+
+def _init_worker(birds, graph):
+    global _worker_graph
+    _worker_graph = (birds, graph)
+
+
+def _evaluate_threshold_worker(score_thresh, nest_grid):
+    birds, graph = _worker_graph
+    return evaluate_threshold(birds, graph, score_thresh, nest_grid)
+
+
+def sweep_site_year(gdf, score_thresholds, min_scores, min_detections, min_consec_detects, workers=4):
+    """Nest counts and species breakdowns for every combination of thresholds over one site-year
+
+    gdf holds the combined birds of the site-year. The match graph is built
+    once and the score thresholds are evaluated by workers processes, each
+    receiving the graph once; workers=0 evaluates them in this process.
+    Returns a DataFrame with a row per combination and a nest count column
+    per species.
+    """
+    with instrument.step("graph"):
+        graph = build_match_graph(gdf)
+    birds = sweep_birds(gdf)
+    nest_grid = list(itertools.product(min_scores, min_detections, min_consec_detects))
+
+    with instrument.step("evaluate"):
+        if workers > 0 and len(score_thresholds) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(score_thresholds)),
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker,
+                                     initargs=(birds, graph)) as executor:
+                results = list(executor.map(_evaluate_threshold_worker, score_thresholds, itertools.repeat(nest_grid)))
+        else:
+            results = [evaluate_threshold(birds, graph, score_thresh, nest_grid) for score_thresh in score_thresholds]
+        instrument.count("combinations", len(score_thresholds) * len(nest_grid))
+
+    table = pd.DataFrame([row for rows in results for row in rows])
+    species = sorted(set(table.columns) - set(SWEEP_COLUMNS))
+    table[species] = table[species].fillna(0).astype("int64")
+    return table[SWEEP_COLUMNS + species]
+
+
+def sweep(paths, score_thresholds, min_scores, min_detections, min_consec_detects, workers=4):
+    """Sweep table of several combined site-year files"""
+    tables = []
+    for path in paths:
+        with instrument.step("read"):
+            gdf = tools.repair_bounds(tools.read_geodataframe(path))
+            instrument.count("birds", len(gdf))
+        if len(gdf) == 0:
+            print(f"Skipping {path}, it has no birds")
+            continue
+        tables.append(sweep_site_year(gdf, score_thresholds, min_scores, min_detections, min_consec_detects, workers))
+        print(f"Swept {len(tables[-1])} parameter combinations for {path}")
+    if not tables:
+        return pd.DataFrame(columns=SWEEP_COLUMNS)
+    table = pd.concat(tables, ignore_index=True)
+    species = [column for column in table.columns if column not in SWEEP_COLUMNS]
+    table[species] = table[species].fillna(0).astype("int64")
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nest counts for a grid of nest detection and processing thresholds")
+    parser.add_argument("paths", nargs="+", help="Combined bird predictions for each site-year")
+    parser.add_argument("--score-thresh", type=float, nargs="+", default=[0.3], help="Bird score thresholds")
+    parser.add_argument("--min-score", type=float, nargs="+", default=[0.3], help="process_nests min_score values")
+    parser.add_argument("--min-detections",
+                        type=int,
+                        nargs="+",
+                        default=[3],
+                        help="process_nests min_detections values")
+    parser.add_argument("--min-consec-detects",
+                        type=int,
+                        nargs="+",
+                        default=[1],
+                        help="process_nests min_consec_detects values")
+    parser.add_argument("--workers", type=int, default=4, help="Processes evaluating score thresholds")
+    parser.add_argument("--output", default="nest_parameter_sweep.csv", help="CSV file for the sweep table")
+    args = parser.parse_args()
+
+    instrument.start_job("sweep_nests")
+    table = sweep(args.paths,
+                  args.score_thresh,
+                  args.min_score,
+                  args.min_detections,
+                  args.min_consec_detects,
+                  workers=args.workers)
+    table.to_csv(args.output, index=False)
+    print(f"Wrote {len(table)} parameter combinations to {args.output}")
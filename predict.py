@@ -1,37 +1,293 @@
+import argparse
+import contextlib
+import multiprocessing
 import os
 import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import instrument
+import raster_windows
 import tools
 
 import geopandas
 import pandas as pd
-import rasterio
+import shapely
 import torch
-from deepforest import main
-from deepforest.utilities import image_to_geo_coordinates
+from deepforest import main, utilities
+from deepforest.predict import across_class_nms
 import PIL.Image
 
 PIL.Image.MAX_IMAGE_PIXELS = None
 
+MODEL_NAME = "weecology/everglades-bird-species-detector"
 
-def run(proj_tile_path, savedir="."):
-    """Apply trained model to a drone tile"""
-    model_name = "weecology/everglades-bird-species-detector"
+
+def load_model(model_name=MODEL_NAME):
+    """Load the bird detector"""
     model = main.deepforest()
     model.load_model(model_name=model_name)
+    return model
+
+
+def prediction_dir(proj_tile_path):
+    """Directory predictions for a projected orthomosaic are saved to"""
+    split_path = os.path.normpath(proj_tile_path).split(os.path.sep)
+    year = split_path[5]
+    site = split_path[6]
+    working_dir = tools.get_working_dir()
+    return os.path.join(working_dir, "predictions", year, site)
+
+
+def plan_windows(proj_tile_path,
+                 patch_size=1500,
+                 skip_nodata=False,
+                 min_valid_fraction=0.0,
+                 virtual=False,
+                 patch_overlap=0.0):
+    """Windows of a drone tile to predict
+
+    Neighbouring windows overlap by patch_overlap of patch_size. With
+    skip_nodata windows that are entirely nodata, or have less than
+    min_valid_fraction valid pixels, are left out.
+    """
+    with raster_windows.open_raster(proj_tile_path, virtual) as src:
+        windows = raster_windows.tile_windows(src.width, src.height, patch_size, overlap=patch_overlap)
+        if skip_nodata:
+            n_windows = len(windows)
+            windows, skipped = raster_windows.skip_nodata_windows(src, windows, min_valid_fraction)
+            print(f"Skipping {skipped} of {n_windows} windows without enough valid data")
+    return windows
+
+
+def shift_boxes(boxes, window):
+    """Shift boxes predicted in a window image into raster pixel coordinates"""
+    if boxes is None or boxes.empty:
+        return None
+    boxes = pd.DataFrame(boxes).drop(columns="geometry", errors="ignore")
+    boxes[["xmin", "xmax"]] += window.col_off
+    boxes[["ymin", "ymax"]] += window.row_off
+    return boxes
+
+
+def predict_window(model, image, window):
+    """Predict birds in a window image and shift the boxes into raster pixel coordinates"""
+    return shift_boxes(model.predict_image(image=image), window)
+
+
+def predict_window_batch(model, images, windows, device):
+    """Predict birds in several window images with one forward pass
+
+    Post-processing follows model.predict_image: boxes are formatted, boxes of
+    different classes are suppressed across classes and numeric labels are
+    mapped to names. Returns the boxes of each window in raster pixel
+    coordinates, or None for windows without birds.
+    """
+    tensors = [torch.from_numpy(image).permute(2, 0, 1).to(device) / 255 for image in images]
+    with torch.no_grad():
+        outputs = model.model(tensors)
+    results = []
+    for output, window in zip(outputs, windows):
+        if len(output["boxes"]) == 0:
+            results.append(None)
+            continue
+        boxes = utilities.format_boxes(output)
+        if boxes.label.nunique() > 1:
+            boxes = across_class_nms(boxes, iou_threshold=model.config.nms_thresh)
+        boxes["label"] = boxes.label.map(model.numeric_to_label_dict)
+        results.append(shift_boxes(boxes, window))
+    return results
+
+
+# Model and open rasters held by each CPU prediction worker process
+_worker_model = None
+_worker_rasters = {}
+_worker_stack = contextlib.ExitStack()
+
+
+def _init_cpu_worker(torch_threads):
+    global _worker_model
+    torch.set_num_threads(torch_threads)
+    _worker_model = load_model()
+    _worker_model.model.eval()
+
+
+def _predict_cpu_window(proj_tile_path, window, virtual=False):
+    key = (proj_tile_path, virtual)
+    if key not in _worker_rasters:
+        _worker_rasters[key] = _worker_stack.enter_context(raster_windows.open_raster(proj_tile_path, virtual))
+    src = _worker_rasters[key]
+    with torch.no_grad():
+        return predict_window(_worker_model, raster_windows.read_window(src, window), window)
+
+
+def merge_window_boxes(window_boxes, proj_tile_path):
+    """Combine per-window boxes into a GeoDataFrame in raster pixel coordinates
 
-    with rasterio.open(proj_tile_path) as src:
+    The window column records the position of each box's window in window_boxes.
+    """
+    window_boxes = [boxes.assign(window=i) for i, boxes in enumerate(window_boxes) if boxes is not None]
+    if not window_boxes:
+        return None
+    boxes = pd.concat(window_boxes, ignore_index=True)
+    boxes["image_path"] = os.path.basename(proj_tile_path)
+    geometry = shapely.box(boxes["xmin"], boxes["ymin"], boxes["xmax"], boxes["ymax"])
+    return geopandas.GeoDataFrame(boxes, geometry=geometry)
+
+
+def predict_tile_windows(model, proj_tile_path, windows, virtual=False):
+    """Predict a drone tile one window at a time in this process"""
+    window_boxes = []
+    with raster_windows.open_raster(proj_tile_path, virtual) as src, torch.no_grad():
+        for window in windows:
+            window_boxes.append(predict_window(model, raster_windows.read_window(src, window), window))
+    return merge_window_boxes(window_boxes, proj_tile_path)
+
+
+def predict_tile_prefetch(model,
+                          proj_tile_path,
+                          windows,
+                          virtual=False,
+                          prefetch_workers=2,
+                          batch_size=1,
+                          max_queued_mb=1024):
+    """Predict a drone tile while upcoming windows are read and decoded in the background
+
+    prefetch_workers threads read windows ahead of the model, holding at most
+    max_queued_mb of decoded windows (see raster_windows.prefetch_windows),
+    and batch_size windows are passed to the model per forward pass. The model
+    runs on the GPU when one is available. The time the model waited for
+    windows is counted as model_idle_ms.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.model.to(device).eval()
+    stats = {}
+    window_boxes = []
+    batch = []
+    start = time.perf_counter()
+    for window, image in raster_windows.prefetch_windows(proj_tile_path,
+                                                         windows,
+                                                         virtual=virtual,
+                                                         workers=prefetch_workers,
+                                                         max_queued_mb=max_queued_mb,
+                                                         batch_size=batch_size,
+                                                         stats=stats):
+        batch.append((window, image))
+        if len(batch) == batch_size:
+            window_boxes.extend(predict_window_batch(model, [b[1] for b in batch], [b[0] for b in batch], device))
+            batch = []
+    if batch:
+        window_boxes.extend(predict_window_batch(model, [b[1] for b in batch], [b[0] for b in batch], device))
+    elapsed = time.perf_counter() - start
+    print(f"Model waited {stats.get('wait_seconds', 0.0):.1f} of {elapsed:.1f} seconds for windows "
+          f"({stats.get('read_seconds', 0.0):.1f} seconds of reads on {prefetch_workers} threads)")
+    instrument.count("model_idle_ms", 1000 * stats.get("wait_seconds", 0.0))
+    instrument.count("read_ms", 1000 * stats.get("read_seconds", 0.0))
+    return merge_window_boxes(window_boxes, proj_tile_path)
+
+
+def predict_tile_cpu(proj_tile_path, windows, workers, torch_threads=None, virtual=False):
+    """Predict a drone tile on the CPU by sharding its windows across worker processes
+
+    Each worker loads its own copy of the model, limits torch to torch_threads
+    threads (by default the available cores are split evenly between the
+    workers) and reads its windows directly from the raster. Returns boxes in
+    raster pixel coordinates, like model.predict_tile, or None if nothing was
+    found. Boxes keep the window they came from in the window column, so run
+    can remove the birds predicted twice where windows overlap (see
+    raster_windows.suppress_window_duplicates).
+    """
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    print(f"Predicting {len(windows)} windows with {workers} CPU workers x {torch_threads} threads")
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=context,
+                             initializer=_init_cpu_worker,
+                             initargs=(torch_threads,)) as executor:
+        window_boxes = list(
+            executor.map(_predict_cpu_window, [proj_tile_path] * len(windows), windows, [virtual] * len(windows)))
+
+    return merge_window_boxes(window_boxes, proj_tile_path)
+
+
+def run(proj_tile_path,
+        savedir=".",
+        output_format="shp",
+        model=None,
+        cpu_workers=0,
+        torch_threads=None,
+        skip_nodata=False,
+        min_valid_fraction=0.0,
+        virtual=False,
+        prefetch_workers=0,
+        batch_size=1,
+        max_queued_mb=1024,
+        patch_overlap=0.0):
+    """Apply trained model to a drone tile
+
+    Pass an already loaded model to avoid reloading it for every tile. With
+    cpu_workers > 0 the tile is predicted on the CPU by that many worker
+    processes (see predict_tile_cpu) and model is not used. With skip_nodata
+    windows without enough valid data are not predicted (see plan_windows).
+    With virtual=True proj_tile_path is an unprojected orthomosaic, read
+    through a warped view in the projected CRS (see raster_windows.warped_view),
+    and the predictions are named as if it had been projected. With
+    prefetch_workers > 0 windows are read in the background while the model
+    runs, batch_size windows at a time (see predict_tile_prefetch). With
+    patch_overlap > 0 neighbouring windows overlap by that fraction and boxes
+    predicted twice in the overlaps are merged (see
+    raster_windows.suppress_window_duplicates).
+    """
+    with raster_windows.open_raster(proj_tile_path, virtual) as src:
         raster_crs = src.crs
+        raster_transform = src.transform
+        raster_width, raster_height = src.width, src.height
 
-    boxes = model.predict_tile(
-        path=proj_tile_path,
-        patch_overlap=0,
-        patch_size=1500,
-        dataloader_strategy="window",
-    )
-    proj_tile_dir = os.path.dirname(proj_tile_path)
-    projected_boxes = None
+    if model is None and cpu_workers == 0:
+        with instrument.step("load_model"):
+            model = load_model()
+    if cpu_workers > 0 or skip_nodata or virtual or prefetch_workers > 0 or patch_overlap > 0:
+        with instrument.step("plan_windows"):
+            windows = plan_windows(proj_tile_path,
+                                   skip_nodata=skip_nodata,
+                                   min_valid_fraction=min_valid_fraction,
+                                   virtual=virtual,
+                                   patch_overlap=patch_overlap)
+            instrument.count("windows", len(windows))
+    with instrument.step("inference"):
+        if cpu_workers > 0:
+            boxes = predict_tile_cpu(proj_tile_path, windows, cpu_workers, torch_threads=torch_threads, virtual=virtual)
+        elif prefetch_workers > 0:
+            boxes = predict_tile_prefetch(model,
+                                          proj_tile_path,
+                                          windows,
+                                          virtual=virtual,
+                                          prefetch_workers=prefetch_workers,
+                                          batch_size=batch_size,
+                                          max_queued_mb=max_queued_mb)
+        elif skip_nodata or virtual or patch_overlap > 0:
+            # predict_tile reads from a file, so warped views are predicted window by window
+            boxes = predict_tile_windows(model, proj_tile_path, windows, virtual=virtual)
+        else:
+            boxes = model.predict_tile(
+                path=proj_tile_path,
+                patch_overlap=0,
+                patch_size=1500,
+                dataloader_strategy="window",
+            )
+        instrument.count("boxes", 0 if boxes is None else len(boxes))
+    if boxes is not None and patch_overlap > 0:
+        with instrument.step("merge"):
+            n_boxes = len(boxes)
+            boxes = raster_windows.suppress_window_duplicates(boxes, windows, raster_width, raster_height,
+                                                              raster_windows.overlap_pixels(1500, patch_overlap))
+            instrument.count("duplicate_boxes", n_boxes - len(boxes))
     if boxes is not None:
-        projected_boxes = image_to_geo_coordinates(boxes, proj_tile_dir)
+        boxes = boxes.drop(columns="window", errors="ignore")
+        with instrument.step("georeference"):
+            projected_boxes = raster_windows.georeference_boxes(boxes, raster_transform, raster_crs)
     else:
         projected_boxes = geopandas.GeoDataFrame(
             {
@@ -49,22 +305,105 @@ def run(proj_tile_path, savedir="."):
 
     os.makedirs(savedir, exist_ok=True)
     basename = os.path.splitext(os.path.basename(proj_tile_path))[0]
-    fn = "{}/{}.shp".format(savedir, basename)
-
-    try:
-        import pyogrio
-        projected_boxes.to_file(fn, driver="ESRI Shapefile", engine="pyogrio")
-    except ImportError:
-        projected_boxes.to_file(fn, driver="ESRI Shapefile", engine="fiona")
+    if virtual:
+        basename += "_projected"
+        projected_boxes["image_path"] = f"{basename}.tif"
+    fn = "{}/{}.{}".format(savedir, basename, output_format)
+    with instrument.step("write"):
+        tools.write_geodataframe(projected_boxes, fn)
     return fn
 
 
+def run_batch(proj_tile_paths, output_format="shp", model=None, **run_options):
+    """Apply the model to many drone tiles, loading it only once
+
+    Predictions for each tile are written as soon as that tile is done. A
+    failure on one tile is reported and does not stop the remaining tiles.
+    run_options are passed on to run. Returns a dict of written prediction
+    files and a dict of failed tiles.
+    """
+    if model is None and run_options.get("cpu_workers", 0) == 0:
+        with instrument.step("load_model"):
+            model = load_model()
+
+    results = {}
+    failures = {}
+    for i, path in enumerate(proj_tile_paths, start=1):
+        print(f"Predicting {path} ({i}/{len(proj_tile_paths)})")
+        try:
+            results[path] = run(path,
+                                savedir=prediction_dir(path),
+                                output_format=output_format,
+                                model=model,
+                                **run_options)
+            instrument.count("flights")
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Prediction failed for {path}: {e}")
+            failures[path] = e
+            instrument.count("failed_flights")
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    return results, failures
+
+
 if __name__ == "__main__":
-    path = sys.argv[1]
-    split_path = os.path.normpath(path).split(os.path.sep)
-    year = split_path[5]
-    site = split_path[6]
+    parser = argparse.ArgumentParser(description="Predict birds in projected orthomosaics")
+    parser.add_argument("paths", nargs="+", help="Projected orthomosaics")
+    parser.add_argument("--batch",
+                        action="store_true",
+                        help="Predict all orthomosaics in one process, loading the model once")
+    parser.add_argument("--format", default="shp", choices=tools.INTERMEDIATE_FORMATS, help="Prediction file format")
+    parser.add_argument("--cpu-workers",
+                        type=int,
+                        default=0,
+                        help="Predict on the CPU with this many worker processes (0 uses the default device)")
+    parser.add_argument("--torch-threads", type=int, default=None, help="Torch threads per CPU worker")
+    parser.add_argument("--skip-nodata", action="store_true", help="Do not predict windows that are all nodata")
+    parser.add_argument("--min-valid-fraction",
+                        type=float,
+                        default=0.0,
+                        help="With --skip-nodata, also skip windows with less than this fraction of valid pixels")
+    parser.add_argument("--prefetch-workers",
+                        type=int,
+                        default=0,
+                        help="Read and decode windows on this many threads while the model runs (0 reads in turn)")
+    parser.add_argument("--batch-size", type=int, default=1, help="With --prefetch-workers, windows per forward pass")
+    parser.add_argument("--max-queued-mb",
+                        type=int,
+                        default=1024,
+                        help="With --prefetch-workers, most decoded window data read ahead of the model")
+    parser.add_argument("--patch-overlap",
+                        type=float,
+                        default=0.0,
+                        help="Overlap neighbouring windows by this fraction and merge the boxes predicted twice")
+    parser.add_argument("--virtual",
+                        action="store_true",
+                        help="Paths are orthomosaics, predicted through a warped view instead of a projected mosaic")
+    args = parser.parse_args()
 
-    working_dir = tools.get_working_dir()
-    savedir = os.path.join(working_dir, "predictions", year, site)
-    result = run(proj_tile_path=path, savedir=savedir)
+    run_options = {
+        "cpu_workers": args.cpu_workers,
+        "torch_threads": args.torch_threads,
+        "skip_nodata": args.skip_nodata,
+        "min_valid_fraction": args.min_valid_fraction,
+        "virtual": args.virtual,
+        "prefetch_workers": args.prefetch_workers,
+        "batch_size": args.batch_size,
+        "max_queued_mb": args.max_queued_mb,
+        "patch_overlap": args.patch_overlap,
+    }
+    if len(args.paths) == 1:
+        instrument.start_job("predict_birds", **tools.flight_labels(args.paths[0]))
+    else:
+        instrument.start_job("predict_birds", flights=[tools.flight_labels(path)["flight"] for path in args.paths])
+    if args.batch:
+        results, failures = run_batch(args.paths, output_format=args.format, **run_options)
+        print(f"Predicted {len(results)} of {len(args.paths)} orthomosaics")
+        if failures:
+            sys.exit(f"Prediction failed for: {', '.join(failures)}")
+    else:
+        for path in args.paths:
+            result = run(proj_tile_path=path, savedir=prediction_dir(path), output_format=args.format, **run_options)
@@ -0,0 +1,261 @@
+"""Queryable store of all bird predictions
+
+The combined predictions of each site-year are kept as a GeoParquet
+partition, sorted along a Hilbert curve so each row group covers a compact
+area. Every row has its geometry's bounds and its flight date as columns, so
+the Parquet statistics of each row group record the area, dates, labels and
+scores it covers. index.json records the same for each partition. A query
+only opens the partitions that can match and only reads the row groups that
+can match.
+
+    python prediction_store.py query --site Joule --start 2022-03-01 --end 2022-04-01 --label "Great Egret"
+"""
+import argparse
+import os
+from datetime import date
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import instrument
+import manifest
+import tools
+
+ROW_GROUP_SIZE = 10000
+BOUNDS_COLUMNS = ["bbox_xmin", "bbox_ymin", "bbox_xmax", "bbox_ymax"]
+DATE_COLUMN = "flight_date"
+
+
+def sort_partition(df):
+    """Add bounds and date columns and sort the birds along a Hilbert curve over the partition"""
+    bounds = df.geometry.bounds
+    df = df.assign(**{column: bounds[name] for column, name in zip(BOUNDS_COLUMNS, ["minx", "miny", "maxx", "maxy"])})
+    df[DATE_COLUMN] = [tools.parse_date(value) for value in df["Date"]]
+    if len(df) == 0:
+        return df
+    order = np.argsort(df.geometry.hilbert_distance().to_numpy(), kind="stable")
+    return df.iloc[order].reset_index(drop=True)
+
+
+def describe_partition(df):
+    """Index entry with the extent, date range, labels and best score of a sorted partition"""
+    return {
+        "crs": df.crs.to_string() if df.crs else None,
+        "rows": len(df),
+        "bbox": [
+            float(df["bbox_xmin"].min()),
+            float(df["bbox_ymin"].min()),
+            float(df["bbox_xmax"].max()),
+            float(df["bbox_ymax"].max())
+        ],
+        "start": min(df[DATE_COLUMN]).isoformat(),
+        "end": max(df[DATE_COLUMN]).isoformat(),
+        "labels": sorted(df["label"].unique().tolist()),
+        "max_score": float(df["score"].max()),
+    }
+
+
+def update_store(paths, store_dir, row_group_size=ROW_GROUP_SIZE):
+    """Keep a sorted partition and index entry for each combined site-year file
+
+    Like the published partitions, a partition is only rebuilt when the
+    content digest of its source, covering every component of a Shapefile,
+    changes and partitions without a source are removed. Returns the names
+    of the partitions that were rebuilt.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    index_path = os.path.join(store_dir, "index.json")
+    index = manifest.load_manifest(index_path)
+    digests = manifest.update_manifest(paths, os.path.join(store_dir, "sources.json"))
+
+    names = []
+    rebuilt = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        names.append(name)
+        partition_path = os.path.join(store_dir, f"{name}.parquet")
+        if index.get(name, {}).get("digest") == digests[path] and os.path.exists(partition_path):
+            continue
+        df = tools.read_geodataframe(path)
+        if len(df) == 0:
+            index.pop(name, None)
+            if os.path.exists(partition_path):
+                os.remove(partition_path)
+            continue
+        df = sort_partition(df)
+        df.to_parquet(partition_path, index=False, compression="zstd", row_group_size=row_group_size)
+        index[name] = {
+            "source": path,
+            "digest": digests[path],
+            "site": str(df["Site"].iloc[0]),
+            "year": str(df["Year"].iloc[0]),
+            **describe_partition(df)
+        }
+        rebuilt.append(name)
+
+    for name in set(index) - set(names):
+        partition_path = os.path.join(store_dir, f"{name}.parquet")
+        if os.path.exists(partition_path):
+            os.remove(partition_path)
+        del index[name]
+
+    manifest.write_json_atomic(index, index_path)
+    print(f"Rebuilt {len(rebuilt)} of {len(names)} prediction store partitions")
+    return rebuilt
+
+
+def to_date(value):
+    return value if value is None or isinstance(value, date) else date.fromisoformat(value)
+
+
+def overlaps(bbox, other):
+    return bbox[0] <= other[2] and bbox[2] >= other[0] and bbox[1] <= other[3] and bbox[3] >= other[1]
+
+
+def partition_matches(entry, bbox=None, start=None, end=None, labels=None, min_score=None, sites=None):
+    if sites is not None and entry["site"] not in sites:
+        return False
+    if bbox is not None and not overlaps(bbox, entry["bbox"]):
+        return False
+    if start is not None and date.fromisoformat(entry["end"]) < start:
+        return False
+    if end is not None and date.fromisoformat(entry["start"]) > end:
+        return False
+    if labels is not None and not set(labels) & set(entry["labels"]):
+        return False
+    return min_score is None or entry["max_score"] >= min_score
+
+
+def row_group_ranges(metadata, i):
+    """Minimum and maximum of each column with statistics in row group i"""
+    row_group = metadata.row_group(i)
+    ranges = {}
+    for j in range(row_group.num_columns):
+        column = row_group.column(j)
+        if column.statistics is not None and column.statistics.has_min_max:
+            ranges[column.path_in_schema] = (column.statistics.min, column.statistics.max)
+    return ranges
+
+
+def row_group_matches(ranges, bbox=None, start=None, end=None, labels=None, min_score=None):
+    """Whether a row group can hold a match; columns without statistics never rule one out"""
+    if bbox is not None and all(column in ranges for column in BOUNDS_COLUMNS):
+        extent = [ranges["bbox_xmin"][0], ranges["bbox_ymin"][0], ranges["bbox_xmax"][1], ranges["bbox_ymax"][1]]
+        if not overlaps(bbox, extent):
+            return False
+    if DATE_COLUMN in ranges:
+        if start is not None and ranges[DATE_COLUMN][1] < start:
+            return False
+        if end is not None and ranges[DATE_COLUMN][0] > end:
+            return False
+    if labels is not None and "label" in ranges:
+        if not any(ranges["label"][0] <= label <= ranges["label"][1] for label in labels):
+            return False
+    if min_score is not None and "score" in ranges and ranges["score"][1] < min_score:
+        return False
+    return True
+
+
+def plan_query(store_dir, bbox=None, start=None, end=None, labels=None, min_score=None, sites=None):
+    """Partition files that can match a query, with their CRS and the row groups that can match"""
+    start, end = to_date(start), to_date(end)
+    index = manifest.load_manifest(os.path.join(store_dir, "index.json"))
+    plan = {}
+    for name, entry in sorted(index.items()):
+        if not partition_matches(entry, bbox, start, end, labels, min_score, sites):
+            continue
+        path = os.path.join(store_dir, f"{name}.parquet")
+        metadata = pq.read_metadata(path)
+        row_groups = [
+            i for i in range(metadata.num_row_groups)
+            if row_group_matches(row_group_ranges(metadata, i), bbox, start, end, labels, min_score)
+        ]
+        if row_groups:
+            plan[path] = {"crs": entry["crs"], "row_groups": row_groups}
+    return plan
+
+
+def row_filter(table, bbox=None, start=None, end=None, labels=None, min_score=None):
+    conditions = []
+    if bbox is not None:
+        conditions += [
+            pc.less_equal(table["bbox_xmin"], bbox[2]),
+            pc.greater_equal(table["bbox_xmax"], bbox[0]),
+            pc.less_equal(table["bbox_ymin"], bbox[3]),
+            pc.greater_equal(table["bbox_ymax"], bbox[1])
+        ]
+    if start is not None:
+        conditions.append(pc.greater_equal(table[DATE_COLUMN], pa.scalar(start)))
+    if end is not None:
+        conditions.append(pc.less_equal(table[DATE_COLUMN], pa.scalar(end)))
+    if labels is not None:
+        conditions.append(pc.is_in(table["label"], value_set=pa.array(list(labels))))
+    if min_score is not None:
+        conditions.append(pc.greater_equal(table["score"], min_score))
+    if not conditions:
+        return table
+    mask = conditions[0]
+    for condition in conditions[1:]:
+        mask = pc.and_(mask, condition)
+    return table.filter(mask)
+
+
+def query(store_dir, bbox=None, start=None, end=None, labels=None, min_score=None, sites=None, columns=None):
+    """Birds matching every given condition, read from the matching row groups only
+
+    bbox is (minx, miny, maxx, maxy) in the CRS of the predictions and
+    matches birds whose bounds intersect it. start and end are inclusive
+    dates or ISO date strings, labels and sites are lists and min_score is
+    the lowest score kept. columns limits the attribute columns returned.
+    """
+    start, end = to_date(start), to_date(end)
+    plan = plan_query(store_dir, bbox, start, end, labels, min_score, sites)
+    read_columns = None
+    if columns is not None:
+        filter_columns = BOUNDS_COLUMNS + [DATE_COLUMN, "label", "score", "geometry"]
+        read_columns = list(dict.fromkeys(list(columns) + filter_columns))
+
+    frames = []
+    for path, partition in plan.items():
+        table = pq.ParquetFile(path).read_row_groups(partition["row_groups"], columns=read_columns)
+        table = row_filter(table, bbox, start, end, labels, min_score)
+        geometry = gpd.GeoSeries.from_wkb(table["geometry"].to_numpy(), crs=partition["crs"])
+        frames.append(gpd.GeoDataFrame(table.drop(["geometry"]).to_pandas(), geometry=geometry))
+    if not frames:
+        return gpd.GeoDataFrame(columns=(columns or []) + ["geometry"], geometry="geometry")
+    result = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=frames[0].crs)
+    if columns is not None:
+        result = result[list(columns) + ["geometry"]]
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or query the store of all bird predictions")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Update the store from the combined site-year predictions")
+    build_parser.add_argument("paths", nargs="+", help="Combined bird prediction files for each site-year")
+    query_parser = subparsers.add_parser("query", help="Write the birds matching a query to a file")
+    query_parser.add_argument("--bbox", type=float, nargs=4, metavar=("MINX", "MINY", "MAXX", "MAXY"))
+    query_parser.add_argument("--start", help="First flight date (YYYY-MM-DD)")
+    query_parser.add_argument("--end", help="Last flight date (YYYY-MM-DD)")
+    query_parser.add_argument("--label", action="append", dest="labels", help="Species label, may be repeated")
+    query_parser.add_argument("--site", action="append", dest="sites", help="Site, may be repeated")
+    query_parser.add_argument("--min-score", type=float)
+    query_parser.add_argument("--output", help="Write the birds to this .shp or .parquet file")
+    parser.add_argument("--store-dir", help="Store directory (default published/prediction_store)")
+    args = parser.parse_args()
+
+    store_dir = args.store_dir or os.path.join(tools.get_working_dir(), "published", "prediction_store")
+    if args.command == "build":
+        instrument.start_job("build_prediction_store")
+        with instrument.step("update"):
+            rebuilt = update_store(args.paths, store_dir)
+            instrument.count("partitions_rebuilt", len(rebuilt))
+    else:
+        birds = query(store_dir, args.bbox, args.start, args.end, args.labels, args.min_score, args.sites)
+        print(f"{len(birds)} birds match")
+        if args.output:
+            tools.write_geodataframe(birds, args.output)
@@ -1,47 +1,91 @@
+import argparse
 import geopandas
 import pandas as pd
 import sys
 import os
+import instrument
 import tools
 
 
-def count_max_consec_detects(nest_data, date_data):
-    """Determine the maximum number of consecutive bird detections"""
-    assert date_data.shape[0] == 1, "date_data should be a Pandas DataFrame with one row"
-    sorted_dates = pd.Series(date_data.Date[0]).sort_values().reset_index(drop=True)
-    sorted_nest_dates = pd.Series(nest_data.Date).sort_values().reset_index(drop=True)
-    sorted_dates_dict = {val: key for key, val in sorted_dates.items()}
-    sorted_dates_combined_diff = sorted_nest_dates.map(sorted_dates_dict).diff()
-    all_consec_detects = []
-    consec_detects = 0
-    for i in range(1, len(sorted_dates_combined_diff)):
-        if sorted_dates_combined_diff[i] == 1 and sorted_dates_combined_diff[i - 1] != 1:
-            # New start to consectutive detection set
-            consec_detects = 1
-            if i + 1 == len(sorted_dates_combined_diff):
-                all_consec_detects.append(consec_detects)
-        elif sorted_dates_combined_diff[i] == 1 and sorted_dates_combined_diff[i - 1] == 1:
-            # Increment existing consecutive detection set
-            consec_detects += 1
-            if i + 1 == len(sorted_dates_combined_diff):
-                all_consec_detects.append(consec_detects)
-        elif sorted_dates_combined_diff[i] != 1 and sorted_dates_combined_diff[i - 1] == 1:
-            # Store completed consecutive detection set and reset
-            all_consec_detects.append(consec_detects)
-            consec_detects = 0
-        elif sorted_dates_combined_diff[i] != 1 and sorted_dates_combined_diff[i - 1] != 1:
-            consec_detects == 0
-        else:
-            assert False, "Oops, I shouldn't be here"
-    if all_consec_detects:
-        max_consec_detects = max(all_consec_detects)
-    else:
-        max_consec_detects = 0
-
-    return max_consec_detects
-
-
-def process_nests(nest_file, year, site, savedir, min_score=0.3, min_detections=3, min_consec_detects=1):
+def count_max_consec_detects(nests_data, dates):
+    """Determine the maximum number of consecutive bird detections for each nest
+
+    nests_data needs target_ind and Date columns. dates holds every survey date
+    for the site-year, so consecutive detections are detections on neighbouring
+    surveys rather than neighbouring calendar days. Returns a Series indexed by
+    target_ind with the length of the longest run of consecutive detections
+    (a nest seen on three surveys in a row has two consecutive detections).
+    """
+    date_ordinal = {date: i for i, date in enumerate(sorted(dates))}
+    detections = pd.DataFrame({
+        "target_ind": nests_data["target_ind"].to_numpy(),
+        "ordinal": nests_data["Date"].map(date_ordinal).to_numpy(),
+    }).sort_values(["target_ind", "ordinal"], kind="stable")
+
+    # A detection continues a run when it is on the survey right after the previous detection of the same nest
+    same_nest = detections["target_ind"].eq(detections["target_ind"].shift())
+    consecutive = same_nest & detections["ordinal"].diff().eq(1)
+    run_id = (~consecutive).cumsum()
+    run_length = consecutive.groupby(run_id).transform("sum")
+    return run_length.groupby(detections["target_ind"]).max()
+
+
+def summarize_nests(nests_data, min_score=0.3, min_detections=3, min_consec_detects=1):
+    """Summary of each nest kept by the thresholds, indexed by target_ind in order of first appearance
+
+    Detections below min_score are dropped and a nest is kept when it has at
+    least min_detections detections or min_consec_detects consecutive ones.
+    The label column is the species with the highest summed score.
+    """
+    # Nests are reported in the order they first appear in the file
+    nest_order = pd.unique(nests_data["target_ind"])
+    dates = nests_data["Date"].unique()
+    nest_data = nests_data[nests_data["score"] >= min_score]
+
+    grouped = nest_data.groupby("target_ind", sort=False)
+    nest_info = grouped.agg(
+        Site=("Site", "first"),
+        Year=("Year", "first"),
+        first_obs=("Date", "min"),
+        last_obs=("Date", "max"),
+        num_obs=("Date", "count"),
+        match_xmin=("match_xmin", "mean"),
+        match_ymin=("match_ymin", "mean"),
+        match_xmax=("match_xmax", "mean"),
+        match_ymax=("match_ymax", "mean"),
+    )
+    bird_ids = nest_data["bird_id"].astype(str)
+    nest_info["bird_match"] = bird_ids.groupby(nest_data["target_ind"], sort=False).agg(",".join)
+    nest_info["num_consec_detects"] = count_max_consec_detects(nest_data, dates)
+
+    # Aggregate scores per label and pick the top label by summed score
+    summed_scores = nest_data.groupby(["target_ind", "label"]).score.agg(["sum", "count"]).reset_index()
+    top_score_data = summed_scores.sort_values(["target_ind", "sum", "label"],
+                                               ascending=[True, False, True],
+                                               kind="stable").drop_duplicates("target_ind").set_index("target_ind")
+    nest_info = nest_info.join(top_score_data)
+
+    keep = (nest_info["num_obs"] >= min_detections) | (nest_info["num_consec_detects"] >= min_consec_detects)
+    nest_info = nest_info[keep]
+    nest_info = nest_info.reindex([x for x in nest_order if x in nest_info.index])
+
+    return nest_info
+
+
+NEST_COLUMNS = [
+    "target_ind", "Site", "Year", "Date", "label", "score", "bird_id", "match_xmin", "match_ymin", "match_xmax",
+    "match_ymax"
+]
+
+
+def process_nests(nest_file,
+                  year,
+                  site,
+                  savedir,
+                  min_score=0.3,
+                  min_detections=3,
+                  min_consec_detects=1,
+                  output_format="shp"):
     """Process nests into a one-row-per-nest table"""
     SCHEMA = {
         "geometry": "Point",
@@ -61,7 +105,9 @@ def process_nests(nest_file, year, site, savedir, min_score=0.3, min_detections=
         },
     }
 
-    nests_data = geopandas.read_file(nest_file)
+    with instrument.step("read"):
+        nests_data = tools.read_geodataframe(nest_file, columns=NEST_COLUMNS)
+        instrument.count("detections", len(nests_data))
 
     # Convert numeric columns to correct types if they're strings
     # (shapefiles sometimes read them as strings)
@@ -73,52 +119,28 @@ def process_nests(nest_file, year, site, savedir, min_score=0.3, min_detections=
     if cols_to_convert:
         nests_data[cols_to_convert] = nests_data[cols_to_convert].apply(pd.to_numeric, errors='coerce')
 
-    # Build date_data: single row with all dates for the site-year
-    date_data = nests_data.groupby(['Site', 'Year']).agg({'Date': lambda x: x.unique().tolist()}).reset_index()
-    target_inds = nests_data['target_ind'].unique()
-    nests_rows = []
-
-    for target_ind in target_inds:
-        nest_data = nests_data[(nests_data["target_ind"] == target_ind) & (nests_data["score"] >= min_score)]
-        num_consec_detects = count_max_consec_detects(nest_data, date_data)
-
-        if len(nest_data) >= min_detections or num_consec_detects >= min_consec_detects:
-            # Aggregate scores per label and pick the top label by summed score
-            summed_scores = nest_data.groupby(['Site', 'Year', 'target_ind', 'label']).score.agg(['sum', 'count'])
-            top_score_data = summed_scores[summed_scores['sum'] == max(summed_scores['sum'])].reset_index()
-
-            nest_info = nest_data.groupby(['Site', 'Year', 'target_ind']).agg({
-                'Date': ['min', 'max', 'count'],
-                'match_xmin': ['mean'],
-                'match_ymin': ['mean'],
-                'match_xmax': ['mean'],
-                'match_ymax': ['mean']
-            }).reset_index()
-
-            xmean = (nest_info['match_xmin']['mean'][0] + nest_info['match_xmax']['mean'][0]) / 2
-            ymean = (nest_info['match_ymin']['mean'][0] + nest_info['match_ymax']['mean'][0]) / 2
-
-            nests_rows.append([
-                int(target_ind),
-                str(nest_info['Site'][0]),
-                str(nest_info['Year'][0]),
-                float(xmean),
-                float(ymean),
-                str(nest_info['Date']['min'][0]),
-                str(nest_info['Date']['max'][0]),
-                int(nest_info['Date']['count'][0]),
-                str(top_score_data['label'][0]),
-                float(top_score_data['sum'][0]),
-                int(top_score_data['count'][0]),
-                ",".join(str(x) for x in nest_data["bird_id"]),
-            ])
+    nest_info = summarize_nests(nests_data, min_score, min_detections, min_consec_detects)
+
+    nests_df = pd.DataFrame({
+        "nest_id": nest_info.index.to_numpy().astype("int64"),
+        "Site": nest_info["Site"].astype(str).to_numpy(),
+        "Year": nest_info["Year"].astype(str).to_numpy(),
+        "xmean": ((nest_info["match_xmin"] + nest_info["match_xmax"]) / 2).to_numpy(dtype="float64"),
+        "ymean": ((nest_info["match_ymin"] + nest_info["match_ymax"]) / 2).to_numpy(dtype="float64"),
+        "first_obs": nest_info["first_obs"].astype(str).to_numpy(),
+        "last_obs": nest_info["last_obs"].astype(str).to_numpy(),
+        "num_obs": nest_info["num_obs"].to_numpy(dtype="int64"),
+        "species": nest_info["label"].astype(str).to_numpy(),
+        "sum_top1": nest_info["sum"].to_numpy(dtype="float64"),
+        "num_top1": nest_info["count"].to_numpy(dtype="int64"),
+        "bird_match": nest_info["bird_match"].to_numpy(),
+    })
 
     os.makedirs(savedir, exist_ok=True)
-    filename = os.path.join(savedir, f"{site}_{year}_processed_nests.shp")
+    filename = os.path.join(savedir, f"{site}_{year}_processed_nests.{output_format}")
 
     gdf_tofile = None
-    if nests_rows:
-        nests_df = pd.DataFrame(nests_rows, columns=list(SCHEMA["properties"].keys()))
+    if not nests_df.empty:
         nests_gdf = geopandas.GeoDataFrame(
             nests_df,
             geometry=geopandas.points_from_xy(nests_df.xmean, nests_df.ymean),
@@ -137,18 +159,22 @@ def process_nests(nest_file, year, site, savedir, min_score=0.3, min_detections=
         )
         gdf_tofile = empty_gdf
 
-    try:
-        import pyogrio
-        gdf_tofile.to_file(filename, driver="ESRI Shapefile", engine="pyogrio")
-    except ImportError:
-        gdf_tofile.to_file(filename, driver="ESRI Shapefile", engine="fiona")
+    with instrument.step("write"):
+        tools.write_geodataframe(gdf_tofile, filename)
+        instrument.count("nests", len(gdf_tofile))
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise detected nests into one row per nest")
+    parser.add_argument("path", help="Detected nests for a site-year")
+    parser.add_argument("--format", default="shp", choices=tools.INTERMEDIATE_FORMATS, help="Output file format")
+    args = parser.parse_args()
+
     working_dir = tools.get_working_dir()
-    path = sys.argv[1]
+    path = args.path
     split_path = os.path.normpath(path).split(os.path.sep)
     year = split_path[5]
     site = split_path[6]
     nestdir = os.path.join(working_dir, "processed_nests", year, site)
-    process_nests(path, year, site, savedir=nestdir)
+    instrument.start_job("process_nests", site=site, year=year)
+    process_nests(path, year, site, savedir=nestdir, output_format=args.format)
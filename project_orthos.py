@@ -1,65 +1,322 @@
 #!/usr/bin/env python3
+import argparse
+import multiprocessing
 import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from osgeo import gdal
+import instrument
 import tools
 
 gdal.UseExceptions()
 gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
 
+# Creation options for the projected mosaics
+GTIFF_OPTIONS = ['TILED=YES', 'COMPRESS=LZW', 'PREDICTOR=2', 'BIGTIFF=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512']
+# Cloud-optimized GeoTIFF with internal overviews built once during projection
+COG_OPTIONS = [
+    'COMPRESS=LZW', 'PREDICTOR=YES', 'BIGTIFF=YES', 'BLOCKSIZE=512', 'OVERVIEWS=AUTO', 'OVERVIEW_RESAMPLING=AVERAGE',
+    'NUM_THREADS=ALL_CPUS'
+]
 
-def project_raster(path, year, site, dst_crs, savedir, nodata_value=255):
+# Temporary strips written by the tiled reprojection
+STRIP_OPTIONS = ['TILED=YES', 'COMPRESS=LZW', 'PREDICTOR=2', 'BIGTIFF=IF_SAFER', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512']
+
+# Projections written for every orthomosaic: (EPSG code, output directory under the working directory)
+PROJECTIONS = [(32617, "projected_mosaics"), (3857, os.path.join("projected_mosaics", "webmercator"))]
+
+
+def build_source_vrt(path, nodata_value=255):
+    """Build a VRT of bands 1-3 of an orthomosaic with the same nodata in every band"""
+    with instrument.step("build_vrt"):
+        translate_opts = gdal.TranslateOptions(format='VRT', bandList=[1, 2, 3])
+        src_vrt = gdal.Translate('', path, options=translate_opts)
+        for i in range(1, 4):
+            src_vrt.GetRasterBand(i).SetNoDataValue(nodata_value)
+    return src_vrt
+
+
+def destination_name(path, year, site, savedir):
+    """Projected file name for the orthomosaic at path, creating its directory"""
     dest_path = os.path.join(savedir, year, site)
     os.makedirs(dest_path, exist_ok=True)
-
     basename = os.path.basename(os.path.splitext(path)[0])
-    dest_name = os.path.join(dest_path, basename + "_projected.tif")
+    return os.path.join(dest_path, basename + "_projected.tif")
+
+
+def warp_options(dst_crs, nodata_value=255, multithread=True, **kwargs):
+    """gdal.WarpOptions from the EPSG:4326 orthomosaics into dst_crs; kwargs are passed on"""
+    return gdal.WarpOptions(srcSRS='EPSG:4326',
+                            dstSRS=f'EPSG:{dst_crs}',
+                            resampleAlg='bilinear',
+                            multithread=multithread,
+                            srcNodata=nodata_value,
+                            dstNodata=nodata_value,
+                            warpOptions=['INIT_DEST=NO_DATA', 'UNIFIED_SRC_NODATA=YES'],
+                            **kwargs)
+
 
+def warp_source(src, path, year, site, dst_crs, savedir, nodata_value=255, warp_memory_mb=None, cog=False):
+    """Warp an opened source raster for the orthomosaic at path into dst_crs
+
+    With cog=True the output is a cloud-optimized GeoTIFF with internal
+    overviews, otherwise a tiled GeoTIFF without overviews.
+    """
+    dest_name = destination_name(path, year, site, savedir)
     if os.path.exists(dest_name):
         gdal.Unlink(dest_name)
-    # Build VRT with bands 1–3
-    translate_opts = gdal.TranslateOptions(format='VRT', bandList=[1, 2, 3])
-    src_vrt = gdal.Translate('', path, options=translate_opts)
-    # Force the same nodata in every band of the VRT
-    for i in range(1, 4):
-        src_vrt.GetRasterBand(i).SetNoDataValue(nodata_value)
-    warp_opts = gdal.WarpOptions(
-        srcSRS='EPSG:4326',
-        dstSRS=f'EPSG:{dst_crs}',
-        resampleAlg='bilinear',
-        multithread=True,
-        srcNodata=nodata_value,
-        dstNodata=nodata_value,
-        warpOptions=['INIT_DEST=NO_DATA', 'UNIFIED_SRC_NODATA=YES'],
-        creationOptions=['TILED=YES', 'COMPRESS=LZW', 'PREDICTOR=2', 'BIGTIFF=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512'])
+    warp_kwargs = {}
+    if warp_memory_mb is not None:
+        warp_kwargs["warpMemoryLimit"] = warp_memory_mb
+    warp_opts = warp_options(dst_crs,
+                             nodata_value,
+                             format='COG' if cog else 'GTiff',
+                             creationOptions=COG_OPTIONS if cog else GTIFF_OPTIONS,
+                             **warp_kwargs)
     print(f"Processing {path} -> {dest_name}")
-    ds = gdal.Warp(dest_name, src_vrt, options=warp_opts)
+    with instrument.step(f"warp_{dst_crs}"):
+        ds = gdal.Warp(dest_name, src, options=warp_opts)
+        if ds is None:
+            raise RuntimeError(f"GDAL Warp failed for {path} -> {dest_name}")
+        ds = None
+    return dest_name
+
+
+def project_raster(path, year, site, dst_crs, savedir, nodata_value=255, cog=False):
+    src_vrt = build_source_vrt(path, nodata_value)
+    dest_name = warp_source(src_vrt, path, year, site, dst_crs, savedir, nodata_value, cog=cog)
+    src_vrt = None
+    return dest_name
+
+
+def project_raster_once(path,
+                        year,
+                        site,
+                        targets,
+                        nodata_value=255,
+                        memory_cap_mb=16000,
+                        cache_mb=512,
+                        tmpdir=None,
+                        cog=False):
+    """Project an orthomosaic into several projections while decoding it only once
+
+    targets is a list of (dst_crs, savedir) pairs. Bands 1-3 of the source are
+    decoded once into an uncompressed tiled GeoTIFF that every warp reads from.
+    memory_cap_mb bounds the GDAL memory of the whole run: each warp gets a
+    quarter of it as warp buffer (at most 2048 MB) and the block cache is
+    limited to cache_mb (at most another quarter). The decoded copy is kept in
+    memory when it fits in what is left and is written to a temporary file in
+    tmpdir otherwise. Returns the projected file names.
+    """
+    warp_memory_mb = min(2048, memory_cap_mb // 4)
+    cache_mb = min(cache_mb, memory_cap_mb // 4)
+    gdal.SetCacheMax(cache_mb * 1024**2)
+    src_vrt = build_source_vrt(path, nodata_value)
+    decoded_mb = src_vrt.RasterXSize * src_vrt.RasterYSize * 3 / 1024**2
+    basename = os.path.basename(os.path.splitext(path)[0])
+
+    tmp_handle = None
+    if decoded_mb <= memory_cap_mb - warp_memory_mb - cache_mb:
+        decoded_path = f"/vsimem/{basename}_decoded.tif"
+    else:
+        if tmpdir is not None:
+            os.makedirs(tmpdir, exist_ok=True)
+        tmp_handle = tempfile.TemporaryDirectory(dir=tmpdir)
+        decoded_path = os.path.join(tmp_handle.name, f"{basename}_decoded.tif")
+    print(f"Decoding {path} ({decoded_mb:.0f} MB) -> {decoded_path}")
+
+    try:
+        decode_opts = gdal.TranslateOptions(
+            format='GTiff',
+            creationOptions=['TILED=YES', 'COMPRESS=NONE', 'BIGTIFF=IF_SAFER', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512'])
+        with instrument.step("decode"):
+            decoded = gdal.Translate(decoded_path, src_vrt, options=decode_opts)
+            if decoded is None:
+                raise RuntimeError(f"GDAL Translate failed for {path} -> {decoded_path}")
+        src_vrt = None
+
+        outputs = []
+        for dst_crs, savedir in targets:
+            outputs.append(
+                warp_source(decoded,
+                            path,
+                            year,
+                            site,
+                            dst_crs,
+                            savedir,
+                            nodata_value,
+                            warp_memory_mb=warp_memory_mb,
+                            cog=cog))
+        decoded = None
+    finally:
+        if tmp_handle is None:
+            if gdal.VSIStatL(decoded_path) is not None:
+                gdal.Unlink(decoded_path)
+        else:
+            tmp_handle.cleanup()
+    return outputs
+
+
+def plan_strips(height, strip_rows=4096):
+    """Split height destination rows into (row offset, rows) strips of at most strip_rows rows"""
+    if strip_rows < 1:
+        raise ValueError(f"strip_rows must be positive, got {strip_rows}")
+    return [(row_off, min(strip_rows, height - row_off)) for row_off in range(0, height, strip_rows)]
+
+
+def strip_bounds(geotransform, width, row_off, rows):
+    """(minx, miny, maxx, maxy) of rows row_off to row_off + rows of a north-up grid"""
+    x0, dx, _, y0, _, dy = geotransform
+    return (x0, y0 + (row_off + rows) * dy, x0 + width * dx, y0 + row_off * dy)
+
+
+def _warp_strip(path, strip_path, dst_crs, bounds, width, rows, nodata_value, warp_memory_mb, cache_mb):
+    """Warp one strip of the destination grid in a worker process"""
+    gdal.UseExceptions()
+    gdal.SetConfigOption('GDAL_NUM_THREADS', '1')
+    gdal.SetCacheMax(cache_mb * 1024**2)
+    src_vrt = build_source_vrt(path, nodata_value)
+    warp_opts = warp_options(dst_crs,
+                             nodata_value,
+                             multithread=False,
+                             format='GTiff',
+                             creationOptions=STRIP_OPTIONS,
+                             outputBounds=bounds,
+                             width=width,
+                             height=rows,
+                             warpMemoryLimit=warp_memory_mb)
+    ds = gdal.Warp(strip_path, src_vrt, options=warp_opts)
     if ds is None:
-        raise RuntimeError(f"GDAL Warp failed for {path} -> {dest_name}")
+        raise RuntimeError(f"GDAL Warp failed for {path} -> {strip_path}")
     ds = None
     src_vrt = None
+    return strip_path
+
+
+def project_raster_tiled(path,
+                         year,
+                         site,
+                         dst_crs,
+                         savedir,
+                         nodata_value=255,
+                         workers=4,
+                         strip_rows=4096,
+                         warp_memory_mb=1024,
+                         cache_mb=256,
+                         tmpdir=None,
+                         cog=False):
+    """Project an orthomosaic by warping strips of the destination grid in parallel processes
+
+    The destination grid is the one a single gdal.Warp would produce. It is
+    split into strips of strip_rows rows that workers warp into temporary
+    GeoTIFFs in tmpdir, each with at most warp_memory_mb of warp buffer and
+    cache_mb of block cache. The strips are then mosaicked through a VRT into
+    the final GeoTIFF, which GDAL copies block by block.
+    """
+    dest_name = destination_name(path, year, site, savedir)
+    src_vrt = build_source_vrt(path, nodata_value)
+    grid = gdal.Warp('', src_vrt, options=warp_options(dst_crs, nodata_value, format='VRT'))
+    width, height, geotransform = grid.RasterXSize, grid.RasterYSize, grid.GetGeoTransform()
+    grid = None
+    src_vrt = None
+
+    strips = plan_strips(height, strip_rows)
+    print(f"Processing {path} -> {dest_name} ({width} x {height} pixels in {len(strips)} strips, {workers} workers)")
+    if tmpdir is not None:
+        os.makedirs(tmpdir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=tmpdir) as strip_dir:
+        with instrument.step(f"warp_strips_{dst_crs}"):
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                futures = [
+                    executor.submit(_warp_strip, path, os.path.join(strip_dir, f"strip_{i:05d}.tif"), dst_crs,
+                                    strip_bounds(geotransform, width, row_off, rows), width, rows, nodata_value,
+                                    warp_memory_mb, cache_mb) for i, (row_off, rows) in enumerate(strips)
+                ]
+                strip_paths = [future.result() for future in futures]
+            instrument.count("strips", len(strip_paths))
+
+        with instrument.step(f"assemble_{dst_crs}"):
+            mosaic = gdal.BuildVRT(os.path.join(strip_dir, "strips.vrt"), strip_paths)
+            if os.path.exists(dest_name):
+                gdal.Unlink(dest_name)
+            translate_opts = gdal.TranslateOptions(format='COG' if cog else 'GTiff',
+                                                   creationOptions=COG_OPTIONS if cog else GTIFF_OPTIONS +
+                                                   ['NUM_THREADS=ALL_CPUS'])
+            ds = gdal.Translate(dest_name, mosaic, options=translate_opts)
+            if ds is None:
+                raise RuntimeError(f"GDAL Translate failed for {path} -> {dest_name}")
+            ds = None
+            mosaic = None
     return dest_name
 
 
 if __name__ == "__main__":
-    path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Project an orthomosaic to UTM and web mercator")
+    parser.add_argument("path", help="Orthomosaic")
+    parser.add_argument("--single-read",
+                        action="store_true",
+                        help="Decode the orthomosaic once and produce both projections from the decoded copy")
+    parser.add_argument("--memory-cap-mb",
+                        type=int,
+                        default=16000,
+                        help="With --single-read, GDAL memory for the decoded copy, warp buffer and block cache")
+    parser.add_argument("--tmpdir", help="Directory for warped strips and decoded copies (default system temp)")
+    parser.add_argument("--cog", action="store_true", help="Write cloud-optimized GeoTIFFs with internal overviews")
+    parser.add_argument("--crs",
+                        type=int,
+                        action="append",
+                        choices=[dst_crs for dst_crs, _ in PROJECTIONS],
+                        help="Only write this projection, may be repeated (default all)")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=0,
+                        help="Warp strips of each projection in this many processes (0 warps in one process)")
+    parser.add_argument("--warp-memory-mb", type=int, default=1024, help="With --workers, warp buffer per worker")
+    parser.add_argument("--strip-rows",
+                        type=int,
+                        default=4096,
+                        help="With --workers, destination rows per strip (a multiple of 512)")
+    args = parser.parse_args()
+
+    path = args.path
     split_path = os.path.normpath(path).split(os.path.sep)
     year = split_path[5]
     site = split_path[6]
     working_dir = tools.get_working_dir()
+    targets = [(dst_crs, os.path.join(working_dir, subdir))
+               for dst_crs, subdir in PROJECTIONS
+               if args.crs is None or dst_crs in args.crs]
+    instrument.start_job("project_mosaics", **tools.flight_labels(path))
 
-    out1 = project_raster(path,
-                          year,
-                          site,
-                          dst_crs=32617,
-                          savedir=f"{working_dir}/projected_mosaics/",
-                          nodata_value=255)
-    print(f"Wrote: {out1}")
-
-    out2 = project_raster(path,
-                          year,
-                          site,
-                          dst_crs=3857,
-                          savedir=f"{working_dir}/projected_mosaics/webmercator/",
-                          nodata_value=255)
-    print(f"Wrote: {out2}")
+    if args.workers > 0:
+        outputs = [
+            project_raster_tiled(path,
+                                 year,
+                                 site,
+                                 dst_crs=dst_crs,
+                                 savedir=savedir,
+                                 nodata_value=255,
+                                 workers=args.workers,
+                                 strip_rows=args.strip_rows,
+                                 warp_memory_mb=args.warp_memory_mb,
+                                 tmpdir=args.tmpdir,
+                                 cog=args.cog) for dst_crs, savedir in targets
+        ]
+    elif args.single_read:
+        outputs = project_raster_once(path,
+                                      year,
+                                      site,
+                                      targets,
+                                      nodata_value=255,
+                                      memory_cap_mb=args.memory_cap_mb,
+                                      tmpdir=args.tmpdir,
+                                      cog=args.cog)
+    else:
+        outputs = [
+            project_raster(path, year, site, dst_crs=dst_crs, savedir=savedir, nodata_value=255, cog=args.cog)
+            for dst_crs, savedir in targets
+        ]
+    for output in outputs:
+        print(f"Wrote: {output}")
@@ -0,0 +1,327 @@
+import contextlib
+import math
+import queue
+import threading
+import time
+import warnings
+
+import geopandas
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from rasterio.enums import Resampling
+from rasterio.errors import NodataShadowWarning
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+# Downsampling factor for the valid data mask used to skip nodata windows
+MASK_SCALE = 16
+
+# Intersection over the smaller box above which boxes from neighbouring windows are the same bird
+DUPLICATE_THRESHOLD = 0.5
+
+# CRS of the projected mosaics that birds are predicted on
+PREDICTION_CRS = "EPSG:32617"
+
+
+def warped_view(src, dst_crs=PREDICTION_CRS, nodata=255):
+    """Virtual view of an EPSG:4326 orthomosaic warped into dst_crs
+
+    Uses the settings of project_orthos.warp_source (bilinear resampling and
+    255 as source and destination nodata), so windows read from the view
+    match the projected mosaic without writing it.
+    """
+    return WarpedVRT(src,
+                     src_crs="EPSG:4326",
+                     crs=dst_crs,
+                     resampling=Resampling.bilinear,
+                     src_nodata=nodata,
+                     nodata=nodata,
+                     init_dest_nodata=True,
+                     warp_extras={"UNIFIED_SRC_NODATA": "YES"})
+
+
+@contextlib.contextmanager
+def open_raster(path, virtual=False):
+    """Open a projected mosaic, or with virtual=True a warped view of an orthomosaic"""
+    with rasterio.open(path) as src:
+        if not virtual:
+            yield src
+            return
+        with warped_view(src) as vrt:
+            yield vrt
+
+
+def window_offsets(length, patch_size, stride):
+    """Start offsets of windows of patch_size pixels every stride pixels, the last one cut at length"""
+    offsets = list(range(0, max(length - patch_size, 0) + 1, stride))
+    if offsets[-1] + patch_size < length:
+        offsets.append(offsets[-1] + stride)
+    return offsets
+
+
+def tile_windows(width, height, patch_size=1500, overlap=0.0):
+    """Split a raster into windows of at most patch_size pixels
+
+    Neighbouring windows overlap by overlap_pixels(patch_size, overlap)
+    pixels, so with overlap=0 the windows do not overlap.
+    """
+    stride = patch_size - overlap_pixels(patch_size, overlap)
+    return [
+        Window(col_off, row_off, min(patch_size, width - col_off), min(patch_size, height - row_off))
+        for row_off in window_offsets(height, patch_size, stride)
+        for col_off in window_offsets(width, patch_size, stride)
+    ]
+
+
+def overlap_pixels(patch_size, overlap):
+    """Width in pixels of the strip shared by neighbouring windows, for overlap as a fraction of patch_size"""
+    if not 0 <= overlap < 1:
+        raise ValueError(f"overlap must be at least 0 and less than 1, got {overlap}")
+    return int(patch_size * overlap)
+
+
+def read_window(src, window):
+    """Read the RGB bands of a window as a channels-last float32 array"""
+    return src.read(indexes=[1, 2, 3], window=window).transpose(1, 2, 0).astype("float32")
+
+
+def queue_depth(windows, max_queued_mb, batch_size=1):
+    """Number of windows that can be read ahead with max_queued_mb of decoded float32 RGB windows
+
+    The consumer holds up to batch_size - 1 earlier windows while it fills a
+    batch, so those count against max_queued_mb too. At least one window is
+    read ahead, so a budget smaller than a batch still makes progress.
+    """
+    window_mb = max(window.width * window.height for window in windows) * 3 * 4 / 1024**2
+    return max(1, int(max_queued_mb // window_mb) - (batch_size - 1))
+
+
+def prefetch_windows(path, windows, virtual=False, workers=2, max_queued_mb=1024, batch_size=1, stats=None):
+    """Read and decode windows on background threads, yielding (window, image) pairs in order
+
+    Each thread reads through its own dataset opened with open_raster, and
+    GDAL releases the GIL while decoding, so reads overlap with each other and
+    with the consumer. Reads stay at most queue_depth windows ahead of the
+    consumer, which collects batch_size windows per batch. When stats is a dict, the seconds the consumer waited for a
+    window (wait_seconds) and spent reading (read_seconds) are added to it.
+    """
+    if not windows:
+        return
+    stats = {} if stats is None else stats
+    stats.setdefault("wait_seconds", 0.0)
+    stats.setdefault("read_seconds", 0.0)
+    tasks = queue.Queue()
+    results = {}
+    ready = threading.Condition()
+    stop = threading.Event()
+
+    def reader():
+        # Datasets are opened and closed in the thread that reads them, as rasterio requires
+        try:
+            with open_raster(path, virtual) as src:
+                while True:
+                    i = tasks.get()
+                    if i is None or stop.is_set():
+                        return
+                    start = time.perf_counter()
+                    image = read_window(src, windows[i])
+                    with ready:
+                        stats["read_seconds"] += time.perf_counter() - start
+                        results[i] = image
+                        ready.notify_all()
+        except Exception as e:
+            with ready:
+                results[-1] = e
+                ready.notify_all()
+
+    threads = [threading.Thread(target=reader, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    depth = queue_depth(windows, max_queued_mb, batch_size)
+    issued = 0
+    try:
+        for i, window in enumerate(windows):
+            while issued < min(len(windows), i + depth):
+                tasks.put(issued)
+                issued += 1
+            start = time.perf_counter()
+            with ready:
+                ready.wait_for(lambda: i in results or -1 in results)
+                if -1 in results:
+                    raise results[-1]
+                image = results.pop(i)
+            stats["wait_seconds"] += time.perf_counter() - start
+            yield window, image
+    finally:
+        stop.set()
+        for _ in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+def valid_data_mask(src, scale=MASK_SCALE):
+    """Low resolution boolean mask of the pixels that are not nodata
+
+    The mask is read at 1/scale of the raster size, so GDAL can use overviews
+    when the raster has them instead of decoding every full resolution block.
+    """
+    out_shape = (max(1, math.ceil(src.height / scale)), max(1, math.ceil(src.width / scale)))
+    with warnings.catch_warnings():
+        # Warped views of the orthomosaics mask by nodata, like the projected mosaics, not by alpha
+        warnings.simplefilter("ignore", NodataShadowWarning)
+        return src.dataset_mask(out_shape=out_shape) > 0
+
+
+def window_valid_fraction(mask, window, height, width):
+    """Fraction of valid mask pixels under a window of a height x width raster
+
+    The window is padded by one mask pixel on every side so valid pixels that
+    fall between mask samples at the window edge are not missed.
+    """
+    scale_y = height / mask.shape[0]
+    scale_x = width / mask.shape[1]
+    row_start = max(0, math.floor(window.row_off / scale_y) - 1)
+    row_stop = math.ceil((window.row_off + window.height) / scale_y) + 1
+    col_start = max(0, math.floor(window.col_off / scale_x) - 1)
+    col_stop = math.ceil((window.col_off + window.width) / scale_x) + 1
+    return float(np.mean(mask[row_start:row_stop, col_start:col_stop]))
+
+
+def skip_nodata_windows(src, windows, min_valid_fraction=0.0):
+    """Drop windows that have no valid pixels or less than min_valid_fraction valid pixels
+
+    Returns the windows to keep and the number of windows skipped.
+    """
+    mask = valid_data_mask(src)
+    keep = []
+    for window in windows:
+        valid_fraction = window_valid_fraction(mask, window, src.height, src.width)
+        if valid_fraction > 0 and valid_fraction >= min_valid_fraction:
+            keep.append(window)
+    return keep, len(windows) - len(keep)
+
+
+def preview_shape(src, max_size=1024):
+    """Shape (rows, cols) of a whole-raster read at most max_size pixels on its longest side"""
+    scale = max(src.width, src.height) / max_size
+    if scale <= 1:
+        return src.height, src.width
+    return max(1, round(src.height / scale)), max(1, round(src.width / scale))
+
+
+def read_preview(src, max_size=1024):
+    """Read a reduced resolution RGB preview of the whole raster as a channels-last uint8 array
+
+    Reads at a reduced shape are served by GDAL from the closest internal
+    overview when the raster has them (e.g. COG output from project_orthos),
+    so only a small fraction of the full resolution data is decoded.
+    """
+    out_shape = (3,) + preview_shape(src, max_size)
+    return src.read(indexes=[1, 2, 3], out_shape=out_shape).transpose(1, 2, 0)
+
+
+def georeference_boxes(boxes, transform, crs):
+    """Convert boxes in raster pixel coordinates into a GeoDataFrame in the raster's coordinates
+
+    The box corners are mapped through the raster's affine transform at pixel
+    centers, like rasterio.transform.xy(offset="center") in DeepForest's
+    image_to_geo_coordinates, for all boxes at once. The xmin, ymin, xmax
+    and ymax columns are set to the bounds of the new geometry.
+    """
+    a, b, c, d, e, f = transform[:6]
+    cols = boxes[["xmin", "xmax"]].to_numpy(dtype="float64") + 0.5
+    rows = boxes[["ymin", "ymax"]].to_numpy(dtype="float64") + 0.5
+    x = a * cols + b * rows + c
+    y = d * cols + e * rows + f
+    bounds = {"xmin": x.min(axis=1), "ymin": y.min(axis=1), "xmax": x.max(axis=1), "ymax": y.max(axis=1)}
+    projected = boxes.drop(columns="geometry", errors="ignore").assign(**bounds)
+    geometry = shapely.box(bounds["xmin"], bounds["ymin"], bounds["xmax"], bounds["ymax"])
+    return geopandas.GeoDataFrame(projected, geometry=geometry, crs=crs)
+
+
+def overlap_candidates(boxes, windows, width, height, margin):
+    """Mask of boxes within margin pixels of an edge their window shares with a neighbouring window
+
+    boxes are in raster pixel coordinates and have a window column with the
+    index of the window they were predicted in. Only these boxes can have a
+    duplicate in another window when windows overlap by margin pixels.
+    """
+    col_off = np.array([window.col_off for window in windows])[boxes["window"].to_numpy()]
+    row_off = np.array([window.row_off for window in windows])[boxes["window"].to_numpy()]
+    col_end = col_off + np.array([window.width for window in windows])[boxes["window"].to_numpy()]
+    row_end = row_off + np.array([window.height for window in windows])[boxes["window"].to_numpy()]
+    return (((col_off > 0) & (boxes["xmin"].to_numpy() < col_off + margin)) |
+            ((col_end < width) & (boxes["xmax"].to_numpy() > col_end - margin)) |
+            ((row_off > 0) & (boxes["ymin"].to_numpy() < row_off + margin)) |
+            ((row_end < height) & (boxes["ymax"].to_numpy() > row_end - margin)))
+
+
+def duplicate_pairs(candidates, threshold=DUPLICATE_THRESHOLD, class_aware=True):
+    """Pairs of candidate boxes from different windows that cover the same bird
+
+    Boxes are hashed into a grid of cells at least as large as the largest
+    box, so overlapping boxes are always in the same or adjacent cells and
+    each box is only compared with the boxes near it. Pairs are kept when
+    their intersection covers more than threshold of the smaller box, which
+    matches a box cut off at one window's edge with the whole box from the
+    neighbouring window. With class_aware only boxes with the same label are
+    paired. Returns the positions of the two boxes of each pair in candidates.
+    """
+    xmin, ymin, xmax, ymax = (
+        candidates[column].to_numpy(dtype="float64") for column in ["xmin", "ymin", "xmax", "ymax"])
+    cell_size = max(float(np.max(xmax - xmin)), float(np.max(ymax - ymin)), 1.0)
+    cells = pd.DataFrame({
+        "i": np.arange(len(candidates)),
+        "cx": np.floor(xmin / cell_size).astype("int64"),
+        "cy": np.floor(ymin / cell_size).astype("int64")
+    })
+    neighbours = pd.concat([cells.assign(cx=cells.cx + dx, cy=cells.cy + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+    pairs = cells.merge(neighbours, on=["cx", "cy"], suffixes=("", "_other"))
+    i, j = pairs["i"].to_numpy(), pairs["i_other"].to_numpy()
+    keep = (i < j) & (candidates["window"].to_numpy()[i] != candidates["window"].to_numpy()[j])
+    if class_aware:
+        keep &= candidates["label"].to_numpy()[i] == candidates["label"].to_numpy()[j]
+    i, j = i[keep], j[keep]
+
+    overlap_x = np.minimum(xmax[i], xmax[j]) - np.maximum(xmin[i], xmin[j])
+    overlap_y = np.minimum(ymax[i], ymax[j]) - np.maximum(ymin[i], ymin[j])
+    intersection = np.clip(overlap_x, 0, None) * np.clip(overlap_y, 0, None)
+    area = (xmax - xmin) * (ymax - ymin)
+    smaller = np.minimum(area[i], area[j])
+    duplicate = intersection > threshold * np.where(smaller > 0, smaller, np.inf)
+    return i[duplicate], j[duplicate]
+
+
+def suppress_window_duplicates(boxes, windows, width, height, margin, threshold=DUPLICATE_THRESHOLD, class_aware=True):
+    """Remove boxes that duplicate a higher scoring box predicted in a neighbouring window
+
+    Only the boxes in the strips where windows overlap are compared (see
+    overlap_candidates and duplicate_pairs). Duplicates are suppressed
+    greedily in order of score, like non-maximum suppression. Returns boxes
+    without the suppressed rows.
+    """
+    positions = np.flatnonzero(overlap_candidates(boxes, windows, width, height, margin))
+    if len(positions) < 2:
+        return boxes
+    candidates = boxes.iloc[positions]
+    first, second = duplicate_pairs(candidates, threshold, class_aware)
+    if len(first) == 0:
+        return boxes
+
+    scores = candidates["score"].to_numpy()
+    # Rank by descending score, ties broken by position
+    rank = np.empty(len(candidates), dtype="int64")
+    rank[np.lexsort((np.arange(len(candidates)), -scores))] = np.arange(len(candidates))
+    neighbours = {}
+    for a, b in zip(first, second):
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+    suppressed = set()
+    for a in sorted(neighbours, key=lambda a: rank[a]):
+        if a in suppressed:
+            continue
+        suppressed.update(b for b in neighbours[a] if rank[b] > rank[a])
+    return boxes.drop(index=boxes.index[positions[sorted(suppressed)]])
@@ -0,0 +1,57 @@
+# test benchmark
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import geopandas
+import rasterio
+
+import benchmark
+
+
+def test_synthetic_inputs(tmp_path):
+    paths = benchmark.write_synthetic_flights(str(tmp_path), n_dates=3, n_nests=20)
+    assert len(paths) == 3
+    flight = geopandas.read_file(paths[0])
+    assert flight.crs.to_epsg() == 32617
+    assert {"xmin", "ymin", "xmax", "ymax", "score", "label"} <= set(flight.columns)
+
+    path = benchmark.write_synthetic_mosaic(str(tmp_path / "mosaic.tif"), 600, "EPSG:3857", (0, 0), 0.05)
+    with rasterio.open(path) as src:
+        mask = src.dataset_mask()
+    # Valid footprint in the middle, nodata in the corners
+    assert mask[300, 300] == 255 and mask[0, 0] == 0
+
+
+def test_compare_results():
+    baseline = {
+        "compare_site/small": {
+            "status": "ok",
+            "seconds": 1.0,
+            "peak_rss_mb": 100
+        },
+        "combine_files/small": {
+            "status": "ok",
+            "seconds": 0.01,
+            "peak_rss_mb": 100
+        },
+    }
+    results = {
+        "compare_site/small": {
+            "status": "ok",
+            "seconds": 1.5,
+            "peak_rss_mb": 100
+        },
+        # Small absolute slowdowns are treated as noise
+        "combine_files/small": {
+            "status": "ok",
+            "seconds": 0.05,
+            "peak_rss_mb": 110
+        },
+        "project_raster/small": {
+            "status": "skipped",
+            "reason": "No module named 'osgeo'"
+        },
+    }
+    regressions = benchmark.compare_results(results, baseline)
+    assert len(regressions) == 1 and regressions[0].startswith("compare_site/small")
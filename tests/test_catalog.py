@@ -0,0 +1,34 @@
+# test catalog
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import catalog
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+
+
+def test_scan_flights(tmpdir):
+    orthomosaic_dir = os.path.join(tmpdir, "orthomosaics")
+    cache_path = os.path.join(tmpdir, "manifest", "flight_catalog.json")
+    touch(os.path.join(orthomosaic_dir, "2022", "Joule", "Joule_03_08_2022.tif"))
+    touch(os.path.join(orthomosaic_dir, "2022", "Joule", "Joule_03_01_2022.tif"))
+    touch(os.path.join(orthomosaic_dir, "2022", "Joule", "Joule_03_01_2022_B.tif"))
+    touch(os.path.join(orthomosaic_dir, "2023", "Aerie", "Aerie_04_02_2023_primary.tif"))
+
+    flights = catalog.scan_flights(orthomosaic_dir, cache_path)
+    assert [record.flight for record in flights
+           ] == ["Joule_03_01_2022", "Joule_03_01_2022_B", "Joule_03_08_2022", "Aerie_04_02_2023_primary"]
+    assert flights[1] == catalog.Flight("2022", "Joule", "Joule_03_01_2022_B", "03_01_2022", "B", "_B")
+
+    index = catalog.index_flights(flights)
+    assert len(index[("Joule", "2022", "primary")]) == 2
+    assert index[("Aerie", "2023", "primary")][0].file_postscript == "_PRIMARY"
+
+    # The cached listing gives the same flights and picks up new files
+    assert catalog.scan_flights(orthomosaic_dir, cache_path) == flights
+    touch(os.path.join(orthomosaic_dir, "2023", "Aerie", "Aerie_04_09_2023.tif"))
+    assert len(catalog.scan_flights(orthomosaic_dir, cache_path)) == 5
@@ -0,0 +1,53 @@
+# test combine_bird_predictions
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import glob
+
+import pandas as pd
+
+import combine_bird_predictions
+import combine_birds_site_year
+import tools
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def test_incremental_publish_matches_combine(tmp_path):
+    paths = sorted(glob.glob(os.path.join(DATA_DIR, "predictions", "*.shp")))
+    joule = combine_birds_site_year.combine_files(paths, "2020", "Joule", 0.3, str(tmp_path))
+    aerie = joule.iloc[:50].assign(Site="Aerie")
+    site_years = [os.path.join(tmp_path, "Joule_2020_combined.shp"), os.path.join(tmp_path, "Aerie_2020_combined.shp")]
+    tools.write_geodataframe(aerie, site_years[1])
+
+    legacy = combine_bird_predictions.truncate_columns(combine_bird_predictions.combine(site_years))
+    legacy_counts = combine_bird_predictions.count_birds(legacy)
+
+    partition_dir = str(tmp_path / "partitions")
+    output_base = str(tmp_path / "PredictedBirds")
+    names, rebuilt = combine_bird_predictions.update_partitions(site_years, partition_dir)
+    assert rebuilt == names == ["Joule_2020_combined", "Aerie_2020_combined"]
+    combine_bird_predictions.assemble_partitions(names, partition_dir, output_base)
+
+    published = tools.read_geodataframe(f"{output_base}.shp")
+    assert len(published) == len(legacy)
+    assert published["bird_id"].tolist() == legacy["bird_id"].tolist()
+    assert published["Site"].tolist() == legacy["Site"].tolist()
+    counts = pd.read_csv(f"{output_base}.csv", dtype={"Date": str})
+    pd.testing.assert_frame_equal(counts, legacy_counts, check_dtype=False)
+
+    # Only the changed site-year is rebuilt
+    names, rebuilt = combine_bird_predictions.update_partitions(site_years, partition_dir)
+    assert rebuilt == []
+    tools.write_geodataframe(aerie.iloc[:10], site_years[1])
+    names, rebuilt = combine_bird_predictions.update_partitions(site_years, partition_dir)
+    assert rebuilt == ["Aerie_2020_combined"]
+
+    # Changing only attributes leaves the .shp bytes alone but still rebuilds the partition
+    relabelled = aerie.iloc[:10].assign(label="Roseate Spoonbill")
+    tools.write_geodataframe(relabelled, site_years[1])
+    names, rebuilt = combine_bird_predictions.update_partitions(site_years, partition_dir)
+    assert rebuilt == ["Aerie_2020_combined"]
+    partition = tools.read_geodataframe(os.path.join(partition_dir, "Aerie_2020_combined.parquet"))
+    assert set(partition["label"]) == {"Roseate Spoonbill"}
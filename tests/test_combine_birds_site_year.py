@@ -0,0 +1,82 @@
+# test combine_birds_site_year
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import glob
+
+import geopandas
+import pandas as pd
+import shapely
+
+import combine_birds_site_year
+import tools
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def test_stream_combine_files_matches_combine_files(tmp_path):
+    paths = sorted(glob.glob(os.path.join(DATA_DIR, "predictions", "*.shp")), reverse=True)
+    for output_format in tools.INTERMEDIATE_FORMATS:
+        combined_dir = str(tmp_path / "combined" / output_format)
+        streamed_dir = str(tmp_path / "streamed" / output_format)
+        os.makedirs(combined_dir)
+        os.makedirs(streamed_dir)
+        combine_birds_site_year.combine_files(paths, "2020", "Joule", 0.3, combined_dir, output_format=output_format)
+        combine_birds_site_year.stream_combine_files(paths,
+                                                     "2020",
+                                                     "Joule",
+                                                     0.3,
+                                                     streamed_dir,
+                                                     output_format=output_format,
+                                                     workers=2)
+
+        filename = f"Joule_2020_combined.{output_format}"
+        combined = tools.read_geodataframe(os.path.join(combined_dir, filename))
+        streamed = tools.read_geodataframe(os.path.join(streamed_dir, filename))
+        assert len(streamed) > 0
+        assert streamed.crs == combined.crs
+        pd.testing.assert_frame_equal(streamed, combined)
+
+
+def test_stream_combine_files_with_differing_dtypes(tmp_path):
+    # The first flight has no labels at all, the second has labels and integer coordinates
+    flights = {
+        "Joule_03_03_2020_projected.parquet": {
+            "xmin": [10.5, 20.5],
+            "label": [None, None]
+        },
+        "Joule_03_10_2020_projected.parquet": {
+            "xmin": [30, 40, 50],
+            "label": ["Great Egret", "White Ibis", "Great Egret"]
+        },
+    }
+    paths = []
+    for name, columns in flights.items():
+        xmin = pd.Series(columns["xmin"])
+        flight = geopandas.GeoDataFrame(
+            {
+                "xmin": xmin,
+                "ymin": xmin,
+                "xmax": xmin + 1,
+                "ymax": xmin + 1,
+                "score": 0.9,
+                "label": pd.Series(columns["label"], dtype=object)
+            },
+            geometry=shapely.box(xmin, xmin, xmin + 1, xmin + 1),
+            crs="EPSG:32617")
+        paths.append(tools.write_geodataframe(flight, str(tmp_path / name)))
+    assert tools.read_geodataframe(paths[1])["xmin"].dtype == "int64"
+
+    filename = combine_birds_site_year.stream_combine_files(paths,
+                                                            "2020",
+                                                            "Joule",
+                                                            0.3,
+                                                            str(tmp_path),
+                                                            output_format="parquet",
+                                                            workers=2)
+    streamed = tools.read_geodataframe(filename)
+    assert streamed["xmin"].tolist() == [10.5, 20.5, 30, 40, 50]
+    assert streamed["bird_id"].tolist() == [1, 2, 3, 4, 5]
+    assert streamed["label"].isna().tolist() == [True, True, False, False, False]
+    assert streamed["label"].iloc[2:].tolist() == ["Great Egret", "White Ibis", "Great Egret"]
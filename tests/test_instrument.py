@@ -0,0 +1,99 @@
+# test instrument
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import json
+
+import instrument
+
+
+def record_job(name, wall_seconds, **labels):
+    return {
+        "job": name,
+        "labels": labels,
+        "status": "ok",
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": wall_seconds,
+        "peak_rss_mb": 100,
+        "bytes_read": 0,
+        "bytes_written": 0,
+        "steps": []
+    }
+
+
+def test_job_sidecar(tmp_path, monkeypatch):
+    monkeypatch.setenv("EVERWATCH_METRICS_DIR", str(tmp_path))
+    # Steps and counts are ignored outside a job
+    with instrument.step("read"):
+        instrument.count("birds", 10)
+
+    instrument.start_job("detect_nests", site="Joule", year="2022")
+    with instrument.step("read"):
+        instrument.count("birds", 10)
+        data = bytearray(10 * 1024**2)
+    with instrument.step("match"):
+        with instrument.step("tracks"):
+            instrument.count("candidate_pairs", 5)
+    path = instrument.finish_job()
+    assert instrument.finish_job() is None
+
+    with open(path) as f:
+        job = json.load(f)
+    assert os.path.basename(path).startswith("detect_nests_Joule_2022")
+    assert job["counts"] == {"birds": 10, "candidate_pairs": 5}
+    assert [step["name"] for step in job["steps"]] == ["read", "match/tracks", "match"]
+    assert job["steps"][0]["counts"] == {"birds": 10}
+    assert job["steps"][0]["peak_rss_mb"] > 0
+    assert job["wall_seconds"] >= sum(step["wall_seconds"] for step in job["steps"] if "/" not in step["name"])
+
+
+def test_nested_steps_keep_the_parent_peak(tmp_path, monkeypatch):
+    monkeypatch.setenv("EVERWATCH_METRICS_DIR", str(tmp_path))
+    # Resident memory and its high-water mark, which reset_peak_rss lowers to the current memory
+    memory = {"rss": 100, "peak": 100}
+
+    def allocate(mb):
+        memory["rss"] += mb
+        memory["peak"] = max(memory["peak"], memory["rss"])
+
+    monkeypatch.setattr(instrument, "peak_rss_mb", lambda: memory["peak"])
+    monkeypatch.setattr(instrument, "reset_peak_rss", lambda: memory.update(peak=memory["rss"]))
+
+    instrument.start_job("detect_nests", site="Joule", year="2022")
+    with instrument.step("match"):
+        allocate(900)
+        allocate(-900)
+        with instrument.step("tracks"):
+            allocate(200)
+            allocate(-200)
+        with instrument.step("pairs"):
+            allocate(50)
+    path = instrument.finish_job()
+
+    with open(path) as f:
+        job = json.load(f)
+    peaks = {step["name"]: step["peak_rss_mb"] for step in job["steps"]}
+    # The parent keeps the peak it reached before its children started
+    assert peaks == {"match/tracks": 300, "match/pairs": 150, "match": 1000}
+    assert job["peak_rss_mb"] == 1000
+    assert all(not key.startswith("_") for step in job["steps"] for key in step)
+
+
+def test_critical_path():
+    records = [
+        record_job("project_mosaics", 100, site="Joule", year="2022", flight="Joule_03_01_2022"),
+        record_job("project_mosaics", 50, site="Joule", year="2022", flight="Joule_03_08_2022"),
+        record_job("predict_birds", 10, flights=["Joule_03_01_2022", "Joule_03_08_2022"]),
+        record_job("create_mbtile", 30, site="Joule", year="2022", flight="Joule_03_08_2022"),
+        record_job("combine_birds_site_year", 5, site="Joule", year="2022"),
+        record_job("detect_nests", 5, site="Joule", year="2022"),
+    ]
+    path, total = instrument.critical_path(records)
+    assert [record["job"] for record in path
+           ] == ["project_mosaics", "predict_birds", "combine_birds_site_year", "detect_nests"]
+    assert path[0]["labels"]["flight"] == "Joule_03_01_2022"
+    assert total == 120
+
+    report = instrument.summarize(records, lambda record: record["job"])
+    assert report["project_mosaics"]["jobs"] == 2
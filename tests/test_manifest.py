@@ -0,0 +1,70 @@
+# test manifest
+import hashlib
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import manifest
+
+
+def test_file_digest(tmpdir):
+    path = os.path.join(tmpdir, "mosaic.tif")
+    data = os.urandom(10000)
+    with open(path, "wb") as f:
+        f.write(data)
+    assert manifest.file_digest(path, chunk_size=1024) == hashlib.sha256(data).hexdigest()
+
+
+def test_stamps_only_change_with_content(tmpdir):
+    working_dir = str(tmpdir)
+    path = os.path.join(working_dir, "orthomosaics", "2022", "Joule", "Joule_03_01_2022.tif")
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(b"pixels")
+
+    os.utime(path, ns=(10**17, 10**17))
+    stamp = manifest.stamp_orthomosaics([path], working_dir)[path]
+    assert stamp == os.path.join(working_dir, "manifest", "orthomosaics", "2022", "Joule", "Joule_03_01_2022.sha256")
+    # A new stamp is as old as its orthomosaic, so existing products stay current
+    assert os.stat(stamp).st_mtime_ns == 10**17
+    os.utime(stamp, ns=(0, 0))
+
+    # Touching the orthomosaic rehashes it but leaves the stamp alone
+    os.utime(path, ns=(10**18, 10**18))
+    manifest.stamp_orthomosaics([path], working_dir)
+    assert os.stat(stamp).st_mtime_ns == 0
+
+    with open(path, "wb") as f:
+        f.write(b"new pixels")
+    manifest.stamp_orthomosaics([path], working_dir)
+    assert os.stat(stamp).st_mtime_ns > 0
+    with open(stamp) as f:
+        assert f.read() == hashlib.sha256(b"new pixels").hexdigest()
+
+
+def test_version_stamps_only_change_with_version(tmpdir):
+    working_dir = str(tmpdir)
+    stamp = manifest.stamp_version("predictions", working_dir, "2024.1")
+    assert stamp == os.path.join(working_dir, "manifest", "versions", "predictions.txt")
+    # A new version stamp predates every product
+    assert os.stat(stamp).st_mtime == 0
+
+    manifest.stamp_version("predictions", working_dir, "2024.1")
+    assert os.stat(stamp).st_mtime == 0
+    manifest.stamp_version("predictions", working_dir, "2025.1")
+    assert os.stat(stamp).st_mtime > 0
+    with open(stamp) as f:
+        assert f.read() == "2025.1"
+
+
+def test_shapefile_digest_covers_components(tmpdir):
+    base = os.path.join(tmpdir, "Joule_2022_combined")
+    for extension, content in [(".shp", b"geometry"), (".shx", b"index"), (".dbf", b"attributes")]:
+        with open(base + extension, "wb") as f:
+            f.write(content)
+    manifest_path = os.path.join(tmpdir, "sources.json")
+    digest = manifest.update_manifest([base + ".shp"], manifest_path)[base + ".shp"]
+
+    with open(base + ".dbf", "wb") as f:
+        f.write(b"new attributes")
+    assert manifest.update_manifest([base + ".shp"], manifest_path)[base + ".shp"] != digest
@@ -0,0 +1,83 @@
+# test nest_chips
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import shutil
+
+import geopandas
+import numpy as np
+import rasterio
+import shapely
+
+import nest_chips
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def test_extract_chips(tmp_path):
+    mosaic_dir = tmp_path / "projected_mosaics"
+    mosaic_dir.mkdir()
+    source = os.path.join(DATA_DIR, "Vacation_03192020_203_projected.tif")
+    for date in ["03_19_2020", "03_26_2020"]:
+        shutil.copy(source, mosaic_dir / f"Vacation_{date}_projected.tif")
+    with rasterio.open(source) as src:
+        left, bottom, right, top = src.bounds
+        window = src.window(left + 2, top - 3.25, left + 3, top - 2.25).round_offsets().round_lengths()
+        expected = src.read(indexes=[1, 2, 3], window=window)
+
+    def box(x, y):
+        return shapely.box(left + x, top - y - 0.5, left + x + 0.5, top - y)
+
+    dates = ["03_19_2020", "03_19_2020", "03_26_2020", "03_19_2020", "03_26_2020", "03_19_2020"]
+    detected = geopandas.GeoDataFrame(
+        {
+            "target_ind": [1, 1, 1, 2, 2, 3],
+            "Site": ["Vacation"] * 6,
+            "Date": dates,
+            "score": [0.9, 0.5, 0.8, 0.7, 0.6, 0.9],
+            "image_path": [f"Vacation_{date}_projected.tif" for date in dates],
+        },
+        geometry=[box(x, y) for x, y in [(2.25, 2.5), (5, 5), (2.25, 2.5), (6, 6), (6, 6), (4, 4)]],
+        crs="EPSG:32617")
+    # Nest 3 was not kept by process_nests
+    processed = geopandas.GeoDataFrame({"nest_id": [1, 2]}, geometry=shapely.points([0, 0], [0, 0]), crs="EPSG:32617")
+    processed_file = str(tmp_path / "processed.shp")
+    detected_file = str(tmp_path / "detected.shp")
+    processed.to_file(processed_file)
+    detected.to_file(detected_file)
+
+    savedir = tmp_path / "chips"
+
+    def extract(**options):
+        options = {"buffer": 0.25, "max_size": None, "workers": 0, **options}
+        written = nest_chips.extract_chips(processed_file, detected_file, str(mosaic_dir), str(savedir), **options)
+        return sorted(os.path.relpath(path, savedir) for path in written)
+
+    assert extract() == [
+        "1/1_Vacation_03_19_2020.png", "1/1_Vacation_03_26_2020.png", "2/2_Vacation_03_19_2020.png",
+        "2/2_Vacation_03_26_2020.png"
+    ]
+    # The best scoring box of nest 1 on 03_19_2020 was cut at full resolution
+    with rasterio.open(savedir / "1" / "1_Vacation_03_19_2020.png") as chip:
+        np.testing.assert_array_equal(chip.read(), expected)
+    # Existing chips are skipped
+    assert extract() == []
+
+    # Rebuilt tracks swapped the nest ids, so every chip is cut again from its new box
+    detected["target_ind"] = detected["target_ind"].map({1: 2, 2: 1, 3: 3})
+    detected.to_file(detected_file)
+    assert len(extract()) == 4
+    with rasterio.open(savedir / "2" / "2_Vacation_03_19_2020.png") as chip:
+        np.testing.assert_array_equal(chip.read(), expected)
+
+    # Chips of nests that are no longer kept are removed
+    processed.iloc[1:].to_file(processed_file)
+    assert extract() == []
+    assert sorted(os.listdir(savedir)) == ["2", "chips.json"]
+
+    # Large chips are downsampled to max_size
+    written = extract(buffer=3, max_size=64, workers=1)
+    assert written == ["2/2_Vacation_03_19_2020.png", "2/2_Vacation_03_26_2020.png"]
+    with rasterio.open(savedir / written[0]) as chip:
+        assert max(chip.shape) == 64
@@ -3,44 +3,217 @@ import os
 import sys
 
 sys.path.append(os.path.dirname(os.getcwd()))
-import pytest
-import nest_detection
+import glob
+
 import geopandas
+import numpy as np
+import pandas as pd
+import shapely
+
+import combine_birds_site_year
+import nest_detection
+import tools
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
 
+def combined_birds(tmp_path):
+    paths = sorted(glob.glob(os.path.join(DATA_DIR, "predictions", "*.shp")))
+    combine_birds_site_year.combine_files(paths, "2020", "Joule", 0.3, savedir=str(tmp_path))
+    return os.path.join(tmp_path, "Joule_2020_combined.shp")
 
-def test_load_files():
-    df = nest_detection.load_files("data/predictions/")
+
+def test_load_files(tmp_path):
+    df = tools.read_geodataframe(combined_birds(tmp_path))
     assert not df.empty
     assert df.Site.unique() == ["Joule"]
 
 
-def test_compare_site():
-    df = nest_detection.load_files("data/predictions/")
+def test_compare_site(tmp_path):
+    df = tools.read_geodataframe(combined_birds(tmp_path))
     results = nest_detection.compare_site(df)
 
     assert not results.empty
 
 
-def test_detect_nests():
-    filename = nest_detection.detect_nests("data/predictions/", savedir="output/")
-
+def test_detect_nests(tmp_path):
+    filename = nest_detection.detect_nests(combined_birds(tmp_path), "2020", "Joule", savedir=str(tmp_path / "output"))
     assert os.path.exists(filename)
 
+    gdf = geopandas.read_file(filename)
+    assert not gdf.empty
+    for target_ind, group in gdf.groupby("target_ind"):
+        # Every nest holds its target bird and at least one match on another date
+        assert len(group) > 1
+        assert group["Date"].nunique() > 1
+        assert (group["Site"] == "Joule").all()
 
-# only run on hipergator with access to the rgb data
-is_travis = 'TRAVIS' in os.environ
 
+def match_pairs(results):
+    return set(zip(results["bird_id"].astype(int), results["target_ind"].astype(int)))
 
-@pytest.mark.skipif(is_travis, reason="Cannot load comet on TRAVIS")
-def test_detect_nests():
-    filename = nest_detection.detect_nests("data/predictions/", savedir="output/")
-    rgb_pool = nest_detection.find_files()
-    nest_detection.extract_nests(filename, rgb_pool=rgb_pool, savedir="output", upload=True)
-    gdf = geopandas.read_file(filename)
-    grouped = gdf.groupby("target_ind")
-    for name, group in grouped:
-        if group.shape[0] < 3:
+
+def synthetic_birds(n_nests=200, n_dates=6, seed=0, extent=60):
+    """Jittered boxes around fixed nest locations with neighbours close enough to overlap"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(0, extent, size=(n_nests, 2))
+    rows = []
+    for date in range(n_dates):
+        present = rng.random(n_nests) < 0.7
+        xy = centers[present] + rng.normal(0, 0.2, size=(present.sum(), 2))
+        for x, y in xy:
+            rows.append({
+                "Date": f"03_{date + 1:02d}_2022",
+                "geometry": shapely.box(x - 0.5, y - 0.5, x + 0.5, y + 0.5)
+            })
+    gdf = geopandas.GeoDataFrame(rows, crs="EPSG:32617")
+    bounds = gdf.geometry.bounds
+    gdf["xmin"], gdf["ymin"], gdf["xmax"], gdf["ymax"] = bounds.minx, bounds.miny, bounds.maxx, bounds.maxy
+    gdf["bird_id"] = range(1, len(gdf) + 1)
+    return gdf
+
+
+# Unmodified copy of the row-by-row compare_site that the vectorized version replaced (baseline 49b21f1)
+def baseline_calculate_IoUs(geom, match):
+    """Calculate intersection-over-union scores for a pair of boxes"""
+    intersection = geom.intersection(match).area
+    union = geom.union(match).area
+    iou = intersection / float(union)
+    return iou
+
+
+def baseline_compare_site(gdf):
+    """Iterate over a dataframe and check rows"""
+    results = []
+    claimed_indices = []
+    spatial_index = gdf.sindex
+
+    for index, row in gdf.iterrows():
+        if index in claimed_indices:
             continue
-        for index, row in group.iterrows():
-            filename = "output/{}/{}_{}_{}.png".format(index, row["target_ind"], row["Site"], row["Date"])
-            os.path.exists(filename)
+        claimed_indices.append(index)
+        geom = row["geometry"]
+
+        possible_matches_index = list(spatial_index.intersection(geom.bounds))
+        possible_matches = gdf.iloc[possible_matches_index]
+
+        # Remove matches to the current date, which are nearby birds not the same bird on a different date
+        possible_matches = possible_matches.loc[possible_matches["Date"] != row.Date]
+
+        # Check for multiple matches from the same date and pick best match
+        match_date_count = possible_matches.groupby("Date").Date.agg("count")
+        multiple_match_dates = match_date_count[match_date_count > 1]
+
+        if not multiple_match_dates.empty:
+            for date in multiple_match_dates.index:
+                mm = possible_matches[possible_matches["Date"] == date].copy()
+                mm = mm.assign(iou=mm["geometry"].map(lambda x: baseline_calculate_IoUs(x, geom)))
+                best_match = mm.loc[mm["iou"] == mm["iou"].max()].drop(columns="iou")
+                possible_matches = possible_matches.drop(possible_matches[possible_matches["Date"] == date].index)
+                possible_matches = geopandas.GeoDataFrame(pd.concat([possible_matches, best_match], ignore_index=True),
+                                                          crs=gdf.crs)
+
+        # remove matches already claimed
+        matches = possible_matches[~(possible_matches.index.isin(claimed_indices))]
+        if matches.empty:
+            continue
+
+        # add to claimed
+        claimed_indices.extend(matches.index.values)
+
+        # add target info to match
+        row_gdf = geopandas.GeoDataFrame(pd.DataFrame(row).transpose(), crs=matches.crs)
+        matches = geopandas.GeoDataFrame(pd.concat([matches, row_gdf], ignore_index=True), crs=matches.crs)
+        matches["target_ind"] = index
+        matches = matches.rename(columns={
+            "xmin": "match_xmin",
+            "xmax": "match_xmax",
+            "ymin": "match_ymin",
+            "ymax": "match_ymax",
+        })
+        results.append(matches)
+
+    if results:
+        results = pd.concat(results, ignore_index=True)
+    else:
+        results = pd.DataFrame(columns=[
+            'match_xmin', 'match_ymin', 'match_xmax', 'match_ymax', 'label', 'score', 'image_path', 'Site', 'Date',
+            'Year', 'event', 'file_posts', 'bird_id', 'target_ind'
+        ])
+    return results
+
+
+def test_compare_site_matches_baseline():
+    # Spread out nests never have two candidate matches on the same date, where the two versions differ
+    for seed in range(3):
+        df = synthetic_birds(n_nests=200, seed=seed, extent=1000)
+        results = nest_detection.compare_site(df)
+        expected = baseline_compare_site(df)
+        assert len(results) > 0
+        assert match_pairs(results) == match_pairs(expected)
+
+
+def test_compare_site_claims_by_bird_index():
+    """Before and after of the one intended change from the baseline
+
+    When a target had two candidates on a date, the baseline reset the index
+    of its candidates, so claims were recorded against positions rather than
+    birds. A candidate in the first position was then dropped as already
+    claimed and the best match was left for a later, worse target.
+    """
+    boxes = [(0, 0, 1, 1), (0.1, 0, 1.1, 1), (0.6, 0, 1.6, 1), (0, 0.1, 1, 1.1)]
+    df = geopandas.GeoDataFrame(
+        {
+            "Date": ["03_01_2022", "03_02_2022", "03_02_2022", "03_03_2022"],
+            "bird_id": [1, 2, 3, 4]
+        },
+        geometry=[shapely.box(*box) for box in boxes],
+        crs="EPSG:32617")
+    # Before: bird 4 overlaps bird 1 best, but is matched to the lower IoU bird 3
+    assert match_pairs(baseline_compare_site(df)) == {(1, 0), (2, 0), (3, 2), (4, 2)}
+    # After: bird 1 claims its best match on each date
+    assert match_pairs(nest_detection.compare_site(df)) == {(1, 0), (2, 0), (4, 0)}
+
+
+def test_compare_site_dense():
+    df = synthetic_birds()
+    # Make sure the best-match-per-date path is exercised
+    target, match = df.sindex.query(df.geometry.values)
+    dates = df["Date"].to_numpy()
+    same_date_pairs = set(zip(target, dates[match]))
+    assert len(same_date_pairs) < len(target)
+
+    results = nest_detection.compare_site(df)
+    # Every bird belongs to at most one nest and each nest contains its target
+    assert not results["bird_id"].duplicated().any()
+    assert set(results["target_ind"]) <= set(df.index[df["bird_id"].isin(results["bird_id"])])
+    assert set(results.columns) >= {"match_xmin", "match_ymax", "target_ind", "bird_id"}
+
+
+def test_compare_site_empty():
+    df = synthetic_birds(n_nests=1, n_dates=1)
+    results = nest_detection.compare_site(df)
+    assert results.empty
+    assert "target_ind" in results.columns
+
+
+def test_detect_nests_incremental(tmp_path):
+    birds = synthetic_birds(n_nests=300, n_dates=5, seed=1)
+    birds["Site"] = "Synthetic"
+    birds["Year"] = "2022"
+    dates = sorted(birds["Date"].unique())
+
+    for n_dates in [2, 3, 5, 4]:
+        season = birds[birds["Date"].isin(dates[:n_dates])].reset_index(drop=True)
+        season_file = os.path.join(tmp_path, f"season_{n_dates}.shp")
+        season.to_file(season_file)
+        filename = nest_detection.detect_nests(season_file,
+                                               "2022",
+                                               "Synthetic",
+                                               str(tmp_path / "tracked"),
+                                               incremental=True)
+        expected = nest_detection.compare_site(geopandas.read_file(season_file))
+        assert match_pairs(geopandas.read_file(filename)) == match_pairs(expected)
+
+    manifest = os.path.join(tmp_path, "tracked", "tracks", "Synthetic_2022_tracks.json")
+    assert os.path.exists(manifest)
@@ -0,0 +1,71 @@
+# test nest_sweep
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import glob
+
+import geopandas
+import numpy as np
+import shapely
+
+import combine_birds_site_year
+import nest_detection
+import nest_sweep
+import process_nests
+import tools
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def test_sweep_matches_full_chain(tmp_path):
+    paths = sorted(glob.glob(os.path.join(DATA_DIR, "predictions", "*.shp")))
+    combine_birds_site_year.combine_files(paths, "2020", "Joule", 0.3, str(tmp_path), output_format="parquet")
+    combined = os.path.join(tmp_path, "Joule_2020_combined.parquet")
+
+    score_thresholds = [0.3, 0.5, 0.7]
+    table = nest_sweep.sweep([combined], score_thresholds, [0.3, 0.6], [2, 3], [1], workers=2)
+    assert len(table) == 12
+
+    # Rerun combine, detect and process for each score threshold and compare with the sweep
+    for score_thresh in score_thresholds:
+        savedir = str(tmp_path / str(score_thresh))
+        os.makedirs(savedir)
+        combine_birds_site_year.combine_files(paths, "2020", "Joule", score_thresh, savedir, output_format="parquet")
+        detected = nest_detection.detect_nests(os.path.join(savedir, "Joule_2020_combined.parquet"),
+                                               "2020",
+                                               "Joule",
+                                               savedir,
+                                               output_format="parquet")
+        for min_score in [0.3, 0.6]:
+            process_nests.process_nests(detected,
+                                        "2020",
+                                        "Joule",
+                                        savedir,
+                                        min_score=min_score,
+                                        min_detections=2,
+                                        output_format="parquet")
+            nests = tools.read_geodataframe(os.path.join(savedir, "Joule_2020_processed_nests.parquet"))
+            row = table[(table["score_thresh"] == score_thresh) & (table["min_score"] == min_score) &
+                        (table["min_detections"] == 2)].iloc[0]
+            assert row["nests"] == len(nests)
+            for species, count in nests["species"].value_counts().items():
+                assert row[species] == count
+    assert table["nests"].max() > 0
+
+
+def test_sweep_targets_match_assign_targets():
+    # Jittered boxes around fixed nest locations, close enough for neighbours to overlap
+    rng = np.random.default_rng(2)
+    centers = rng.uniform(0, 40, size=(150, 2))
+    dates = np.repeat([f"03_{day:02d}_2022" for day in range(1, 6)], len(centers))
+    xy = np.tile(centers, (5, 1)) + rng.normal(0, 0.2, size=(len(dates), 2))
+    birds = geopandas.GeoDataFrame({"Date": dates},
+                                   geometry=shapely.box(xy[:, 0] - 0.5, xy[:, 1] - 0.5, xy[:, 0] + 0.5, xy[:, 1] + 0.5),
+                                   crs="EPSG:32617")
+    birds["score"] = rng.uniform(0, 1, len(birds))
+    graph = nest_sweep.build_match_graph(birds)
+    for score_thresh in [0.0, 0.4, 0.8]:
+        keep = birds["score"].to_numpy() > score_thresh
+        kept = birds[keep].reset_index(drop=True)
+        np.testing.assert_array_equal(nest_sweep.sweep_targets(graph, keep), nest_detection.assign_targets(kept))
@@ -0,0 +1,317 @@
+# test predict
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import contextlib
+import importlib
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import shapely
+from rasterio import features
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import raster_windows
+import tools
+
+# Side of a bird in pixels
+BIRD_SIZE = 20
+LABELS = {0: "Great Egret", 1: "White Ibis"}
+# (row, col, numeric label) of the top left corner of each bird in a 3000 x 1600 mosaic, predicted in windows
+# starting at columns 0, 1350 and 2700 and rows 0 and 1350 with patch_overlap=0.1
+BIRDS = [
+    (100, 100, 0),
+    # Cut by the right edge of the first column of windows, whole in the second
+    (700, 1490, 0),
+    # Whole in the first two columns of windows
+    (300, 1400, 1),
+    # Cut by the bottom edge of the first row of windows, whole in the second
+    (1490, 2000, 0),
+    (1550, 2900, 1),
+]
+
+
+def write_bird_mosaic(path, width=3000, height=1600):
+    """Projected RGB mosaic with white Great Egrets and red White Ibis on a black background"""
+    data = np.zeros((3, height, width), dtype="uint8")
+    for row, col, label in BIRDS:
+        data[:, row:row + BIRD_SIZE, col:col + BIRD_SIZE] = [[[200]], [[200 if label == 0 else 50]], [[50]]]
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": 3,
+        "dtype": "uint8",
+        "crs": "EPSG:32617",
+        "transform": from_origin(500000, 2900000, 0.01, 0.01),
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    return path
+
+
+def detect(image):
+    """Boxes, numeric labels and scores of the birds in a (rows, cols, bands) image
+
+    Birds cut by the image edge score the fraction of a bird they cover.
+    """
+    mask = (image[:, :, 0] > 150).astype("uint8")
+    boxes, labels, scores = [], [], []
+    for geometry, _ in features.shapes(mask, mask=mask.astype(bool)):
+        xmin, ymin, xmax, ymax = shapely.geometry.shape(geometry).bounds
+        boxes.append([xmin, ymin, xmax, ymax])
+        labels.append(0 if image[int(ymin), int(xmin), 1] > 150 else 1)
+        scores.append(min(1.0, (xmax - xmin) * (ymax - ymin) / BIRD_SIZE**2))
+    return {"boxes": np.array(boxes).reshape(-1, 4), "labels": np.array(labels), "scores": np.array(scores)}
+
+
+def format_boxes(output):
+    return pd.DataFrame({
+        "xmin": output["boxes"][:, 0],
+        "ymin": output["boxes"][:, 1],
+        "xmax": output["boxes"][:, 2],
+        "ymax": output["boxes"][:, 3],
+        "label": output["labels"],
+        "score": output["scores"],
+    })
+
+
+def across_class_nms(boxes, iou_threshold):
+    # Birds never overlap in the test mosaics
+    return boxes
+
+
+class FakeTensor:
+
+    def __init__(self, array):
+        self.array = array
+
+    def permute(self, *dims):
+        return FakeTensor(self.array.transpose(dims))
+
+    def to(self, device):
+        return self
+
+    def __truediv__(self, value):
+        return FakeTensor(self.array / value)
+
+
+class FakeNetwork:
+    """Detector network taking a list of (bands, rows, cols) tensors scaled to 0-1"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, tensors):
+        self.batches.append(len(tensors))
+        return [detect(tensor.array.transpose(1, 2, 0) * 255) for tensor in tensors]
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+class FakeDeepForest:
+    """Stands in for deepforest.main.deepforest; loads counts the models created"""
+    loads = 0
+
+    def __init__(self):
+        FakeDeepForest.loads += 1
+        self.model = FakeNetwork()
+        self.config = types.SimpleNamespace(nms_thresh=0.05)
+        self.numeric_to_label_dict = LABELS
+
+    def load_model(self, model_name):
+        pass
+
+    def postprocess(self, output):
+        if len(output["boxes"]) == 0:
+            return None
+        boxes = format_boxes(output)
+        boxes["label"] = boxes.label.map(self.numeric_to_label_dict)
+        return boxes
+
+    def predict_image(self, image):
+        return self.postprocess(detect(image))
+
+    def predict_tile(self, path, patch_overlap, patch_size, dataloader_strategy):
+        """Reference prediction of the whole mosaic at once, so no bird is cut by a window edge"""
+        with rasterio.open(path) as src:
+            boxes = self.postprocess(detect(src.read().transpose(1, 2, 0)))
+        boxes["image_path"] = os.path.basename(path)
+        return boxes
+
+
+class SerialExecutor:
+    """Runs the CPU prediction workers in this process, where the fake modules are imported"""
+    instances = []
+
+    def __init__(self, max_workers, mp_context=None, initializer=None, initargs=()):
+        self.max_workers = max_workers
+        SerialExecutor.instances.append(self)
+        if initializer is not None:
+            initializer(*initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+@pytest.fixture
+def predict(monkeypatch):
+    """predict imported against fake torch, deepforest and PIL modules"""
+    torch = types.ModuleType("torch")
+    torch.no_grad = contextlib.nullcontext
+    torch.cuda = types.SimpleNamespace(is_available=lambda: False, empty_cache=lambda: None)
+    torch.device = str
+    torch.from_numpy = FakeTensor
+    torch.num_threads = []
+    torch.set_num_threads = torch.num_threads.append
+    deepforest = types.ModuleType("deepforest")
+    deepforest.main = types.SimpleNamespace(deepforest=FakeDeepForest)
+    deepforest.utilities = types.SimpleNamespace(format_boxes=format_boxes)
+    image = types.ModuleType("PIL.Image")
+    modules = {
+        "torch": torch,
+        "deepforest": deepforest,
+        "deepforest.predict": types.SimpleNamespace(across_class_nms=across_class_nms),
+        "PIL": types.SimpleNamespace(Image=image),
+        "PIL.Image": image,
+    }
+    for name, module in modules.items():
+        monkeypatch.setitem(sys.modules, name, module)
+    monkeypatch.delitem(sys.modules, "predict", raising=False)
+    monkeypatch.setattr(FakeDeepForest, "loads", 0)
+    monkeypatch.setattr(SerialExecutor, "instances", [])
+    module = importlib.import_module("predict")
+    monkeypatch.setattr(module, "ProcessPoolExecutor", SerialExecutor)
+    yield module
+    module._worker_stack.close()
+    sys.modules.pop("predict", None)
+
+
+def read_boxes(path):
+    boxes = tools.read_geodataframe(path).sort_values(["xmin", "ymin"])
+    return boxes.reset_index(drop=True)[["xmin", "ymin", "xmax", "ymax", "label", "score"]]
+
+
+def test_merge_window_boxes(predict):
+    windows = [Window(0, 0, 1500, 1500), Window(1350, 0, 1500, 1500)]
+    window_boxes = [
+        predict.shift_boxes(format_boxes(detect(np.full((100, 100, 3), 200.0))), window) for window in windows
+    ]
+    boxes = predict.merge_window_boxes([window_boxes[0], None, window_boxes[1]], "/mosaics/Joule_projected.tif")
+    # Boxes are shifted by their window offset and keep the position of their window
+    assert boxes["xmin"].tolist() == [0, 1350]
+    assert boxes["window"].tolist() == [0, 2]
+    assert (boxes["image_path"] == "Joule_projected.tif").all()
+    assert boxes.geometry.bounds["maxx"].tolist() == [100, 1450]
+    assert predict.merge_window_boxes([None, None], "/mosaics/Joule_projected.tif") is None
+
+
+def test_predict_tile_cpu_matches_predict_tile(predict, tmp_path):
+    path = write_bird_mosaic(str(tmp_path / "Joule_03_01_2022_projected.tif"))
+    reference = predict.run(path, savedir=str(tmp_path / "reference"), model=FakeDeepForest())
+    windows = predict.plan_windows(path, patch_overlap=0.1)
+    assert len(windows) == 6
+
+    # Every window sees the birds in it, so birds in the overlaps are predicted twice
+    boxes = predict.predict_tile_cpu(path, windows, workers=2, torch_threads=3)
+    assert len(boxes) > len(BIRDS)
+    assert [executor.max_workers for executor in SerialExecutor.instances] == [2]
+    assert sys.modules["torch"].num_threads == [3]
+
+    # Merging the windows suppresses the duplicates and the cut birds, matching the whole-mosaic prediction
+    merged = predict.run(path, savedir=str(tmp_path / "cpu"), cpu_workers=2, patch_overlap=0.1)
+    assert len(read_boxes(merged)) == len(BIRDS)
+    pd.testing.assert_frame_equal(read_boxes(merged), read_boxes(reference))
+
+
+def test_run_batch_continues_after_a_failed_flight(predict, tmp_path, monkeypatch, capsys):
+    paths = [
+        write_bird_mosaic(str(tmp_path / f"Joule_03_0{day}_2022_projected.tif"), width=600, height=600)
+        for day in range(1, 4)
+    ]
+    monkeypatch.setattr(predict, "prediction_dir", lambda path: str(tmp_path / "predictions"))
+    predict_tile = FakeDeepForest.predict_tile
+
+    def failing_predict_tile(self, path, **kwargs):
+        if path == paths[1]:
+            raise RuntimeError("CUDA out of memory")
+        return predict_tile(self, path, **kwargs)
+
+    monkeypatch.setattr(FakeDeepForest, "predict_tile", failing_predict_tile)
+    results, failures = predict.run_batch(paths)
+
+    # The flights before and after the failure are still written, with the model loaded once
+    assert FakeDeepForest.loads == 1
+    assert list(results) == [paths[0], paths[2]]
+    assert all(os.path.exists(result) for result in results.values())
+    assert len(read_boxes(results[paths[2]])) == 1
+    assert list(failures) == [paths[1]] and isinstance(failures[paths[1]], RuntimeError)
+    assert not os.path.exists(str(tmp_path / "predictions" / "Joule_03_02_2022_projected.shp"))
+    assert f"Prediction failed for {paths[1]}: CUDA out of memory" in capsys.readouterr().out
+
+
+def test_predict_window_batch_matches_predict_window(predict, tmp_path):
+    path = write_bird_mosaic(str(tmp_path / "Joule_03_01_2022_projected.tif"))
+    model = FakeDeepForest()
+    windows = raster_windows.tile_windows(3000, 1600, 500)
+    with rasterio.open(path) as src:
+        images = [raster_windows.read_window(src, window) for window in windows]
+    batched = predict.predict_window_batch(model, images, windows, "cpu")
+    single = [predict.predict_window(model, image, window) for image, window in zip(images, windows)]
+
+    assert model.model.batches == [len(windows)]
+    assert [boxes is None for boxes in batched] == [boxes is None for boxes in single]
+    assert sum(boxes is not None for boxes in batched) > 1
+    for batch_boxes, window_boxes in zip(batched, single):
+        if window_boxes is not None:
+            pd.testing.assert_frame_equal(batch_boxes, window_boxes)
+
+
+def test_predict_tile_prefetch_stays_within_budget(predict, tmp_path, monkeypatch):
+    path = write_bird_mosaic(str(tmp_path / "Joule_03_01_2022_projected.tif"))
+    windows = raster_windows.tile_windows(3000, 1600, 250)
+    expected = predict.predict_tile_windows(FakeDeepForest(), path, windows)
+
+    read_window = raster_windows.read_window
+    reads = []
+    held = []
+
+    def counted_read_window(src, window):
+        reads.append(window)
+        return read_window(src, window)
+
+    class BudgetNetwork(FakeNetwork):
+
+        def __call__(self, tensors):
+            # Windows read but not yet passed to an earlier batch, including the batch being predicted
+            held.append(len(reads) - sum(self.batches))
+            return super().__call__(tensors)
+
+    monkeypatch.setattr(raster_windows, "read_window", counted_read_window)
+    model = FakeDeepForest()
+    model.model = BudgetNetwork()
+    boxes = predict.predict_tile_prefetch(model, path, windows, prefetch_workers=4, batch_size=4, max_queued_mb=10)
+
+    # A 250 x 250 float32 RGB window is 0.72 MB, so 10 MB holds 13 windows
+    assert max(held) <= 13
+    assert model.model.batches == [4] * 21
+    pd.testing.assert_frame_equal(pd.DataFrame(boxes.drop(columns="geometry")),
+                                  pd.DataFrame(expected.drop(columns="geometry")))
@@ -0,0 +1,66 @@
+# test prediction_store
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import glob
+from datetime import date
+
+import combine_birds_site_year
+import prediction_store
+import tools
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def test_query_matches_full_scan(tmp_path):
+    paths = sorted(glob.glob(os.path.join(DATA_DIR, "predictions", "*.shp")))
+    joule = combine_birds_site_year.combine_files(paths, "2020", "Joule", 0.3, str(tmp_path), output_format="parquet")
+    aerie = joule.iloc[:50].assign(Site="Aerie")
+    site_years = [
+        os.path.join(tmp_path, "Joule_2020_combined.parquet"),
+        os.path.join(tmp_path, "Aerie_2020_combined.parquet")
+    ]
+    tools.write_geodataframe(aerie, site_years[1])
+
+    store_dir = str(tmp_path / "store")
+    assert prediction_store.update_store(site_years, store_dir,
+                                         row_group_size=50) == ["Joule_2020_combined", "Aerie_2020_combined"]
+    assert prediction_store.update_store(site_years, store_dir, row_group_size=50) == []
+
+    minx, miny, maxx, maxy = joule.total_bounds
+    bbox = (minx, miny, (minx + maxx) / 2, (miny + maxy) / 2)
+    label = joule["label"].mode()[0]
+    birds = prediction_store.query(store_dir,
+                                   bbox=bbox,
+                                   start="2020-03-10",
+                                   end=date(2020, 4, 30),
+                                   labels=[label],
+                                   min_score=0.5,
+                                   sites=["Joule"])
+
+    bounds = joule.geometry.bounds
+    dates = joule["Date"].map(tools.parse_date)
+    expected = joule[(bounds.minx <= bbox[2]) & (bounds.maxx >= bbox[0]) & (bounds.miny <= bbox[3]) &
+                     (bounds.maxy >= bbox[1]) & (dates >= date(2020, 3, 10)) & (dates <= date(2020, 4, 30)) &
+                     (joule["label"] == label) & (joule["score"] >= 0.5)]
+    assert len(expected) > 0
+    assert sorted(birds["bird_id"]) == sorted(expected["bird_id"])
+    assert birds.crs == joule.crs
+
+    # Only some of the row groups of the Hilbert sorted partition are read
+    plan = prediction_store.plan_query(store_dir, bbox=bbox, sites=["Joule"])
+    row_groups = plan[os.path.join(store_dir, "Joule_2020_combined.parquet")]["row_groups"]
+    assert 0 < len(row_groups) < -(-len(joule) // 50)
+
+    assert len(prediction_store.query(store_dir, start="2021-01-01")) == 0
+    assert len(prediction_store.query(store_dir, sites=["Aerie"], columns=["bird_id"])) == 50
+
+    # A change to the attributes of a Shapefile site-year alone rebuilds its partition
+    shapefile = os.path.join(tmp_path, "Aerie_2021_combined.shp")
+    tools.write_geodataframe(aerie.assign(Year="2021"), shapefile)
+    shp_store = str(tmp_path / "shp_store")
+    assert prediction_store.update_store([shapefile], shp_store) == ["Aerie_2021_combined"]
+    tools.write_geodataframe(aerie.assign(Year="2021", score=0.99), shapefile)
+    assert prediction_store.update_store([shapefile], shp_store) == ["Aerie_2021_combined"]
+    assert prediction_store.query(shp_store, min_score=0.95)["score"].tolist() == [0.99] * 50
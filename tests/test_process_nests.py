@@ -0,0 +1,51 @@
+# test process_nests
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import glob
+
+import pandas as pd
+
+import combine_birds_site_year
+import nest_detection
+import process_nests
+import tools
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def test_count_max_consec_detects():
+    dates = ["03_01_2022", "03_08_2022", "03_15_2022", "03_22_2022", "03_29_2022"]
+    nests_data = pd.DataFrame({
+        "target_ind": [1, 1, 1, 2, 2, 3, 4, 4, 4, 4],
+        "Date": [
+            "03_15_2022", "03_01_2022", "03_08_2022", "03_01_2022", "03_15_2022", "03_22_2022", "03_01_2022",
+            "03_08_2022", "03_22_2022", "03_29_2022"
+        ],
+    })
+    consec = process_nests.count_max_consec_detects(nests_data, dates)
+    assert consec.to_dict() == {1: 2, 2: 0, 3: 0, 4: 1}
+
+
+def test_process_nests_formats_match(tmp_path):
+    paths = sorted(glob.glob(os.path.join(DATA_DIR, "predictions", "*.shp")))
+    processed = {}
+    for output_format in tools.INTERMEDIATE_FORMATS:
+        savedir = str(tmp_path / output_format)
+        os.makedirs(savedir)
+        combine_birds_site_year.combine_files(paths, "2020", "Joule", 0.3, savedir, output_format=output_format)
+        detected = nest_detection.detect_nests(os.path.join(savedir, f"Joule_2020_combined.{output_format}"),
+                                               "2020",
+                                               "Joule",
+                                               savedir,
+                                               output_format=output_format)
+        process_nests.process_nests(detected, "2020", "Joule", savedir, output_format=output_format)
+        processed[output_format] = tools.read_geodataframe(
+            os.path.join(savedir, f"Joule_2020_processed_nests.{output_format}"))
+
+    shp, parquet = processed["shp"], processed["parquet"]
+    assert len(shp) > 0
+    assert shp["nest_id"].tolist() == parquet["nest_id"].tolist()
+    assert shp["bird_match"].tolist() == parquet["bird_match"].tolist()
+    assert parquet["num_obs"].dtype == "int64"
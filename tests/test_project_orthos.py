@@ -0,0 +1,231 @@
+# test project_orthos
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import importlib
+import types
+from concurrent.futures import Future
+
+import pytest
+
+
+class FakeDataset:
+
+    def __init__(self, width, height):
+        self.RasterXSize = width
+        self.RasterYSize = height
+
+    def GetGeoTransform(self):
+        # North-up UTM grid of 0.1 m pixels
+        return (500000.0, 0.1, 0.0, 2900000.0, 0.0, -0.1)
+
+    def GetRasterBand(self, i):
+        return self
+
+    def SetNoDataValue(self, value):
+        pass
+
+
+class FakeGdal(types.ModuleType):
+    """Records the GDAL calls project_orthos makes, so its planning can be tested without GDAL
+
+    Sources and warped grids are size pixels, files written to /vsimem/ are
+    tracked in vsimem and other files are created empty.
+    """
+
+    def __init__(self, size=(1000, 1000)):
+        super().__init__("osgeo.gdal")
+        self.size = size
+        self.calls = []
+        self.vsimem = set()
+
+    def UseExceptions(self):
+        pass
+
+    def SetConfigOption(self, key, value):
+        pass
+
+    def SetCacheMax(self, num_bytes):
+        self.calls.append(("SetCacheMax", num_bytes))
+
+    def TranslateOptions(self, **kwargs):
+        return kwargs
+
+    def WarpOptions(self, **kwargs):
+        return kwargs
+
+    def Translate(self, dest, src, options):
+        self.calls.append(("Translate", dest, src, options))
+        if dest.startswith("/vsimem/"):
+            self.vsimem.add(dest)
+        elif dest:
+            open(dest, "w").close()
+        return FakeDataset(*self.size)
+
+    def Warp(self, dest, src, options):
+        self.calls.append(("Warp", dest, src, options))
+        if dest:
+            open(dest, "w").close()
+        return FakeDataset(*self.size)
+
+    def BuildVRT(self, dest, paths):
+        self.calls.append(("BuildVRT", dest, list(paths)))
+        return FakeDataset(*self.size)
+
+    def Unlink(self, path):
+        self.vsimem.discard(path)
+
+    def VSIStatL(self, path):
+        return path if path in self.vsimem else None
+
+
+class SerialExecutor:
+    """Runs submitted strips in this process, where the FakeGdal is imported"""
+
+    def __init__(self, max_workers, mp_context=None):
+        self.max_workers = max_workers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@pytest.fixture
+def project_orthos(monkeypatch):
+    """project_orthos imported against a FakeGdal"""
+    gdal = FakeGdal()
+    monkeypatch.setitem(sys.modules, "osgeo", types.SimpleNamespace(gdal=gdal))
+    monkeypatch.setitem(sys.modules, "osgeo.gdal", gdal)
+    monkeypatch.delitem(sys.modules, "project_orthos", raising=False)
+    module = importlib.import_module("project_orthos")
+    yield module
+    sys.modules.pop("project_orthos", None)
+
+
+@pytest.mark.parametrize("height, strip_rows", [(10000, 4096), (8192, 4096), (100, 4096), (1, 1), (513, 512)])
+def test_strips_cover_every_row_once(project_orthos, height, strip_rows):
+    strips = project_orthos.plan_strips(height, strip_rows)
+    rows = [row for row_off, n in strips for row in range(row_off, row_off + n)]
+    assert rows == list(range(height))
+    assert all(0 < n <= strip_rows for _, n in strips)
+
+
+def test_plan_strips_rejects_empty_strips(project_orthos):
+    assert project_orthos.plan_strips(0) == []
+    with pytest.raises(ValueError):
+        project_orthos.plan_strips(100, 0)
+
+
+def test_strip_bounds_tile_the_grid(project_orthos):
+    # North-up UTM grid of 0.1 m pixels
+    geotransform = (500000.0, 0.1, 0.0, 2900000.0, 0.0, -0.1)
+    width, height = 3000, 10000
+    strips = project_orthos.plan_strips(height, 4096)
+    bounds = [project_orthos.strip_bounds(geotransform, width, row_off, rows) for row_off, rows in strips]
+    # Each strip spans the full width and starts where the strip above it ends
+    assert all(b[0] == 500000.0 and b[2] == pytest.approx(500300.0) for b in bounds)
+    assert all(above[1] == pytest.approx(below[3]) for above, below in zip(bounds, bounds[1:]))
+    assert bounds[0][3] == 2900000.0
+    assert bounds[-1][1] == pytest.approx(2900000.0 - height * 0.1)
+    assert [(b[3] - b[1]) / 0.1 for b in bounds] == pytest.approx([rows for _, rows in strips])
+
+
+def project_once(project_orthos, tmp_path, size, memory_cap_mb):
+    """Run project_raster_once on a size pixel orthomosaic, returning the outputs, decoded path and warps"""
+    gdal = project_orthos.gdal
+    gdal.size = size
+    targets = [(32617, str(tmp_path / "projected_mosaics")), (3857, str(tmp_path / "webmercator"))]
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    outputs = project_orthos.project_raster_once("/blue/orthomosaics/2022/Joule/Joule_03_01_2022.tif",
+                                                 "2022",
+                                                 "Joule",
+                                                 targets,
+                                                 memory_cap_mb=memory_cap_mb,
+                                                 tmpdir=str(scratch))
+    decoded_path = [call[1] for call in gdal.calls if call[0] == "Translate" and call[1]][0]
+    warps = [call for call in gdal.calls if call[0] == "Warp"]
+    return outputs, decoded_path, warps
+
+
+def test_project_once_decodes_in_memory(project_orthos, tmp_path):
+    # 1000 x 1000 RGB is 2.9 MB decoded
+    outputs, decoded_path, warps = project_once(project_orthos, tmp_path, (1000, 1000), memory_cap_mb=16000)
+    assert decoded_path == "/vsimem/Joule_03_01_2022_decoded.tif"
+    assert outputs == [
+        str(tmp_path / "projected_mosaics" / "2022" / "Joule" / "Joule_03_01_2022_projected.tif"),
+        str(tmp_path / "webmercator" / "2022" / "Joule" / "Joule_03_01_2022_projected.tif")
+    ]
+    assert [warp[1] for warp in warps] == outputs
+    assert [warp[3]["dstSRS"] for warp in warps] == ["EPSG:32617", "EPSG:3857"]
+    assert all(warp[3]["warpMemoryLimit"] == 2048 for warp in warps)
+    assert ("SetCacheMax", 512 * 1024**2) in project_orthos.gdal.calls
+    # Both warps read the decoded copy, which is removed afterwards
+    assert len({id(warp[2]) for warp in warps}) == 1
+    assert project_orthos.gdal.vsimem == set()
+    assert os.listdir(tmp_path / "scratch") == []
+
+
+def test_project_once_falls_back_to_a_temp_file(project_orthos, tmp_path):
+    # 4000 x 3000 RGB is 34 MB decoded, more than the 10 MB cap
+    outputs, decoded_path, warps = project_once(project_orthos, tmp_path, (4000, 3000), memory_cap_mb=10)
+    assert os.path.dirname(os.path.dirname(decoded_path)) == str(tmp_path / "scratch")
+    assert os.path.basename(decoded_path) == "Joule_03_01_2022_decoded.tif"
+    assert len(outputs) == 2
+    # Warp buffer and block cache each get a quarter of the cap
+    assert all(warp[3]["warpMemoryLimit"] == 2 for warp in warps)
+    assert ("SetCacheMax", 2 * 1024**2) in project_orthos.gdal.calls
+    # Nothing is decoded into memory and the temporary directory is removed afterwards
+    assert project_orthos.gdal.vsimem == set()
+    assert not any(call[0] == "Translate" and call[1].startswith("/vsimem/") for call in project_orthos.gdal.calls)
+    assert os.listdir(tmp_path / "scratch") == []
+
+
+def test_project_once_counts_warp_buffer_and_cache_against_the_cap(project_orthos, tmp_path):
+    # 34 MB decoded fits in a 40 MB cap alone, but not with 10 MB of warp buffer and 10 MB of block cache
+    outputs, decoded_path, warps = project_once(project_orthos, tmp_path, (4000, 3000), memory_cap_mb=40)
+    assert not decoded_path.startswith("/vsimem/")
+    assert all(warp[3]["warpMemoryLimit"] == 10 for warp in warps)
+    assert ("SetCacheMax", 10 * 1024**2) in project_orthos.gdal.calls
+
+
+def test_project_tiled_warps_planned_strips(project_orthos, tmp_path, monkeypatch):
+    monkeypatch.setattr(project_orthos, "ProcessPoolExecutor", SerialExecutor)
+    gdal = project_orthos.gdal
+    gdal.size = (3000, 10000)
+    scratch = tmp_path / "scratch"
+    dest_name = project_orthos.project_raster_tiled("/blue/orthomosaics/2022/Joule/Joule_03_01_2022.tif",
+                                                    "2022",
+                                                    "Joule",
+                                                    32617,
+                                                    str(tmp_path / "projected_mosaics"),
+                                                    workers=2,
+                                                    strip_rows=4096,
+                                                    warp_memory_mb=256,
+                                                    tmpdir=str(scratch))
+    assert dest_name == str(tmp_path / "projected_mosaics" / "2022" / "Joule" / "Joule_03_01_2022_projected.tif")
+
+    # Each strip warps the planned rows of the destination grid into the temporary directory
+    strips = project_orthos.plan_strips(10000, 4096)
+    geotransform = FakeDataset(3000, 10000).GetGeoTransform()
+    strip_warps = [call for call in gdal.calls if call[0] == "Warp" and call[1]]
+    assert [os.path.dirname(os.path.dirname(warp[1])) for warp in strip_warps] == [str(scratch)] * len(strips)
+    assert [warp[3]["outputBounds"] for warp in strip_warps
+           ] == [project_orthos.strip_bounds(geotransform, 3000, row_off, rows) for row_off, rows in strips]
+    assert [(warp[3]["width"], warp[3]["height"]) for warp in strip_warps] == [(3000, rows) for _, rows in strips]
+    assert all(warp[3]["warpMemoryLimit"] == 256 for warp in strip_warps)
+
+    # The strips are assembled through a VRT into the projected mosaic and then removed
+    build_vrt = [call for call in gdal.calls if call[0] == "BuildVRT"]
+    assert len(build_vrt) == 1 and build_vrt[0][2] == [warp[1] for warp in strip_warps]
+    assert gdal.calls[-1][0] == "Translate" and gdal.calls[-1][1] == dest_name
+    assert gdal.calls[-1][3]["format"] == "GTiff"
+    assert os.listdir(scratch) == []
@@ -0,0 +1,207 @@
+# test raster_windows
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import raster_windows
+
+
+def write_diagonal_raster(path, size=3000, nodata=255):
+    """RGB raster that is only valid along a diagonal strip, like a rotated transect"""
+    rows, cols = np.indices((size, size))
+    valid = np.abs(rows - cols) < size // 10
+    data = np.where(valid, 100, nodata).astype("uint8")
+    profile = {
+        "driver": "GTiff",
+        "width": size,
+        "height": size,
+        "count": 3,
+        "dtype": "uint8",
+        "crs": "EPSG:32617",
+        "transform": from_origin(500000, 2800000, 0.01, 0.01),
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.stack([data] * 3))
+    return path
+
+
+def test_tile_windows_cover_raster():
+    windows = raster_windows.tile_windows(3100, 1600, patch_size=1500)
+    assert len(windows) == 6
+    assert sum(window.width * window.height for window in windows) == 3100 * 1600
+    assert windows[-1].col_off == 3000 and windows[-1].width == 100
+
+
+def test_skip_nodata_windows(tmp_path):
+    path = write_diagonal_raster(os.path.join(tmp_path, "diagonal.tif"))
+    with rasterio.open(path) as src:
+        windows = raster_windows.tile_windows(src.width, src.height, patch_size=500)
+        keep, skipped = raster_windows.skip_nodata_windows(src, windows)
+        assert skipped > 0
+        assert len(keep) + skipped == len(windows)
+        # Every window with a valid pixel is kept
+        for window in windows:
+            has_data = src.dataset_mask(window=window).any()
+            assert has_data == (window in keep)
+
+        keep_mostly_valid, skipped_more = raster_windows.skip_nodata_windows(src, windows, min_valid_fraction=0.5)
+        assert skipped_more > skipped
+
+
+def test_read_preview(tmp_path):
+    path = write_diagonal_raster(os.path.join(tmp_path, "diagonal.tif"))
+    with rasterio.open(path, "r+") as dst:
+        dst.build_overviews([2, 4, 8])
+    with rasterio.open(path) as src:
+        preview = raster_windows.read_preview(src, max_size=400)
+    assert preview.shape == (400, 400, 3)
+    assert preview.dtype == np.uint8
+
+
+def test_georeference_boxes_matches_rasterio():
+    import pandas as pd
+    from rasterio.transform import xy
+
+    transform = from_origin(536000.5, 2877500.25, 0.0125, 0.0125)
+    rng = np.random.default_rng(0)
+    xmin, ymin = rng.uniform(0, 5000, 100), rng.uniform(0, 5000, 100)
+    boxes = pd.DataFrame({
+        "xmin": xmin,
+        "ymin": ymin,
+        "xmax": xmin + rng.uniform(10, 60, 100),
+        "ymax": ymin + rng.uniform(10, 60, 100),
+        "label": "Great Egret",
+        "score": 0.5
+    })
+    projected = raster_windows.georeference_boxes(boxes, transform, "EPSG:32617")
+
+    left, top = xy(transform, boxes["ymin"], boxes["xmin"], offset="center")
+    right, bottom = xy(transform, boxes["ymax"], boxes["xmax"], offset="center")
+    np.testing.assert_allclose(projected["xmin"], left)
+    np.testing.assert_allclose(projected["xmax"], right)
+    np.testing.assert_allclose(projected["ymin"], bottom)
+    np.testing.assert_allclose(projected["ymax"], top)
+    np.testing.assert_allclose(projected.geometry.bounds.to_numpy(), projected[["xmin", "ymin", "xmax", "ymax"]])
+    assert projected.crs == "EPSG:32617"
+    assert projected["label"].tolist() == boxes["label"].tolist()
+
+
+def test_warped_view_of_orthomosaic(tmpdir):
+    from rasterio.warp import calculate_default_transform
+
+    path = os.path.join(tmpdir, "Joule_03_01_2022.tif")
+    data = np.full((3, 400, 500), 100, dtype="uint8")
+    data[:, :, :50] = 255
+    with rasterio.open(path,
+                       "w",
+                       driver="GTiff",
+                       width=500,
+                       height=400,
+                       count=3,
+                       dtype="uint8",
+                       crs="EPSG:4326",
+                       transform=from_origin(-80.9, 25.9, 1e-6, 1e-6)) as dst:
+        dst.write(data)
+
+    with rasterio.open(path) as src:
+        transform, width, height = calculate_default_transform(src.crs, "EPSG:32617", src.width, src.height,
+                                                               *src.bounds)
+    with raster_windows.open_raster(path, virtual=True) as view:
+        assert view.crs == "EPSG:32617"
+        assert (view.width, view.height) == (width, height)
+        assert view.transform.almost_equals(transform)
+        image = raster_windows.read_window(view, raster_windows.tile_windows(view.width, view.height, 1500)[0])
+        assert image.shape == (view.height, view.width, 3)
+        # Nodata columns stay nodata and valid pixels are not mixed with the nodata value
+        assert image[:, :40].max() == 255
+        assert np.all((image == 255) | (image == 100))
+
+
+def test_prefetch_windows(tmpdir):
+    path = os.path.join(tmpdir, "diagonal.tif")
+    write_diagonal_raster(path, size=1200)
+    windows = raster_windows.tile_windows(1200, 1200, 250)
+    # A 250 x 250 float32 RGB window is 0.72 MB
+    assert raster_windows.queue_depth(windows, max_queued_mb=2) == 2
+    assert raster_windows.queue_depth(windows, max_queued_mb=10) == 13
+    # The windows of a batch being filled count against the budget, more workers do not raise it
+    assert raster_windows.queue_depth(windows, max_queued_mb=10, batch_size=4) == 10
+    assert raster_windows.queue_depth(windows, max_queued_mb=0.5) == 1
+
+    stats = {}
+    with rasterio.open(path) as src:
+        prefetched = list(raster_windows.prefetch_windows(path, windows, workers=3, max_queued_mb=2, stats=stats))
+        assert [window for window, _ in prefetched] == windows
+        for window, image in prefetched:
+            np.testing.assert_array_equal(image, raster_windows.read_window(src, window))
+    assert stats["read_seconds"] > 0
+    assert stats["wait_seconds"] >= 0
+
+
+def test_prefetch_windows_stays_within_budget(tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "diagonal.tif")
+    write_diagonal_raster(path, size=1200)
+    windows = raster_windows.tile_windows(1200, 1200, 250)
+    read_window = raster_windows.read_window
+    reads = []
+
+    def counted_read_window(src, window):
+        reads.append(window)
+        return read_window(src, window)
+
+    monkeypatch.setattr(raster_windows, "read_window", counted_read_window)
+    # 10 MB holds 13 windows, a batch of 4 leaves 10 to read ahead
+    budget = 13
+    batch = []
+    released = 0
+    for window, image in raster_windows.prefetch_windows(path, windows, workers=4, max_queued_mb=10, batch_size=4):
+        batch.append(image)
+        # Windows read but not yet released by the consumer never exceed the budget
+        assert len(reads) - released <= budget
+        if len(batch) == 4:
+            released += len(batch)
+            batch = []
+    assert len(reads) == len(windows)
+
+
+def test_overlapping_windows_cover_raster():
+    windows = raster_windows.tile_windows(3100, 1600, patch_size=1500, overlap=0.1)
+    assert [w.col_off for w in windows if w.row_off == 0] == [0, 1350, 2700]
+    assert [w.row_off for w in windows if w.col_off == 0] == [0, 1350]
+    assert max(w.col_off + w.width for w in windows) == 3100
+    assert max(w.row_off + w.height for w in windows) == 1600
+    assert raster_windows.tile_windows(3100, 1600, 1500) == raster_windows.tile_windows(3100, 1600, 1500, 0.0)
+
+
+def test_suppress_window_duplicates():
+    import pandas as pd
+
+    windows = raster_windows.tile_windows(2000, 1000, patch_size=1000, overlap=0.2)
+    assert [w.col_off for w in windows] == [0, 800, 1600]
+    boxes = pd.DataFrame(
+        [
+            # A bird cut off at the right edge of window 0 and whole in window 1
+            (960, 100, 1000, 140, "Great Egret", 0.6, 0),
+            (960, 100, 1010, 140, "Great Egret", 0.8, 1),
+            # Another species at the same place is kept
+            (962, 102, 1008, 138, "White Ibis", 0.7, 0),
+            # Birds in the overlap of windows 1 and 2, the best score wins
+            (1650, 500, 1680, 530, "Wood Stork", 0.9, 1),
+            (1651, 501, 1680, 530, "Wood Stork", 0.5, 2),
+            # Two birds side by side in one window are not merged
+            (100, 100, 130, 130, "Great Egret", 0.9, 0),
+            (101, 101, 131, 131, "Great Egret", 0.9, 0),
+        ],
+        columns=["xmin", "ymin", "xmax", "ymax", "label", "score", "window"])
+    merged = raster_windows.suppress_window_duplicates(boxes, windows, 2000, 1000, margin=200)
+    assert merged.index.tolist() == [1, 2, 3, 5, 6]
+    merged = raster_windows.suppress_window_duplicates(boxes, windows, 2000, 1000, margin=200, class_aware=False)
+    assert merged.index.tolist() == [1, 3, 5, 6]
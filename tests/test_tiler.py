@@ -0,0 +1,83 @@
+# test tiler
+import os
+import sqlite3
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+import tiler
+
+
+def write_webmercator_raster(path, size=512, nodata=255, value=100):
+    """RGB raster in EPSG:3857 that is only valid along a diagonal strip"""
+    rows, cols = np.indices((size, size))
+    data = np.where(np.abs(rows - cols) < size // 10, value, nodata).astype("uint8")
+    profile = {
+        "driver": "GTiff",
+        "width": size,
+        "height": size,
+        "count": 3,
+        "dtype": "uint8",
+        "crs": "EPSG:3857",
+        "transform": from_origin(-8977000, 2990000, 0.3, 0.3),
+        "nodata": nodata,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.stack([data] * 3))
+    return path
+
+
+def test_tiles_for_bounds():
+    x, y, zoom = 70000, 110000, 18
+    left, bottom, right, top = tiler.tile_bounds(x, y, zoom)
+    assert tiler.tiles_for_bounds((left + 1, bottom + 1, right - 1, top - 1), zoom) == [(x, y, zoom)]
+    assert len(tiler.tiles_for_bounds((left + 1, bottom - 1, right + 1, top - 1), zoom)) == 4
+
+
+def test_create_mbtiles(tmpdir):
+    path = write_webmercator_raster(os.path.join(tmpdir, "mosaic.tif"))
+    mbtiles_path = os.path.join(tmpdir, "mosaic.mbtiles")
+    counts = tiler.create_mbtiles(path, mbtiles_path, min_zoom=19, max_zoom=20, workers=2, incremental=True)
+
+    # Tiles off the diagonal strip are all nodata and are not written
+    assert counts["written"] > 0 and counts["empty"] > 0
+    with sqlite3.connect(mbtiles_path) as connection:
+        n_tiles = connection.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+        tile_format = connection.execute("SELECT value FROM metadata WHERE name='format'").fetchone()[0]
+        png = connection.execute("SELECT tile_data FROM tiles").fetchone()[0]
+    assert n_tiles == counts["written"]
+    assert tile_format == "png"
+    assert png[:8] == b"\x89PNG\r\n\x1a\n"
+
+    # An unchanged mosaic does not rewrite any tiles
+    counts = tiler.create_mbtiles(path, mbtiles_path, min_zoom=19, max_zoom=20, workers=2, incremental=True)
+    assert counts["written"] == 0 and counts["unchanged"] == n_tiles
+
+    # Changing the pixel values rewrites every tile with data
+    write_webmercator_raster(path, value=150)
+    counts = tiler.create_mbtiles(path, mbtiles_path, min_zoom=19, max_zoom=20, workers=2, incremental=True)
+    assert counts["written"] == n_tiles and counts["unchanged"] == 0
+
+
+def test_nodata_is_transparent(tmpdir):
+    path = write_webmercator_raster(os.path.join(tmpdir, "mosaic.tif"))
+    mbtiles_path = os.path.join(tmpdir, "mosaic.mbtiles")
+    tiler.create_mbtiles(path, mbtiles_path, min_zoom=19, max_zoom=19, workers=1)
+    with sqlite3.connect(mbtiles_path) as connection:
+        pngs = [png for png, in connection.execute("SELECT tile_data FROM tiles")]
+
+    straddling = 0
+    for png in pngs:
+        with MemoryFile(png) as memfile, memfile.open() as tile:
+            assert tile.count == 4
+            data = tile.read()
+        alpha = data[3]
+        # Nodata inside the mosaic and the area past its edges are transparent, valid pixels are opaque
+        assert set(np.unique(alpha)) <= {0, 255}
+        np.testing.assert_array_equal(alpha == 255, data[0] == 100)
+        straddling += (alpha == 0).any() and (alpha == 255).any()
+    assert straddling > 0
@@ -0,0 +1,160 @@
+# test upload_mapbox
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.getcwd()))
+import upload_mapbox
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeMapbox:
+    """Stand-in for the Mapbox Uploads API that finishes each upload after a few status checks"""
+
+    def __init__(self, checks_until_complete=2):
+        self.checks_until_complete = checks_until_complete
+        self.credentials = 0
+        self.uploads = {}
+
+    def post(self, url, json=None, headers=None):
+        if "/credentials" in url:
+            self.credentials += 1
+            n = self.credentials
+            return FakeResponse(
+                200, {
+                    "accessKeyId": f"key{n}",
+                    "secretAccessKey": "secret",
+                    "sessionToken": "token",
+                    "bucket": "staging",
+                    "key": f"object{n}",
+                    "url": f"s3://staging/object{n}"
+                })
+        upload_id = f"upload{len(self.uploads)}"
+        self.uploads[upload_id] = {"url": json["url"], "tileset": json["tileset"], "checks": 0}
+        return FakeResponse(201, {"id": upload_id})
+
+    def get(self, url):
+        upload_id = url.split("?")[0].split("/")[-1]
+        upload = self.uploads[upload_id]
+        upload["checks"] += 1
+        complete = upload["checks"] >= self.checks_until_complete
+        return FakeResponse(200, {"id": upload_id, "complete": complete, "error": None, "tileset": upload["tileset"]})
+
+
+class FakeS3:
+    """Stand-in for an S3 client that can be made to fail after a number of uploaded parts"""
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.multipart = {}
+        self.objects = {}
+        self.parts_uploaded = 0
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"mp{len(self.multipart)}"
+        self.multipart[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if self.fail_after is not None and self.parts_uploaded >= self.fail_after:
+            raise ConnectionError("connection reset")
+        self.parts_uploaded += 1
+        self.multipart[UploadId][PartNumber] = Body
+        return {"ETag": f"etag{PartNumber}"}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        numbers = sorted(number for number in self.multipart[UploadId] if number > PartNumberMarker)
+        page = numbers[:2]
+        return {
+            "Parts": [{
+                "PartNumber": number,
+                "ETag": f"etag{number}"
+            } for number in page],
+            "IsTruncated": len(numbers) > 2,
+            "NextPartNumberMarker": page[-1] if page else 0
+        }
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.multipart.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+
+
+def write_mbtiles(tmpdir, name, size):
+    path = os.path.join(tmpdir, f"{name}.mbtiles")
+    data = os.urandom(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path, data
+
+
+def test_upload_resumes_after_interruption(tmpdir):
+    state_dir = os.path.join(tmpdir, "upload_state")
+    path, data = write_mbtiles(tmpdir, "Joule_03_01_2022", 10000)
+    mapbox = FakeMapbox()
+    s3 = FakeS3(fail_after=4)
+    uploader = upload_mapbox.MapboxUploader("token", "user", session=mapbox, s3_client_factory=lambda c: s3)
+
+    failed = upload_mapbox.upload_tilesets(uploader, [path], state_dir, part_workers=1, part_size=1000)
+    assert failed == [path]
+    with open(os.path.join(state_dir, "Joule_03_01_2022.json")) as f:
+        assert "s3_upload_id" in json.load(f)
+
+    # Only the 6 missing parts are uploaded, with the same credentials
+    s3.fail_after = None
+    sleeps = []
+    failed = upload_mapbox.upload_tilesets(uploader, [path], state_dir, part_size=1000, sleep=sleeps.append)
+    assert failed == []
+    assert s3.parts_uploaded == 10
+    assert mapbox.credentials == 1
+    assert s3.objects[("staging", "object1")] == data
+    assert mapbox.uploads["upload0"]["tileset"] == "user.Joule_03_01_2022"
+    assert sleeps == [upload_mapbox.POLL_INTERVAL]
+
+    # A completed upload is not repeated
+    assert upload_mapbox.upload_tilesets(uploader, [path], state_dir, part_size=1000) == []
+    assert len(mapbox.uploads) == 1
+
+
+def test_batch_polls_uploads_together(tmpdir):
+    state_dir = os.path.join(tmpdir, "upload_state")
+    paths = [write_mbtiles(tmpdir, f"Aerie_03_0{day}_2022", 2500)[0] for day in range(1, 4)]
+    mapbox = FakeMapbox(checks_until_complete=3)
+    s3 = FakeS3()
+    uploader = upload_mapbox.MapboxUploader("token", "user", session=mapbox, s3_client_factory=lambda c: s3)
+
+    sleeps = []
+    failed = upload_mapbox.upload_tilesets(uploader, paths, state_dir, part_size=1000, sleep=sleeps.append)
+    assert failed == []
+    assert len(s3.objects) == 3
+    assert all(upload["checks"] == 3 for upload in mapbox.uploads.values())
+    assert sleeps == [upload_mapbox.POLL_INTERVAL, 2 * upload_mapbox.POLL_INTERVAL]
+
+
+def test_state_is_never_readable_by_others(tmpdir, monkeypatch):
+    state_path = os.path.join(tmpdir, "upload_state", "Joule_03_01_2022.json")
+    os.makedirs(os.path.dirname(state_path))
+    # A leftover temporary file from an interrupted run does not keep its permissions
+    with open(f"{state_path}.tmp", "w") as f:
+        f.write("{}")
+    os.chmod(f"{state_path}.tmp", 0o644)
+
+    created = []
+    open_file = os.open
+
+    def recording_open(path, flags, mode=0o777, **kwargs):
+        created.append((path, mode))
+        return open_file(path, flags, mode, **kwargs)
+
+    monkeypatch.setattr(os, "open", recording_open)
+    upload_mapbox.save_state({"credentials": {"secretAccessKey": "secret"}}, state_path)
+    assert created == [(f"{state_path}.tmp", 0o600)]
+    assert os.stat(state_path).st_mode & 0o777 == 0o600
@@ -0,0 +1,222 @@
+"""Render a web mercator mosaic into an MBTiles file without shelling out to rio mbtiles"""
+import hashlib
+import math
+import multiprocessing
+import os
+import sqlite3
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.io import MemoryFile
+from rasterio.warp import transform_bounds
+from rasterio.windows import from_bounds
+
+# Half the width of the EPSG:3857 world in meters
+WEBMERCATOR_EXTENT = 20037508.342789244
+TILE_SIZE = 256
+
+# Tiles rendered per worker task and tiles written per SQLite transaction
+TILES_PER_TASK = 64
+TILES_PER_TRANSACTION = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+CREATE TABLE IF NOT EXISTS tile_sources (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, digest TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_source_index ON tile_sources (zoom_level, tile_column, tile_row);
+"""
+
+
+def tile_bounds(x, y, zoom):
+    """Bounds (left, bottom, right, top) of an XYZ tile in EPSG:3857 meters"""
+    size = 2 * WEBMERCATOR_EXTENT / 2**zoom
+    left = -WEBMERCATOR_EXTENT + x * size
+    top = WEBMERCATOR_EXTENT - y * size
+    return left, top - size, left + size, top
+
+
+def tiles_for_bounds(bounds, zoom):
+    """All XYZ tiles at a zoom level that intersect bounds in EPSG:3857 meters"""
+    left, bottom, right, top = bounds
+    size = 2 * WEBMERCATOR_EXTENT / 2**zoom
+    n_tiles = 2**zoom
+    x_min = max(0, math.floor((left + WEBMERCATOR_EXTENT) / size))
+    x_max = min(n_tiles - 1, math.ceil((right + WEBMERCATOR_EXTENT) / size) - 1)
+    y_min = max(0, math.floor((WEBMERCATOR_EXTENT - top) / size))
+    y_max = min(n_tiles - 1, math.ceil((WEBMERCATOR_EXTENT - bottom) / size) - 1)
+    return [(x, y, zoom) for y in range(y_min, y_max + 1) for x in range(x_min, x_max + 1)]
+
+
+def encode_png(data):
+    """Encode a (bands, rows, cols) uint8 array as PNG bytes"""
+    count, height, width = data.shape
+    with MemoryFile() as memfile, warnings.catch_warnings():
+        # Tiles are located by the MBTiles index, not a geotransform
+        warnings.simplefilter("ignore", NotGeoreferencedWarning)
+        with memfile.open(driver="PNG", width=width, height=height, count=count, dtype="uint8") as dst:
+            dst.write(data)
+        return memfile.read()
+
+
+def render_tile(src, x, y, zoom, resampling=Resampling.nearest):
+    """Read the source pixels for a tile
+
+    Returns the RGBA data and whether the tile has any valid (not nodata)
+    pixels. The alpha band is the dataset mask, so nodata and the parts of
+    tiles that extend past the raster are transparent, as rio mbtiles writes
+    them.
+    """
+    window = from_bounds(*tile_bounds(x, y, zoom), transform=src.transform)
+    inside = (window.col_off >= 0 and window.row_off >= 0 and window.col_off + window.width <= src.width and
+              window.row_off + window.height <= src.height)
+    mask = src.dataset_mask(window=window,
+                            out_shape=(TILE_SIZE, TILE_SIZE),
+                            boundless=not inside,
+                            resampling=resampling)
+    if not mask.any():
+        return None, False
+    nodata = src.nodata if src.nodata is not None else 0
+    data = src.read(indexes=[1, 2, 3],
+                    window=window,
+                    out_shape=(3, TILE_SIZE, TILE_SIZE),
+                    boundless=not inside,
+                    fill_value=nodata,
+                    resampling=resampling)
+    return np.concatenate([data, mask[np.newaxis].astype("uint8")]), True
+
+
+# Source raster opened once in each worker process
+_worker_src = None
+
+
+def _init_worker(path):
+    global _worker_src
+    _worker_src = rasterio.open(path)
+
+
+def _render_tiles(tiles, known_digests):
+    """Render a chunk of tiles, skipping encoding for tiles whose source is unchanged
+
+    Returns (x, y, zoom, digest, png) for every tile. digest is None for empty
+    tiles and png is None when nothing needs to be written.
+    """
+    rendered = []
+    for x, y, zoom in tiles:
+        data, has_data = render_tile(_worker_src, x, y, zoom)
+        if not has_data:
+            rendered.append((x, y, zoom, None, None))
+            continue
+        digest = hashlib.sha1(np.ascontiguousarray(data).tobytes()).hexdigest()
+        if known_digests.get((x, y, zoom)) == digest:
+            rendered.append((x, y, zoom, digest, None))
+        else:
+            rendered.append((x, y, zoom, digest, encode_png(data)))
+    return rendered
+
+
+def write_metadata(connection, src, name, min_zoom, max_zoom):
+    west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+    metadata = {
+        "name": name,
+        "type": "overlay",
+        "version": "1.1",
+        "description": name,
+        "format": "png",
+        "bounds": f"{west},{south},{east},{north}",
+        "center": f"{(west + east) / 2},{(south + north) / 2},{min_zoom}",
+        "minzoom": str(min_zoom),
+        "maxzoom": str(max_zoom),
+    }
+    connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)", metadata.items())
+
+
+def create_mbtiles(path, mbtiles_path, min_zoom=17, max_zoom=24, workers=4, incremental=False):
+    """Write the tiles of a web mercator mosaic into an MBTiles file
+
+    Tiles are rendered by a pool of worker processes and written to SQLite in
+    batched transactions. Tiles with no valid pixels are not written. With
+    incremental=True an existing file is updated in place: a digest of each
+    tile's source pixels is stored alongside the tiles, and only tiles whose
+    source changed are encoded and rewritten. Tiles that are now empty or
+    outside the mosaic are removed. Returns counts of written, unchanged,
+    empty and removed tiles.
+    """
+    if not incremental and os.path.exists(mbtiles_path):
+        os.remove(mbtiles_path)
+
+    with rasterio.open(path) as src:
+        if src.crs.to_epsg() != 3857:
+            raise ValueError(f"{path} is not in EPSG:3857")
+        tiles = [tile for zoom in range(min_zoom, max_zoom + 1) for tile in tiles_for_bounds(src.bounds, zoom)]
+        name = os.path.splitext(os.path.basename(mbtiles_path))[0]
+        connection = sqlite3.connect(mbtiles_path)
+        connection.executescript(SCHEMA)
+        with connection:
+            write_metadata(connection, src, name, min_zoom, max_zoom)
+
+    known_digests = {}
+    if incremental:
+        for zoom, column, row, digest in connection.execute("SELECT * FROM tile_sources"):
+            x, y = column, 2**zoom - 1 - row
+            known_digests[(x, y, zoom)] = digest
+
+    counts = {"written": 0, "unchanged": 0, "empty": 0, "removed": 0}
+    chunks = [tiles[i:i + TILES_PER_TASK] for i in range(0, len(tiles), TILES_PER_TASK)]
+    print(f"Rendering {len(tiles)} tiles at zoom {min_zoom}-{max_zoom} with {workers} workers")
+    context = multiprocessing.get_context("spawn")
+    pending_tiles = []
+    pending_sources = []
+    stale = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(path,)) as executor:
+            chunk_digests = [{tile: known_digests[tile] for tile in chunk if tile in known_digests} for chunk in chunks]
+            for rendered in executor.map(_render_tiles, chunks, chunk_digests):
+                for x, y, zoom, digest, png in rendered:
+                    # MBTiles rows use the TMS scheme with y counted from the bottom
+                    row = 2**zoom - 1 - y
+                    if digest is None:
+                        counts["empty"] += 1
+                        if (x, y, zoom) in known_digests:
+                            stale.append((zoom, x, row))
+                    elif png is None:
+                        counts["unchanged"] += 1
+                    else:
+                        counts["written"] += 1
+                        pending_tiles.append((zoom, x, row, png))
+                        pending_sources.append((zoom, x, row, digest))
+                if len(pending_tiles) >= TILES_PER_TRANSACTION:
+                    _write_tiles(connection, pending_tiles, pending_sources)
+                    pending_tiles, pending_sources = [], []
+        _write_tiles(connection, pending_tiles, pending_sources)
+
+        # Remove tiles that are now empty or no longer covered by the mosaic
+        current = set(tiles)
+        stale.extend((zoom, x, 2**zoom - 1 - y) for x, y, zoom in known_digests if (x, y, zoom) not in current)
+        with connection:
+            for table in ("tiles", "tile_sources"):
+                connection.executemany(f"DELETE FROM {table} WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                       stale)
+        counts["removed"] = len(stale)
+    finally:
+        connection.close()
+
+    print(f"Tiles written: {counts['written']}, unchanged: {counts['unchanged']}, "
+          f"empty: {counts['empty']}, removed: {counts['removed']}")
+    return counts
+
+
+def _write_tiles(connection, tiles, sources):
+    if not tiles:
+        return
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)", tiles)
+        connection.executemany(
+            "INSERT OR REPLACE INTO tile_sources (zoom_level, tile_column, tile_row, digest) VALUES (?, ?, ?, ?)",
+            sources)
@@ -1,5 +1,13 @@
+import json
 import os
 import re
+from datetime import datetime
+
+# File formats for intermediate vector products, keyed by file extension
+INTERMEDIATE_FORMATS = ("shp", "parquet")
+
+EVENT_REGEX = re.compile(r'\w+_\d+_\d+_\d+_(\w+)_projected')
+SITE_REGEX = re.compile("(\\w+)_\\d+_\\d+_\\d+.*_projected")
 
 
 def get_date(x):
@@ -10,6 +18,11 @@ def get_date(x):
     return date
 
 
+def parse_date(date):
+    """Convert a date string from a file name (month_day_year) into a date"""
+    return datetime.strptime(date, "%m_%d_%Y").date()
+
+
 def get_event(path):
     """
     Determines the event for a given UAS flight
@@ -24,8 +37,7 @@ def get_event(path):
     "A", "a", "primary", "PRIMARY", or mixed case versions of "primary"
     """
     filename = os.path.basename(path)
-    regex = re.compile(r'\w+_\d+_\d+_\d+_(\w+)_projected')
-    match = regex.match(filename)
+    match = EVENT_REGEX.match(filename)
 
     if match:
         event = match.group(1).upper()
@@ -39,8 +51,7 @@ def get_event(path):
 
 def get_site(path):
     path = os.path.basename(path)
-    regex = re.compile("(\\w+)_\\d+_\\d+_\\d+.*_projected")
-    return regex.match(path).group(1)
+    return SITE_REGEX.match(path).group(1)
 
 
 def get_year(path):
@@ -49,6 +60,118 @@ def get_year(path):
     return year
 
 
+def flight_labels(path):
+    """Site, year and flight of a working directory path like .../{product}/{year}/{site}/{flight}_projected.tif"""
+    split_path = os.path.normpath(path).split(os.path.sep)
+    flight = os.path.splitext(split_path[-1])[0].replace("_projected", "")
+    return {"site": split_path[-2], "year": split_path[-3], "flight": flight}
+
+
+def repair_bounds(df):
+    """Set the xmin, ymin, xmax and ymax columns to the geometry bounds where they disagree
+
+    predict.py keeps these columns consistent with the geometry, but
+    predictions from older versions, georeferenced with DeepForest, kept the
+    box in pixel coordinates.
+    """
+    import numpy as np
+
+    columns = ["xmin", "ymin", "xmax", "ymax"]
+    bounds = df.geometry.bounds.to_numpy()
+    if all(column in df.columns for column in columns) and np.allclose(
+            df[columns].to_numpy(dtype="float64"), bounds, rtol=0, atol=1e-3):
+        return df
+    return df.assign(**dict(zip(columns, bounds.T)))
+
+
 def get_working_dir():
     test_env_set = os.environ.get("TEST_ENV")
     return "/blue/ewhite/everglades_test" if test_env_set else "/blue/ewhite/everglades"
+
+
+def read_geodataframe(path, columns=None):
+    """Read a vector file written by write_geodataframe
+
+    GeoParquet files are read when the path ends in .parquet, otherwise the
+    file is read as a Shapefile. columns limits the attribute columns that are
+    loaded; the geometry is always read.
+    """
+    import geopandas
+
+    if path.endswith(".parquet"):
+        if columns is not None:
+            columns = list(columns) + ["geometry"]
+        return geopandas.read_parquet(path, columns=columns)
+    if columns is not None:
+        return geopandas.read_file(path, columns=list(columns))
+    return geopandas.read_file(path)
+
+
+def write_geodataframe(gdf, path, mode="w"):
+    """Write a GeoDataFrame as zstd compressed GeoParquet or an ESRI Shapefile depending on the extension
+
+    mode="a" appends the rows to an existing Shapefile.
+    """
+    if path.endswith(".parquet"):
+        if mode != "w":
+            raise ValueError("GeoParquet files can only be written, not appended to")
+        gdf.to_parquet(path, index=False, compression="zstd")
+        return path
+    try:
+        import pyogrio
+        gdf.to_file(path, driver="ESRI Shapefile", engine="pyogrio", mode=mode)
+    except ImportError:
+        gdf.to_file(path, driver="ESRI Shapefile", engine="fiona", mode=mode)
+    return path
+
+
+def write_geodataframe_batches(batches, path):
+    """Write an iterable of GeoDataFrames to one file without holding them all in memory
+
+    The first non-empty batch sets the columns and CRS. Shapefiles are
+    appended to batch by batch and GeoParquet batches are written as row
+    groups, each cast to the column types of the first batch, so a later
+    batch with e.g. integer coordinates or an all-null column can still be
+    written. Columns that are all null in the first batch are written as
+    strings. Returns the number of rows written.
+    """
+    writer = None
+    n_rows = 0
+    try:
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            if not path.endswith(".parquet"):
+                write_geodataframe(batch, path, mode="w" if n_rows == 0 else "a")
+            else:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = batch.to_wkb()
+                if writer is None:
+                    columns = list(batch.columns)
+                    # GeoParquet metadata without a bbox, which is not known until every batch is written
+                    geo = {
+                        "version": "1.0.0",
+                        "primary_column": batch.geometry.name,
+                        "columns": {
+                            batch.geometry.name: {
+                                "encoding": "WKB",
+                                "geometry_types": [],
+                                "crs": batch.crs.to_json_dict() if batch.crs else None
+                            }
+                        },
+                    }
+                    schema = pa.Table.from_pandas(table, preserve_index=False).schema
+                    schema = pa.schema(
+                        [field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema],
+                        metadata={
+                            **schema.metadata, b"geo": json.dumps(geo).encode()
+                        })
+                    writer = pq.ParquetWriter(path, schema, compression="zstd")
+                writer.write_table(pa.Table.from_pandas(table[columns], preserve_index=False).cast(schema))
+            n_rows += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
@@ -1,45 +1,112 @@
+"""Upload mbtiles files to Mapbox tilesets
+
+Each file is staged in Mapbox's S3 bucket with a multipart upload and then
+turned into a tileset through the Uploads API. Many files can be uploaded by
+one process, sharing a single HTTP session. The progress of each file is
+checkpointed under mapbox/upload_state, so an interrupted run resumes from
+the last uploaded part and does not repeat files that were already uploaded.
+"""
+import argparse
 import os
-import requests
-import boto3
-from botocore.exceptions import NoCredentialsError
 import sys
-import tomli
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import instrument
+import manifest
+import tools
+
+MAPBOX_API = "https://api.mapbox.com/uploads/v1"
+# S3 multipart uploads need parts of at least 5 MB, except the last one
+PART_SIZE = 64 * 1024**2
+# Seconds between status checks of pending uploads, doubling up to the maximum
+POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 60
 
 
 class MapboxUploader:
 
-    def __init__(self, access_token, username):
+    def __init__(self, access_token, username, session=None, s3_client_factory=None, base_url=MAPBOX_API):
+        """session is reused for every API request and s3_client_factory(credentials) returns an S3 client"""
         self.access_token = access_token
         self.username = username
-        self.base_url = f"https://api.mapbox.com/uploads/v1/{self.username}"
+        self.base_url = f"{base_url}/{self.username}"
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+        self.s3_client_factory = s3_client_factory or boto3_client
+        self._s3_clients = {}
+        self._lock = threading.Lock()
 
     def request_s3_credentials(self):
         credentials_url = f"{self.base_url}/credentials?access_token={self.access_token}"
-        response = requests.post(credentials_url)
+        response = self.session.post(credentials_url)
         if response.status_code == 200:
             return response.json()
         else:
             raise Exception(f"Failed to retrieve S3 credentials. Status code: {response.status_code}")
 
-    def upload_to_s3(self, file_path, s3_credentials):
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=s3_credentials['accessKeyId'],
-            aws_secret_access_key=s3_credentials['secretAccessKey'],
-            aws_session_token=s3_credentials['sessionToken'],
-            region_name='us-east-1'  # Use the appropriate AWS region
-        )
-        try:
-            s3_client.upload_file(file_path, s3_credentials['bucket'], s3_credentials['key'])
-        except NoCredentialsError:
-            print("Credentials not available.")
-            raise
+    def s3_client(self, s3_credentials):
+        """S3 client for a set of credentials, created once and shared between threads"""
+        with self._lock:
+            key = s3_credentials['accessKeyId']
+            if key not in self._s3_clients:
+                self._s3_clients[key] = self.s3_client_factory(s3_credentials)
+            return self._s3_clients[key]
+
+    def upload_to_s3(self, file_path, s3_credentials, state=None, save_state=None, part_size=PART_SIZE, workers=4):
+        """Upload a file to the staging bucket as a multipart upload
+
+        Parts are uploaded by workers threads. When state is given the upload id
+        and part size are recorded in it and save_state(state) is called
+        once the multipart upload has been created, so a later call with the
+        same state only uploads the parts S3 does not have yet.
+        """
+        state = {} if state is None else state
+        s3_client = self.s3_client(s3_credentials)
+        bucket, key = s3_credentials['bucket'], s3_credentials['key']
+
+        uploaded = {}
+        if "s3_upload_id" in state:
+            part_size = state["part_size"]
+            uploaded = list_parts(s3_client, bucket, key, state["s3_upload_id"])
+        else:
+            response = s3_client.create_multipart_upload(Bucket=bucket, Key=key)
+            state.update(s3_upload_id=response['UploadId'], part_size=part_size)
+            if save_state is not None:
+                save_state(state)
+        upload_id = state["s3_upload_id"]
+
+        size = os.path.getsize(file_path)
+        n_parts = max(1, -(-size // part_size))
+        missing = [number for number in range(1, n_parts + 1) if number not in uploaded]
+        if uploaded:
+            print(f"Resuming {file_path}: {len(uploaded)} of {n_parts} parts already uploaded")
+
+        def upload_part(number):
+            with open(file_path, "rb") as f:
+                f.seek((number - 1) * part_size)
+                body = f.read(part_size)
+            response = s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body)
+            return number, response['ETag']
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for number, etag in executor.map(upload_part, missing):
+                uploaded[number] = etag
+
+        parts = [{'PartNumber': number, 'ETag': uploaded[number]} for number in range(1, n_parts + 1)]
+        s3_client.complete_multipart_upload(Bucket=bucket,
+                                            Key=key,
+                                            UploadId=upload_id,
+                                            MultipartUpload={'Parts': parts})
+        return n_parts - len(missing), len(missing)
 
     def create_upload(self, s3_credentials, tileset_id):
         upload_url = f"{self.base_url}?access_token={self.access_token}"
         headers = {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
         data = {"url": s3_credentials['url'], "tileset": f"{self.username}.{tileset_id}"}
-        response = requests.post(upload_url, json=data, headers=headers)
+        response = self.session.post(upload_url, json=data, headers=headers)
         if response.status_code == 201:
             return response.json()
         else:
@@ -47,15 +114,174 @@ class MapboxUploader:
 
     def retrieve_upload_status(self, upload_id):
         status_url = f"{self.base_url}/{upload_id}?access_token={self.access_token}"
-        response = requests.get(status_url)
+        response = self.session.get(status_url)
         if response.status_code in {200, 201}:
             return response.json()
         else:
             raise Exception(f"Failed to retrieve upload status. Status code: {response.status_code}")
 
 
+def boto3_client(s3_credentials):
+    import boto3
+    return boto3.client(
+        's3',
+        aws_access_key_id=s3_credentials['accessKeyId'],
+        aws_secret_access_key=s3_credentials['secretAccessKey'],
+        aws_session_token=s3_credentials['sessionToken'],
+        region_name='us-east-1'  # Use the appropriate AWS region
+    )
+
+
+def list_parts(s3_client, bucket, key, upload_id):
+    """Part number to ETag of the parts already uploaded to a multipart upload"""
+    parts = {}
+    kwargs = {}
+    while True:
+        response = s3_client.list_parts(Bucket=bucket, Key=key, UploadId=upload_id, **kwargs)
+        parts.update({part['PartNumber']: part['ETag'] for part in response.get('Parts', [])})
+        if not response.get('IsTruncated'):
+            return parts
+        kwargs = {'PartNumberMarker': response['NextPartNumberMarker']}
+
+
+def get_tileset_id(path):
+    tileset_id = os.path.splitext(os.path.basename(path))[0]
+    if len(tileset_id) >= 32:
+        raise Exception(f"Length of {tileset_id} is more than or at the limit of 32")
+    return tileset_id
+
+
+def load_state(path, state_path):
+    """Checkpointed progress of uploading path, or a new state if the file changed since"""
+    stat = os.stat(path)
+    state = manifest.load_manifest(state_path)
+    if state.get("size") != stat.st_size or state.get("mtime_ns") != stat.st_mtime_ns:
+        state = {"file": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    return state
+
+
+def save_state(state, state_path):
+    """Checkpoint an upload; the file holds temporary S3 credentials so only the owner can ever read it"""
+    manifest.write_json_atomic(state, state_path, mode=0o600)
+
+
+def stage_tileset(uploader, path, state_path, part_size=PART_SIZE, part_workers=4):
+    """Upload path to the staging bucket and create its Mapbox upload, resuming from state_path
+
+    Returns the state, which holds the Mapbox upload id once the upload was
+    created and complete=True once Mapbox finished processing it.
+    """
+    tileset_id = get_tileset_id(path)
+    state = load_state(path, state_path)
+    if state.get("complete"):
+        print(f"{path} was already uploaded to {tileset_id}")
+        return state
+
+    def checkpoint(state):
+        save_state(state, state_path)
+
+    if not state.get("staged"):
+        if "credentials" in state:
+            try:
+                uploader.upload_to_s3(path, state["credentials"], state, checkpoint, part_size, part_workers)
+            except Exception as e:
+                # Expired credentials or an aborted multipart upload, start again
+                print(f"Could not resume {path} ({e!r}), uploading it again")
+                state = {key: state[key] for key in ("file", "size", "mtime_ns")}
+        if "credentials" not in state or "s3_upload_id" not in state:
+            state["credentials"] = uploader.request_s3_credentials()
+            checkpoint(state)
+            uploader.upload_to_s3(path, state["credentials"], state, checkpoint, part_size, part_workers)
+        state["staged"] = True
+        checkpoint(state)
+
+    if "upload_id" not in state:
+        state["upload_id"] = uploader.create_upload(state["credentials"], tileset_id)['id']
+        checkpoint(state)
+    return state
+
+
+def wait_for_uploads(uploader,
+                     upload_ids,
+                     interval=POLL_INTERVAL,
+                     max_interval=MAX_POLL_INTERVAL,
+                     timeout=3600,
+                     sleep=time.sleep):
+    """Poll the status of several uploads until each one completes or fails
+
+    The wait between rounds of status checks doubles from interval up to
+    max_interval. Returns the last status of each upload id; uploads still
+    processing after timeout seconds are returned with complete=False.
+    """
+    pending = list(upload_ids)
+    statuses = {}
+    start = time.monotonic()
+    while True:
+        for upload_id in list(pending):
+            status = uploader.retrieve_upload_status(upload_id)
+            statuses[upload_id] = status
+            if status.get("complete") or status.get("error"):
+                pending.remove(upload_id)
+        if not pending or time.monotonic() - start + interval > timeout:
+            return statuses
+        sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def upload_tilesets(uploader,
+                    paths,
+                    state_dir,
+                    workers=4,
+                    part_workers=4,
+                    part_size=PART_SIZE,
+                    poll_interval=POLL_INTERVAL,
+                    timeout=3600,
+                    sleep=time.sleep):
+    """Upload mbtiles files to Mapbox, workers files at a time, and wait until Mapbox processed them
+
+    Progress is checkpointed in state_dir/{tileset id}.json. Returns the
+    paths that failed or were still processing after timeout seconds.
+    """
+    state_paths = {path: os.path.join(state_dir, f"{get_tileset_id(path)}.json") for path in paths}
+
+    def stage(path):
+        try:
+            return stage_tileset(uploader, path, state_paths[path], part_size, part_workers)
+        except Exception as e:
+            # Other files go on, this one resumes from its checkpoint on the next run
+            print(f"Staging {path} failed: {e!r}")
+            return None
+
+    with instrument.step("stage"):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            states = dict(zip(paths, executor.map(stage, paths)))
+    failed = [path for path, state in states.items() if state is None]
+    instrument.count("files", len(paths))
+
+    pending = {state["upload_id"]: path for path, state in states.items() if state and not state.get("complete")}
+    with instrument.step("wait"):
+        statuses = wait_for_uploads(uploader, pending, interval=poll_interval, timeout=timeout, sleep=sleep)
+    for upload_id, status in statuses.items():
+        path = pending[upload_id]
+        if status.get("error"):
+            # Start from a fresh staging upload next time
+            print(f"Upload of {path} failed: {status['error']}")
+            os.remove(state_paths[path])
+            failed.append(path)
+        elif status.get("complete"):
+            print(f"Uploaded {path} to {status.get('tileset')}")
+            states[path]["complete"] = True
+            save_state(states[path], state_paths[path])
+        else:
+            print(f"Upload of {path} is still processing, its status will be checked again on the next run")
+            failed.append(path)
+    return failed
+
+
 def get_credentials():
     """Get credentials from mapbox.ini"""
+    import tomli
+
     with open("/blue/ewhite/everglades/mapbox.ini", "rb") as f:
         toml_dict = tomli.load(f)
         access_token = toml_dict['mapbox']['access-token']
@@ -63,22 +289,26 @@ def get_credentials():
 
 
 if __name__ == "__main__":
-    file_path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Upload mbtiles files to Mapbox tilesets")
+    parser.add_argument("paths", nargs="+", help="mbtiles files")
+    parser.add_argument("--workers", type=int, default=4, help="Files uploaded at a time")
+    parser.add_argument("--part-workers", type=int, default=4, help="Parts of each file uploaded at a time")
+    parser.add_argument("--timeout", type=int, default=3600, help="Seconds to wait for Mapbox to process uploads")
+    args = parser.parse_args()
+
     access_token = get_credentials()
     username = 'bweinstein'
     uploader = MapboxUploader(access_token, username)
-    # Step 1: Request S3 credentials
-    s3_credentials = uploader.request_s3_credentials()
-
-    # Step 2: Upload to Mapbox's S3 staging bucket
-    uploader.upload_to_s3(file_path, s3_credentials)
-    filename_without_extension = os.path.splitext(os.path.basename(file_path))[0]
-    tileset_id = filename_without_extension
-
-    if len(tileset_id) >= 32:
-        raise Exception(f"Length of {tileset_id} is more than or at the limit of 32")
-    # Step 3: Create an upload to matbox
-    upload_data = uploader.create_upload(s3_credentials, tileset_id)
-    upload_id = upload_data['id']
-    upload_status = uploader.retrieve_upload_status(upload_id)
-    print(f"Upload status: {upload_status}")
+    if len(args.paths) == 1:
+        instrument.start_job("upload_mapbox", **tools.flight_labels(args.paths[0]))
+    else:
+        instrument.start_job("upload_mapbox", flights=[tools.flight_labels(path)["flight"] for path in args.paths])
+    state_dir = os.path.join(tools.get_working_dir(), "mapbox", "upload_state")
+    failed = upload_tilesets(uploader,
+                             args.paths,
+                             state_dir,
+                             workers=args.workers,
+                             part_workers=args.part_workers,
+                             timeout=args.timeout)
+    if failed:
+        sys.exit(f"{len(failed)} of {len(args.paths)} uploads did not complete: {' '.join(failed)}")